@@ -1,13 +1,25 @@
 from dotenv import load_dotenv
 # 在程序启动时加载 .env 文件
 load_dotenv(override=True)
-from fastapi.responses import FileResponse
+import asyncio
+import os
+from fastapi.responses import FileResponse, JSONResponse, Response
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from fastapi.staticfiles import StaticFiles
 from fastapi import FastAPI
 from routers.api_router import api_router
 from routers.dev_router import dev_router
 from routers.lg_router import lg_router # Import the new router
 from fastapi.middleware.cors import CORSMiddleware
+from database.async_connection import warm_up_async_pools, close_async_pools, get_async_pool_status
+from database.pool_monitor import watch_pool_leaks
+from tools.embedding_service import embedding_service
+from tools.vector_index import law_vector_index, LAW_INDEX_ENABLED
+from tools.question_law_table import question_law_table
+from tools.schema_catalog import schema_catalog
+from tools.hybrid_retrieval import law_bm25_index, hybrid_retriever, RAG_HYBRID_ENABLED
+from setting.models_provider.model_manage import ModelManage
+from tools.timing import ServerTimingMiddleware
 
 # 初始化 FastAPI 应用
 app = FastAPI(
@@ -36,11 +48,55 @@ app.add_middleware(
     allow_headers=["*"],  # 允许所有请求头，也可以指定具体的请求头
 )
 
+# 记录每个请求各阶段耗时，通过 Server-Timing 响应头返回（流式接口在最后的 timing 事件中返回）
+app.add_middleware(ServerTimingMiddleware)
+
+# 就绪检查必须可用的数据库，其余数据库不可用时仅影响对应接口
+READY_REQUIRED_POOLS = [db_type for db_type in os.getenv("READY_REQUIRED_POOLS", "dev,prod").split(",") if db_type]
+
+# 启动时在后台并行预热异步数据库连接池、法条向量索引和 BM25 索引（不阻塞服务启动），创建共享的 HTTP 会话并加载预计算的题目-法条检索表和数据分析用的 schema 目录
+@app.on_event("startup")
+async def startup():
+    app.state.pool_warm_up_task = asyncio.create_task(warm_up_async_pools())
+    app.state.pool_leak_watch_task = asyncio.create_task(watch_pool_leaks())
+    await embedding_service.startup()
+    question_law_table.load()
+    schema_catalog.load()
+    if LAW_INDEX_ENABLED:
+        app.state.law_index_task = asyncio.create_task(law_vector_index.warm_up())
+    if RAG_HYBRID_ENABLED:
+        app.state.bm25_index_task = asyncio.create_task(law_bm25_index.warm_up())
+
+# 关闭时释放异步数据库连接池和 HTTP 会话
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.pool_warm_up_task.cancel()
+    app.state.pool_leak_watch_task.cancel()
+    await close_async_pools()
+    await embedding_service.close()
+    await hybrid_retriever.close()
+    await ModelManage.close()
+
 # 健康检查接口
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
 
+# 就绪检查接口，返回每个数据库连接池的状态
+@app.get("/ready")
+async def ready_check():
+    pools = get_async_pool_status()
+    ready = all(pools[db_type]["status"] == "ready" for db_type in READY_REQUIRED_POOLS)
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "not_ready", "pools": pools},
+    )
+
+# 指标接口，Prometheus 文本格式
+@app.get("/metrics")
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # 将路由器添加到应用
 app.include_router(api_router)
 
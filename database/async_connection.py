@@ -0,0 +1,164 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from psycopg_pool import AsyncConnectionPool
+
+from database.connection import DB_ENV_PREFIXES, get_db_config
+from database.vector import register_vector_type
+from database.pool_monitor import record_checkout, record_checkout_error, record_release, find_caller, get_in_use_counts
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+# 打开连接池时等待首个连接建立的超时时间（秒）
+POOL_OPEN_TIMEOUT = float(os.getenv("DB_POOL_OPEN_TIMEOUT", "10"))
+# 连接池打开失败后的重试间隔（秒），期间的请求直接失败，不再排队等待重新打开
+POOL_RETRY_BACKOFF = float(os.getenv("DB_POOL_RETRY_BACKOFF", "30"))
+
+
+def _to_psycopg_kwargs(config: dict) -> dict:
+    """
+    psycopg2 的连接参数转换为 psycopg3 的连接参数（database -> dbname）
+    """
+    kwargs = dict(config)
+    kwargs["dbname"] = kwargs.pop("database")
+    return kwargs
+
+# 异步连接池，名称与同步连接池保持一致: dev / prod / lg
+# 每个库的连接池在第一次使用（或启动预热）时才创建，互不影响
+async_connection_pools = {}
+_pool_locks = {db_type: asyncio.Lock() for db_type in DB_ENV_PREFIXES}
+
+# 各连接池状态: uninitialized / initializing / ready / error
+async_pool_states = {
+    db_type: {"status": "uninitialized", "error": None, "init_ms": None}
+    for db_type in DB_ENV_PREFIXES
+}
+# 各连接池最近一次打开失败的时间（time.monotonic()）
+_pool_failed_at = {}
+
+def _check_retry_backoff(db_type: str):
+    """
+    距上次打开失败不足 POOL_RETRY_BACKOFF 秒时直接抛出上次的错误
+    """
+    failed_at = _pool_failed_at.get(db_type)
+    if failed_at is None:
+        return
+    remaining = POOL_RETRY_BACKOFF - (time.monotonic() - failed_at)
+    if remaining > 0:
+        raise ConnectionError(
+            f"数据库连接池 {db_type} 初始化失败，{remaining:.0f} 秒后重试: {async_pool_states[db_type]['error']}"
+        )
+
+async def _get_async_pool(db_type="dev") -> AsyncConnectionPool:
+    """
+    获取异步连接池，不存在时创建并打开；打开失败时记录错误，
+    POOL_RETRY_BACKOFF 秒内的请求直接失败，之后的第一次使用时重试
+    """
+    if db_type not in DB_ENV_PREFIXES:
+        raise ValueError(f"无效的数据库类型: {db_type}")
+    if db_type in async_connection_pools:
+        return async_connection_pools[db_type]
+    _check_retry_backoff(db_type)
+
+    async with _pool_locks[db_type]:
+        if db_type in async_connection_pools:
+            return async_connection_pools[db_type]
+        # 排在失败的打开操作之后的请求同样直接失败
+        _check_retry_backoff(db_type)
+        async_pool_states[db_type] = {"status": "initializing", "error": None, "init_ms": None}
+        start_time = time.time()
+        db_pool = None
+        try:
+            db_pool = AsyncConnectionPool(
+                kwargs=_to_psycopg_kwargs(get_db_config(db_type)),
+                min_size=1,
+                max_size=10,
+                open=False,
+                name=db_type,
+                configure=register_vector_type,
+            )
+            await db_pool.open(wait=True, timeout=POOL_OPEN_TIMEOUT)
+        except Exception as e:
+            if db_pool is not None:
+                await db_pool.close()
+            async_pool_states[db_type] = {"status": "error", "error": str(e), "init_ms": None}
+            _pool_failed_at[db_type] = time.monotonic()
+            logger.error(f"数据库连接池 {db_type} 初始化失败: {e}")
+            raise
+        async_connection_pools[db_type] = db_pool
+        _pool_failed_at.pop(db_type, None)
+        async_pool_states[db_type] = {
+            "status": "ready",
+            "error": None,
+            "init_ms": round((time.time() - start_time) * 1000, 2),
+        }
+        logger.info(f"数据库连接池 {db_type} 初始化完成: {async_pool_states[db_type]['init_ms']} ms")
+        return db_pool
+
+async def warm_up_async_pools(db_types=None):
+    """
+    并行预热异步连接池，单个库失败不会影响其他库
+    :param db_types: 需要预热的数据库类型，默认全部
+    """
+    db_types = db_types or list(DB_ENV_PREFIXES)
+    await asyncio.gather(
+        *(_get_async_pool(db_type) for db_type in db_types),
+        return_exceptions=True,
+    )
+    return get_async_pool_status()
+
+def get_async_pool_status() -> dict:
+    """
+    获取异步连接池状态
+    """
+    in_use_counts = get_in_use_counts()
+    return {
+        db_type: {**state, "in_use": in_use_counts.get(db_type, 0)}
+        for db_type, state in async_pool_states.items()
+    }
+
+async def close_async_pools():
+    """
+    关闭所有异步连接池
+    """
+    for db_type in list(async_connection_pools):
+        db_pool = async_connection_pools.pop(db_type)
+        await db_pool.close()
+        async_pool_states[db_type] = {"status": "uninitialized", "error": None, "init_ms": None}
+    _pool_failed_at.clear()
+
+@asynccontextmanager
+async def get_async_db_connection(db_type="dev"):
+    """
+    获取异步数据库连接，退出上下文时提交事务（异常时回滚）并归还连接
+    :param db_type: 数据库类型，可选 'dev', 'prod', 或 'lg'
+    :return: 异步数据库连接对象
+    """
+    if db_type not in DB_ENV_PREFIXES:
+        raise ValueError(f"无效的数据库类型: {db_type}")
+
+    caller = find_caller()
+    start_time = time.time()
+    try:
+        db_pool = await _get_async_pool(db_type)
+        connection = await db_pool.getconn()
+    except Exception as e:
+        record_checkout_error(db_type, e)
+        raise Exception(f"数据库连接失败: {str(e)}")
+    record_checkout(connection, db_type, time.time() - start_time, caller)
+
+    try:
+        yield connection
+    except BaseException:
+        await connection.rollback()
+        raise
+    else:
+        await connection.commit()
+    finally:
+        record_release(connection, db_type)
+        await db_pool.putconn(connection)
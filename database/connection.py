@@ -1,65 +1,109 @@
 from psycopg2 import pool
+from contextlib import contextmanager
 import os
+import threading
+import time
 
-# 数据库连接配置
-DB_CONFIGS = {
-    "dev": {
-        "host": os.getenv("DB_HOST"),
-        "port": int(os.getenv("DB_PORT")),
-        "user": os.getenv("DB_USER"),
-        "password": os.getenv("DB_PASSWORD"),
-        "database": os.getenv("DB_NAME"),
-    },
+from database.pool_monitor import record_checkout, record_checkout_error, record_release, find_caller
+
+# 数据库环境变量前缀，对应 dev / prod / lg 三个数据库
+DB_ENV_PREFIXES = {
+    "dev": "DB_",
+    "prod": "Pord_DB_",
+    "lg": "LG_DB_",
+}
+
+# 额外的连接参数
+DB_EXTRA_OPTIONS = {
     "prod": {
-        "host": os.getenv("Pord_DB_HOST"),
-        "port": int(os.getenv("Pord_DB_PORT")),
-        "user": os.getenv("Pord_DB_USER"),
-        "password": os.getenv("Pord_DB_PASSWORD"),
-        "database": os.getenv("Pord_DB_NAME"),
         "options": "-c search_path=tobacco,public",  # 添加 search_path
     },
-    "lg": {
-        "host": os.getenv("LG_DB_HOST"),
-        "port": int(os.getenv("LG_DB_PORT")),
-        "user": os.getenv("LG_DB_USER"),
-        "password": os.getenv("LG_DB_PASSWORD"),
-        "database": os.getenv("LG_DB_NAME"),
-    }
 }
 
-# 创建连接池
-connection_pools = {
-    "dev": pool.SimpleConnectionPool(
-        minconn=1,
-        maxconn=10,
-        **DB_CONFIGS["dev"]
-    ),
-    "prod": pool.SimpleConnectionPool(
-        minconn=1,
-        maxconn=10,
-        **DB_CONFIGS["prod"]
-    ),
-    "lg": pool.SimpleConnectionPool(
-        minconn=1,
-        maxconn=10,
-        **DB_CONFIGS["lg"]
-    )
+def get_db_config(db_type="dev") -> dict:
+    """
+    读取数据库连接配置（使用时才读取环境变量，缺失配置不会影响模块导入）
+    :param db_type: 数据库类型，可选 'dev', 'prod', 或 'lg'
+    :return: psycopg2 连接参数
+    """
+    if db_type not in DB_ENV_PREFIXES:
+        raise ValueError(f"无效的数据库类型: {db_type}")
+    prefix = DB_ENV_PREFIXES[db_type]
+    port = os.getenv(f"{prefix}PORT")
+    if not port:
+        raise ValueError(f"数据库 {db_type} 未配置 {prefix}PORT")
+    return {
+        "host": os.getenv(f"{prefix}HOST"),
+        "port": int(port),
+        "user": os.getenv(f"{prefix}USER"),
+        "password": os.getenv(f"{prefix}PASSWORD"),
+        "database": os.getenv(f"{prefix}NAME"),
+        **DB_EXTRA_OPTIONS.get(db_type, {}),
+    }
+
+# 连接池在第一次使用时创建
+connection_pools = {}
+_pools_lock = threading.Lock()
+
+# 各连接池状态: uninitialized / initializing / ready / error
+pool_states = {
+    db_type: {"status": "uninitialized", "error": None, "init_ms": None}
+    for db_type in DB_ENV_PREFIXES
 }
 
+def _get_pool(db_type="dev") -> pool.SimpleConnectionPool:
+    """
+    获取连接池，不存在时创建
+    """
+    if db_type not in DB_ENV_PREFIXES:
+        raise ValueError(f"无效的数据库类型: {db_type}")
+    if db_type in connection_pools:
+        return connection_pools[db_type]
+
+    with _pools_lock:
+        if db_type in connection_pools:
+            return connection_pools[db_type]
+        pool_states[db_type] = {"status": "initializing", "error": None, "init_ms": None}
+        start_time = time.time()
+        try:
+            connection_pools[db_type] = pool.SimpleConnectionPool(
+                minconn=1,
+                maxconn=10,
+                **get_db_config(db_type)
+            )
+        except Exception as e:
+            pool_states[db_type] = {"status": "error", "error": str(e), "init_ms": None}
+            raise
+        pool_states[db_type] = {
+            "status": "ready",
+            "error": None,
+            "init_ms": round((time.time() - start_time) * 1000, 2),
+        }
+        return connection_pools[db_type]
+
+def get_pool_status() -> dict:
+    """
+    获取同步连接池状态
+    """
+    return {db_type: dict(state) for db_type, state in pool_states.items()}
+
 def get_db_connection(db_type="dev"):
     """
     获取数据库连接
     :param db_type: 数据库类型，可选 'dev', 'prod', 或 'lg'
     :return: 数据库连接对象
     """
-    if db_type not in connection_pools:
+    if db_type not in DB_ENV_PREFIXES:
         raise ValueError(f"无效的数据库类型: {db_type}")
-    
+
+    start_time = time.time()
     try:
-        connection = connection_pools[db_type].getconn()
-        return connection
+        connection = _get_pool(db_type).getconn()
     except Exception as e:
+        record_checkout_error(db_type, e)
         raise Exception(f"数据库连接失败: {str(e)}")
+    record_checkout(connection, db_type, time.time() - start_time, find_caller())
+    return connection
 
 def release_db_connection(connection, db_type="dev"):
     """
@@ -67,10 +111,26 @@ def release_db_connection(connection, db_type="dev"):
     :param connection: 要释放的数据库连接
     :param db_type: 数据库类型，可选 'dev', 'prod', 或 'lg'
     """
-    if db_type not in connection_pools:
+    # 连接总是归还到借出它的连接池，与 db_type 不一致时归还后再抛出 ValueError，避免连接泄漏或被放进错误的连接池
+    pool_name = record_release(connection, db_type)
+    if pool_name not in connection_pools:
         raise ValueError(f"无效的数据库类型: {db_type}")
-    
     try:
-        connection_pools[db_type].putconn(connection)
+        connection_pools[pool_name].putconn(connection)
     except Exception as e:
-        raise Exception(f"释放数据库连接失败: {str(e)}")
\ No newline at end of file
+        raise Exception(f"释放数据库连接失败: {str(e)}")
+    if pool_name != db_type:
+        raise ValueError(f"连接借出自 {pool_name} 连接池，不能归还到 {db_type} 连接池（已归还到 {pool_name} 连接池）")
+
+@contextmanager
+def db_connection(db_type="dev"):
+    """
+    获取数据库连接的上下文管理器，退出时自动归还连接
+    :param db_type: 数据库类型，可选 'dev', 'prod', 或 'lg'
+    :return: 数据库连接对象
+    """
+    connection = get_db_connection(db_type)
+    try:
+        yield connection
+    finally:
+        release_db_connection(connection, db_type)
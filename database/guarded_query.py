@@ -0,0 +1,185 @@
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+from psycopg import errors
+from prometheus_client import Counter, Histogram
+
+from database.async_connection import get_async_db_connection
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+# 生成的 SQL 单条语句的执行超时（毫秒），EXPLAIN 同样受此限制
+SQL_GUARD_STATEMENT_TIMEOUT_MS = int(os.getenv("SQL_GUARD_STATEMENT_TIMEOUT_MS", "10000"))
+# EXPLAIN 估算的总代价超过该值时拒绝执行，0 表示不检查
+SQL_GUARD_MAX_COST = float(os.getenv("SQL_GUARD_MAX_COST", "1000000"))
+# 最多返回的行数，超出部分不会从数据库取回
+SQL_GUARD_MAX_ROWS = int(os.getenv("SQL_GUARD_MAX_ROWS", "1000"))
+
+SQL_GUARD_REJECTED = Counter(
+    "mcbot_sql_guard_rejected_total",
+    "Generated SQL rejected or cancelled by the guard",
+    ["reason"],
+)
+SQL_GUARD_TRUNCATED = Counter(
+    "mcbot_sql_guard_truncated_total",
+    "Generated SQL results cut off at SQL_GUARD_MAX_ROWS",
+)
+SQL_GUARD_PLAN_COST = Histogram(
+    "mcbot_sql_guard_plan_cost",
+    "EXPLAIN total cost of generated SQL",
+    buckets=(10, 100, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8),
+)
+
+
+class SQLGuardError(Exception):
+    """生成的 SQL 未通过检查或被中止，reason 为 invalid / multiple_statements / cost / timeout / read_only"""
+
+    def __init__(self, message: str, reason: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+@dataclass
+class QueryResult:
+    """
+    受保护查询的结果
+    """
+    rows: List[tuple] = field(default_factory=list)
+    columns: List[str] = field(default_factory=list)
+    # 结果超过行数上限被截断
+    truncated: bool = False
+    # EXPLAIN 估算的总代价
+    cost: Optional[float] = None
+
+
+def _reject(message: str, reason: str) -> SQLGuardError:
+    SQL_GUARD_REJECTED.labels(reason=reason).inc()
+    logger.warning(f"SQL 被拒绝({reason}): {message}")
+    return SQLGuardError(message, reason)
+
+
+_DOLLAR_TAG_RE = re.compile(r"\$[A-Za-z_]\w*\$|\$\$")
+
+
+def _split_statements(sql_query: str) -> List[str]:
+    """
+    按顶层分号拆分 SQL，跳过字符串、带引号的标识符、注释和 $$ 引用中的分号；
+    只有空白和注释的语句不计入
+    """
+    statements, start, has_content = [], 0, False
+    i, length = 0, len(sql_query)
+    while i < length:
+        char = sql_query[i]
+        if char == "'":
+            # E'...' 字符串中反斜杠可以转义引号
+            escapes = i > 0 and sql_query[i - 1] in "eE"
+            i += 1
+            while i < length and sql_query[i] != "'":
+                i += 2 if escapes and sql_query[i] == "\\" else 1
+            has_content = True
+        elif char == '"':
+            i = sql_query.find('"', i + 1)
+            i = length if i < 0 else i
+            has_content = True
+        elif sql_query.startswith("--", i):
+            i = sql_query.find("\n", i)
+            i = length if i < 0 else i
+        elif sql_query.startswith("/*", i):
+            # 块注释可以嵌套
+            depth, i = 1, i + 2
+            while i < length and depth:
+                if sql_query.startswith("/*", i):
+                    depth, i = depth + 1, i + 2
+                elif sql_query.startswith("*/", i):
+                    depth, i = depth - 1, i + 2
+                else:
+                    i += 1
+            continue
+        elif char == "$" and _DOLLAR_TAG_RE.match(sql_query, i):
+            tag = _DOLLAR_TAG_RE.match(sql_query, i).group()
+            i = sql_query.find(tag, i + len(tag))
+            i = length if i < 0 else i + len(tag) - 1
+            has_content = True
+        elif char == ";":
+            if has_content:
+                statements.append(sql_query[start:i].strip())
+            start, has_content = i + 1, False
+        elif not char.isspace():
+            has_content = True
+        i += 1
+    if has_content:
+        statements.append(sql_query[start:].strip())
+    return statements
+
+
+def _normalize_sql(sql_query) -> str:
+    """
+    只接受单条 SQL 字符串，去掉末尾的分号（服务端游标的 DECLARE 中不能带分号）
+    多条语句直接拒绝：否则其中的 COMMIT 可以结束只读事务，后面的语句就能写库
+    """
+    if not isinstance(sql_query, str) or not sql_query.strip():
+        raise _reject(f"未生成有效的 SQL: {sql_query}", "invalid")
+    statements = _split_statements(sql_query)
+    if len(statements) != 1:
+        raise _reject(f"只允许执行单条查询语句，生成的 SQL 包含 {len(statements)} 条语句", "multiple_statements")
+    return statements[0]
+
+
+async def execute_guarded_query(sql_query: str, db_type: str = "prod", max_rows: int = None,
+                                timeout_ms: int = None, max_cost: float = None) -> QueryResult:
+    """
+    执行由 LLM 生成的 SQL：
+    1. 只读事务，并通过 SET LOCAL 设置 statement_timeout
+    2. 先 EXPLAIN，估算代价超过 max_cost 时拒绝执行
+    3. 通过服务端游标取数，最多取回 max_rows 行
+    :param sql_query: 待执行的 SQL
+    :param db_type: 数据库类型
+    :param max_rows: 行数上限，默认 SQL_GUARD_MAX_ROWS
+    :param timeout_ms: 语句超时（毫秒），默认 SQL_GUARD_STATEMENT_TIMEOUT_MS
+    :param max_cost: 代价上限，默认 SQL_GUARD_MAX_COST，0 表示不检查
+    :return: QueryResult
+    """
+    max_rows = SQL_GUARD_MAX_ROWS if max_rows is None else max_rows
+    timeout_ms = SQL_GUARD_STATEMENT_TIMEOUT_MS if timeout_ms is None else timeout_ms
+    max_cost = SQL_GUARD_MAX_COST if max_cost is None else max_cost
+    sql_query = _normalize_sql(sql_query)
+
+    start_time = time.time()
+    result = QueryResult()
+    try:
+        async with get_async_db_connection(db_type) as conn:
+            # 必须是事务中的第一条语句；连接归还前事务结束，设置不会带到连接池中的其他请求
+            await conn.execute("SET TRANSACTION READ ONLY")
+            await conn.execute(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+            if max_cost:
+                async with conn.cursor() as cursor:
+                    # binary 强制使用扩展查询协议，服务端拒绝一次执行多条语句（服务端游标的 DECLARE 本身就走扩展协议）
+                    await cursor.execute(f"EXPLAIN (FORMAT JSON) {sql_query}", binary=True)
+                    plan = (await cursor.fetchone())[0]
+                result.cost = float(plan[0]["Plan"]["Total Cost"])
+                SQL_GUARD_PLAN_COST.observe(result.cost)
+                if result.cost > max_cost:
+                    raise _reject(f"查询代价过高（估算 {result.cost:.0f}，上限 {max_cost:.0f}），请缩小查询范围", "cost")
+            async with conn.cursor(name="guarded_query") as cursor:
+                await cursor.execute(sql_query)
+                result.columns = [column.name for column in cursor.description or []]
+                # 多取一行用于判断是否被截断
+                rows = await cursor.fetchmany(max_rows + 1)
+    except errors.QueryCanceled:
+        raise _reject(f"SQL 执行超过 {timeout_ms} ms，已中止", "timeout")
+    except errors.ReadOnlySqlTransaction:
+        raise _reject("只允许执行查询语句", "read_only")
+
+    result.truncated = len(rows) > max_rows
+    result.rows = rows[:max_rows]
+    if result.truncated:
+        SQL_GUARD_TRUNCATED.inc()
+    logger.info(f"SQL 执行完成: {len(result.rows)} 行{'（已截断）' if result.truncated else ''}，"
+                f"估算代价 {result.cost}，耗时 {round((time.time() - start_time) * 1000, 2)} ms")
+    return result
@@ -0,0 +1,149 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from prometheus_client import Counter, Gauge, Histogram
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+# 连接持有超过该时间（秒）归还时记录告警
+DB_HOLD_WARN_SECONDS = float(os.getenv("DB_HOLD_WARN_SECONDS", "5"))
+# 连接持有超过该时间（秒）仍未归还视为泄漏
+DB_LEAK_SECONDS = float(os.getenv("DB_LEAK_SECONDS", "60"))
+# 泄漏巡检间隔（秒）
+DB_LEAK_CHECK_INTERVAL = float(os.getenv("DB_LEAK_CHECK_INTERVAL", "30"))
+
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    "mcbot_db_pool_checkout_seconds",
+    "Time spent waiting for a connection from the pool",
+    ["pool"],
+)
+DB_POOL_HOLD_SECONDS = Histogram(
+    "mcbot_db_pool_hold_seconds",
+    "Time a connection was held before being returned to the pool",
+    ["pool"],
+)
+DB_POOL_IN_USE = Gauge(
+    "mcbot_db_pool_in_use",
+    "Connections currently checked out of the pool",
+    ["pool"],
+)
+DB_POOL_CHECKOUT_ERRORS = Counter(
+    "mcbot_db_pool_checkout_errors_total",
+    "Failed attempts to get a connection from the pool",
+    ["pool"],
+)
+DB_POOL_LONG_HOLDS = Counter(
+    "mcbot_db_pool_long_holds_total",
+    "Connections held longer than DB_HOLD_WARN_SECONDS",
+    ["pool"],
+)
+
+# 当前借出的连接: id(connection) -> 借出信息
+_checkouts = {}
+_checkouts_lock = threading.Lock()
+
+# 查找调用方时跳过的文件
+_SKIP_FILES = (os.path.dirname(os.path.abspath(__file__)), "contextlib")
+
+
+def find_caller() -> str:
+    """
+    获取借出连接的调用方位置（跳过 database 包和 contextlib 内部的栈帧）
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not any(skip in filename for skip in _SKIP_FILES):
+            return f"{os.path.relpath(filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "unknown"
+
+def record_checkout(connection, db_type: str, wait_seconds: float, caller: str):
+    """
+    记录一次连接借出
+    """
+    with _checkouts_lock:
+        _checkouts[id(connection)] = {
+            "pool": db_type,
+            "caller": caller,
+            "checkout_time": time.time(),
+            "leak_reported": False,
+        }
+    DB_POOL_CHECKOUT_SECONDS.labels(pool=db_type).observe(wait_seconds)
+    DB_POOL_IN_USE.labels(pool=db_type).inc()
+
+def record_checkout_error(db_type: str, error: Exception):
+    """
+    记录一次借出失败，并输出该连接池当前的持有者，方便定位连接池打满
+    """
+    DB_POOL_CHECKOUT_ERRORS.labels(pool=db_type).inc()
+    holders = [
+        f"{checkout['caller']} ({time.time() - checkout['checkout_time']:.1f}s)"
+        for checkout in get_outstanding_checkouts()
+        if checkout["pool"] == db_type
+    ]
+    logger.error(f"数据库连接池 {db_type} 借出连接失败: {error}; 当前持有 {len(holders)} 个连接: {holders}")
+
+def record_release(connection, db_type: str) -> str:
+    """
+    记录一次连接归还
+    :return: 连接实际借出的连接池（未记录借出时为 db_type），调用方应把连接归还到该连接池
+    """
+    with _checkouts_lock:
+        checkout = _checkouts.pop(id(connection), None)
+    if checkout is None:
+        logger.warning(f"归还未记录借出的连接到 {db_type} 连接池")
+        return db_type
+
+    pool_name = checkout["pool"]
+    if pool_name != db_type:
+        logger.error(f"连接借出自 {pool_name} 连接池，却被 {checkout['caller']} 归还到 {db_type} 连接池")
+    hold_seconds = time.time() - checkout["checkout_time"]
+    DB_POOL_HOLD_SECONDS.labels(pool=pool_name).observe(hold_seconds)
+    DB_POOL_IN_USE.labels(pool=pool_name).dec()
+    if hold_seconds > DB_HOLD_WARN_SECONDS:
+        DB_POOL_LONG_HOLDS.labels(pool=pool_name).inc()
+        logger.warning(f"数据库连接 {pool_name} 被 {checkout['caller']} 持有 {hold_seconds:.2f}s")
+    return pool_name
+
+def get_outstanding_checkouts() -> list:
+    """
+    获取当前所有未归还的连接
+    """
+    with _checkouts_lock:
+        return [dict(checkout) for checkout in _checkouts.values()]
+
+def get_in_use_counts() -> dict:
+    """
+    获取每个连接池当前借出的连接数
+    """
+    counts = {}
+    for checkout in get_outstanding_checkouts():
+        counts[checkout["pool"]] = counts.get(checkout["pool"], 0) + 1
+    return counts
+
+def report_leaks():
+    """
+    输出持有时间超过 DB_LEAK_SECONDS 的连接，每个连接只报告一次
+    """
+    now = time.time()
+    with _checkouts_lock:
+        for checkout in _checkouts.values():
+            held = now - checkout["checkout_time"]
+            if held > DB_LEAK_SECONDS and not checkout["leak_reported"]:
+                checkout["leak_reported"] = True
+                logger.error(f"疑似数据库连接泄漏: {checkout['pool']} 连接被 {checkout['caller']} 持有 {held:.1f}s 未归还")
+
+async def watch_pool_leaks():
+    """
+    后台巡检连接泄漏
+    """
+    while True:
+        await asyncio.sleep(DB_LEAK_CHECK_INTERVAL)
+        report_leaks()
@@ -0,0 +1,31 @@
+from typing import List, Union
+import numpy as np
+from pgvector.psycopg.vector import register_vector_info
+from psycopg import AsyncConnection
+from psycopg.types import TypeInfo
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+
+async def register_vector_type(connection: AsyncConnection):
+    """
+    连接池新建连接时注册 pgvector 类型，向量参数以二进制格式发送，查询结果中的向量直接读取为 Vector
+    数据库未安装 vector 扩展时跳过
+    """
+    info = await TypeInfo.fetch(connection, "vector")
+    if info is None:
+        logger.warning("数据库未安装 pgvector 扩展，跳过 vector 类型注册")
+        return
+    register_vector_info(connection, info)
+
+def to_vector_param(embedding: Union[List[float], np.ndarray]) -> np.ndarray:
+    """
+    将向量转换为 float32 数组，作为 %b 占位符的参数以二进制格式发送给 pgvector
+    :param embedding: 向量
+    :return: float32 数组
+    """
+    return np.asarray(embedding, dtype=np.float32)
@@ -1,11 +1,16 @@
 import asyncio
-from fastapi import APIRouter, Query, HTTPException, Response, File, UploadFile
+from fastapi import APIRouter, Query, HTTPException, Response, File, UploadFile, Request
 # from fastapi.responses import StreamingResponse
 from starlette.responses import StreamingResponse
 from services.tobacco_study import get_random_question, get_law_slices_by_question_id, get_analysis_by_question_id
 from services.chat_service import chat_with_ai, chat_with_ai_analysis
 from services.chat_manage import create_chat_id, get_chat_title_list_from_db, get_chathis_by_id
 from services.voice_service import text_to_speech, speech_to_text, clone_voice
+from services.chat_utils import admission_exception
+from tools.llm_scheduler import llm_scheduler, AdmissionError
+from tools.openai_chat import select_model_name
+from tools.streaming import stop_on_disconnect
+from tools.timing import with_timing_event
 from models.question import Question
 from models.law import LawSlice
 from models.chat import ChatAnalysisRequest, ChatTrainRequest, ChatHistoryResponse
@@ -20,7 +25,7 @@ api_router = APIRouter(prefix="/api")
 @api_router.get("/randomquestion", response_model=Question)
 async def random_question():
     try:
-        return get_random_question(999999)
+        return await get_random_question(999999)
     except Exception as e:
         raise HTTPException(status_code=5000, detail=str(e))
 
@@ -28,7 +33,7 @@ async def random_question():
 @api_router.get("/query_question_by_id", response_model=Question)
 async def random_question(questionid: int = Query(..., description="题目ID")):
     try:
-        return get_random_question(questionid)
+        return await get_random_question(questionid)
     except Exception as e:
         raise HTTPException(status_code=5000, detail=str(e))
 
@@ -36,7 +41,7 @@ async def random_question(questionid: int = Query(..., description="题目ID")):
 @api_router.get("/lows", response_model=list[LawSlice])
 async def law_slices(questionid: int = Query(..., description="题目ID")):
     try:
-        return get_law_slices_by_question_id(questionid)
+        return await get_law_slices_by_question_id(questionid)
     except Exception as e:
         raise HTTPException(status_code=5000, detail=str(e))
 
@@ -46,7 +51,7 @@ async def analysis(questionid: int = Query(..., description="题目ID")):
     获取 AI 生成的法律分析内容
     """
     try:
-        return get_analysis_by_question_id(questionid)
+        return await get_analysis_by_question_id(questionid)
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -60,7 +65,7 @@ async def generate_chat_id(user_id: str = Query(..., description="用户的凭
     try:
         #TODO 需要验证用户 id
         # 生成唯一的 chat_id
-        chat_id = create_chat_id(user_id)
+        chat_id = await create_chat_id(user_id)
         return {"chat_id": chat_id}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -73,7 +78,7 @@ async def get_chat_id_title_list_by_user_id(user_id: str = Query(..., descriptio
     try:
         #TODO 需要验证用户 id
         # 生成唯一的 chat_id
-        chat_id_list = get_chat_title_list_from_db(user_id)
+        chat_id_list = await get_chat_title_list_from_db(user_id)
         return {"chat_id_list": chat_id_list}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -85,7 +90,7 @@ async def get_chat_by_id(chat_id: str = Query(..., description="对话的 chat_i
     """
     try:
         #TODO 逻辑未鉴权
-        messages = get_chathis_by_id(chat_id)
+        messages = await get_chathis_by_id(chat_id)
         # print(f"chat_id: {chat_id}, messages: {messages}")
         return {"chat_id":chat_id,"messages": messages}
     except Exception as e:
@@ -107,6 +112,8 @@ async def transcribe_audio(file: UploadFile = File(...)):
         # 返回识别结果
         return {"text": text_result}
 
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -128,29 +135,37 @@ async def clone_voice_endpoint(request: VoiceCloneRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/chat/train")
-async def chat_train(request: ChatTrainRequest):
+async def chat_train(request: ChatTrainRequest, http_request: Request):
     """
     SSE 接口，用于学习时与 AI 聊天。
     """
     try:
+        # 模型并发已满且排队已满时直接返回 429，不再开始流式响应
+        llm_scheduler.check(select_model_name(request.if_r1))
         # 返回 StreamingResponse
         return StreamingResponse(
-            content = chat_with_ai(request),
+            content = stop_on_disconnect(http_request, with_timing_event(chat_with_ai(request)), "/api/chat/train"),
             media_type="text/event-stream",
         )
+    except AdmissionError as e:
+        raise admission_exception(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_router.post("/chat/analysis")
-async def chat_analysis(request: ChatAnalysisRequest):
+async def chat_analysis(request: ChatAnalysisRequest, http_request: Request):
     """
     SSE 接口，用于分析时与 AI 聊天。
     """
     try:
+        # 模型并发已满且排队已满时直接返回 429，不再开始流式响应
+        llm_scheduler.check(select_model_name(False))
         return StreamingResponse(
-            content=chat_with_ai_analysis(request),
+            content=stop_on_disconnect(http_request, with_timing_event(chat_with_ai_analysis(request)), "/api/chat/analysis"),
             media_type="text/event-stream"
         )
+    except AdmissionError as e:
+        raise admission_exception(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -167,5 +182,7 @@ async def generate_tts(request: TTSRequest):
 
         audio_data = await text_to_speech(request.tts_text)
         return Response(content=audio_data, media_type="audio/mpeg")
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
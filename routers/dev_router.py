@@ -1,12 +1,21 @@
 from fastapi import APIRouter, HTTPException
 from tools.embedding_service import embedding_service
+from tools.vector_index import law_vector_index
+from tools.question_law_table import question_law_table
+from tools.schema_catalog import schema_catalog
+from tools.nl2sql_cache import nl2sql_cache
+from tools.hybrid_retrieval import law_bm25_index
 from tools.openai_chat import get_chat_response_stream_langchain
+from tools.llm_router import llm_router
+from tools.llm_scheduler import llm_scheduler
 from fastapi.responses import StreamingResponse
 from fastapi import HTTPException
 import json 
 import os
 
-from database.connection import get_db_connection, release_db_connection
+from database.connection import db_connection
+from database.async_connection import get_async_db_connection
+from database.vector import to_vector_param
 
 # ----------配置日志-------------
 from tools.ray_logger import LoggerHandler
@@ -22,23 +31,19 @@ async def get_chat_history():
     """
     获取聊天历史记录
     """
-    connection = None
-    cursor = None
     try:
-        # 获取数据库连接
-        connection = get_db_connection()
-        cursor = connection.cursor()
+        # 获取数据库连接，退出时关闭游标并释放连接
+        with db_connection() as connection, connection.cursor() as cursor:
+            # 执行 SQL 查询
+            sql = "SELECT * FROM tobacco.chat_history"
+            cursor.execute(sql)
 
-        # 执行 SQL 查询
-        sql = "SELECT * FROM tobacco.chat_history"
-        cursor.execute(sql)
+            # 获取查询结果
+            results = cursor.fetchall()
 
-        # 获取查询结果
-        results = cursor.fetchall()
-
-        # 将结果转换为字典列表
-        columns = [desc[0] for desc in cursor.description]  # 获取列名
-        chat_history = [dict(zip(columns, row)) for row in results]
+            # 将结果转换为字典列表
+            columns = [desc[0] for desc in cursor.description]  # 获取列名
+            chat_history = [dict(zip(columns, row)) for row in results]
 
         return {"status": "success", "data": chat_history}
 
@@ -46,31 +51,20 @@ async def get_chat_history():
         # 捕获异常并返回错误信息
         raise HTTPException(status_code=500, detail=f"查询失败: {str(e)}")
 
-    finally:
-        # 关闭游标并释放连接
-        if cursor:
-            cursor.close()
-        if connection:
-            release_db_connection(connection)
-
 @dev_router.delete("/clear_chat_history")
 async def clear_chat_history():
     """
     清空聊天历史记录
     """
-    connection = None
-    cursor = None
     try:
-        # 获取数据库连接
-        connection = get_db_connection()
-        cursor = connection.cursor()
+        # 获取数据库连接，退出时关闭游标并释放连接
+        with db_connection() as connection, connection.cursor() as cursor:
+            # 执行 SQL 查询
+            sql = "TRUNCATE TABLE tobacco.chat_history;"
+            cursor.execute(sql)
 
-        # 执行 SQL 查询
-        sql = "TRUNCATE TABLE tobacco.chat_history;"
-        cursor.execute(sql)
-
-        # 提交事务
-        connection.commit()
+            # 提交事务
+            connection.commit()
 
         return {"status": "success"}
 
@@ -78,13 +72,6 @@ async def clear_chat_history():
         # 捕获异常并返回错误信息
         raise HTTPException(status_code=500, detail=f"清空失败: {str(e)}")
 
-    finally:
-        # 关闭游标并释放连接
-        if cursor:
-            cursor.close()
-        if connection:
-            release_db_connection(connection)
-
 
 # 新增接口：获取题目信息 getQues
 @dev_router.get("/getQues")
@@ -94,26 +81,18 @@ async def get_ques(q_id: int):
     接收参数: q_id(int)
     返回相应题目信息
     """
-    connection = None
-    cursor = None
     try:
-        connection = get_db_connection("lg")
-        cursor = connection.cursor()
-        sql = "SELECT q_id, q_stem, OPTIONS, q_type, answer, ori_kg_cate, law_content, aimi_quse_5, analysis_qwen32 FROM csm.te_exam_question WHERE q_id = %s"
-        cursor.execute(sql, (q_id,))
-        row = cursor.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="Question not found")
-        columns = [desc[0] for desc in cursor.description]
-        ques = dict(zip(columns, row))
+        with db_connection("lg") as connection, connection.cursor() as cursor:
+            sql = "SELECT q_id, q_stem, OPTIONS, q_type, answer, ori_kg_cate, law_content, aimi_quse_5, analysis_qwen32 FROM csm.te_exam_question WHERE q_id = %s"
+            cursor.execute(sql, (q_id,))
+            row = cursor.fetchone()
+            if not row:
+                raise HTTPException(status_code=404, detail="Question not found")
+            columns = [desc[0] for desc in cursor.description]
+            ques = dict(zip(columns, row))
         return {"status": "success", "data": ques}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"查询失败: {str(e)}")
-    finally:
-        if cursor:
-            cursor.close()
-        if connection:
-            release_db_connection(connection,"lg")
 
 
 # 新增接口：自由问答接口 chatQusetion
@@ -128,26 +107,19 @@ async def chat_question(user_question: str):
     embedding = await embedding_service.get_embedding(user_question)
 
     # 利用向量查询知识点内容
-    connection = None
-    cursor = None
     try:
-        connection = get_db_connection("lg")
-        cursor = connection.cursor()
-        sql = "SELECT title, content, similarity FROM csm.use_vec_get_top5_medic_kgcont(%s::public.vector)"
-        cursor.execute(sql, (embedding,))
-        row = cursor.fetchone()
-        if not row:
-            raise HTTPException(status_code=404, detail="No knowledge content found")
-        columns = [desc[0] for desc in cursor.description]
-        knowledge = dict(zip(columns, row))
+        async with get_async_db_connection("lg") as connection:
+            async with connection.cursor() as cursor:
+                sql = "SELECT title, content, similarity FROM csm.use_vec_get_top5_medic_kgcont(%b::public.vector)"
+                await cursor.execute(sql, (to_vector_param(embedding),))
+                row = await cursor.fetchone()
+                if not row:
+                    raise HTTPException(status_code=404, detail="No knowledge content found")
+                columns = [desc[0] for desc in cursor.description]
+                knowledge = dict(zip(columns, row))
         return {"status": "success", "data": knowledge}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"查询知识点失败: {str(e)}")
-    finally:
-        if cursor:
-            cursor.close()
-        if connection:
-            release_db_connection(connection,"lg")
 
 # 新增接口：生成考卷 geneQusetion
 @dev_router.get("/geneQusetion")
@@ -176,14 +148,12 @@ async def generate_question_with_kb_by_ai(kb_content: str):
         embedding = await embedding_service.get_embedding(__system_prompt)
         
         # 利用向量查询知识点内容
-        connection = None
-        cursor = None
         try:
-            connection = get_db_connection("lg")
-            cursor = connection.cursor()
-            sql = "SELECT title, content, similarity FROM csm.use_vec_get_top5_medic_kgcont(%s::public.vector)"
-            cursor.execute(sql, (embedding,))
-            rows = cursor.fetchall()
+            async with get_async_db_connection("lg") as connection:
+                async with connection.cursor() as cursor:
+                    sql = "SELECT title, content, similarity FROM csm.use_vec_get_top5_medic_kgcont(%b::public.vector)"
+                    await cursor.execute(sql, (to_vector_param(embedding),))
+                    rows = await cursor.fetchall()
             if not rows:
                 raise HTTPException(status_code=404, detail="No knowledge content found")
             
@@ -202,11 +172,6 @@ async def generate_question_with_kb_by_ai(kb_content: str):
             raise HTTPException(status_code=500, detail="JSON Decode Error") from e
         except Exception as e:
             raise HTTPException(status_code=5000, detail=f"AI 模块错误，请联系管理员: {e}")
-        finally:
-            if cursor:
-                cursor.close()
-            if connection:
-                release_db_connection(connection, "lg")
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"生成考题失败: {str(e)}")
@@ -220,20 +185,17 @@ async def get_quesid(q_cate: str):
     接收参数: q_cate(string)
     返回该类别下的所有题目ID
     """
-    connection = None
-    cursor = None
     try:
-        connection = get_db_connection("lg")
-        cursor = connection.cursor()
-        sql = "SELECT q_id FROM csm.te_exam_question WHERE ori_kg_cate = %s"
-        cursor.execute(sql, (q_cate,))
-        rows = cursor.fetchall()  # 获取所有行，而不仅仅是一行
-        
-        if not rows:
-            raise HTTPException(status_code=404, detail="No questions found for this category")
-        
-        # 获取列名
-        columns = [desc[0] for desc in cursor.description]
+        with db_connection("lg") as connection, connection.cursor() as cursor:
+            sql = "SELECT q_id FROM csm.te_exam_question WHERE ori_kg_cate = %s"
+            cursor.execute(sql, (q_cate,))
+            rows = cursor.fetchall()  # 获取所有行，而不仅仅是一行
+            
+            if not rows:
+                raise HTTPException(status_code=404, detail="No questions found for this category")
+            
+            # 获取列名
+            columns = [desc[0] for desc in cursor.description]
         
         # 将每行转换为字典并添加到列表中
         questions = []
@@ -244,8 +206,99 @@ async def get_quesid(q_cate: str):
         return {"status": "success", "data": questions}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"查询失败: {str(e)}")
-    finally:
-        if cursor:
-            cursor.close()
-        if connection:
-            release_db_connection(connection, "lg")
\ No newline at end of file
+
+
+# 新增接口：重新加载内存中的法条向量索引
+@dev_router.post("/law_index/refresh")
+async def refresh_law_index():
+    """
+    从数据库重新加载法条切片向量索引（需开启 LAW_INDEX_ENABLED 才会用于检索）
+    """
+    try:
+        return {"status": "success", "data": await law_vector_index.load()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"加载法条向量索引失败: {str(e)}")
+
+
+# 新增接口：重新加载法条 BM25 索引
+@dev_router.post("/bm25_index/refresh")
+async def refresh_bm25_index():
+    """
+    从数据库重新加载法条切片并重建 BM25 索引（需开启 RAG_HYBRID_ENABLED 才会用于检索）
+    """
+    try:
+        return {"status": "success", "data": await law_bm25_index.load()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"加载法条 BM25 索引失败: {str(e)}")
+
+# 新增接口：重新预计算题目-法条检索表
+@dev_router.post("/question_law_table/refresh")
+async def refresh_question_law_table():
+    """
+    为所有题目重新计算 top-k 相关法条并写入磁盘，法条或编码模型更新后需要调用
+    """
+    try:
+        return {"status": "success", "data": await question_law_table.build()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"预计算题目法条检索表失败: {str(e)}")
+
+
+# 新增接口：重新构建数据分析用的 schema 目录
+@dev_router.post("/schema_catalog/refresh")
+async def refresh_schema_catalog():
+    """
+    重新读取业务库的表结构和样例数据、编码表和字段描述并写入磁盘，表结构变更后需要调用
+    """
+    try:
+        return {"status": "success", "data": await schema_catalog.build()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"构建 schema 目录失败: {str(e)}")
+
+
+# 新增接口：查看数据分析的查询计划缓存和结果缓存
+@dev_router.get("/nl2sql_cache")
+async def get_nl2sql_cache():
+    """
+    查看查询计划缓存和结果缓存的条目数与命中率，以及当前的 schema 版本
+    """
+    try:
+        return {"status": "success", "data": nl2sql_cache.stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"查询 NL2SQL 缓存状态失败: {str(e)}")
+
+
+# 新增接口：清空数据分析的查询计划缓存和结果缓存
+@dev_router.delete("/nl2sql_cache")
+async def clear_nl2sql_cache():
+    """
+    清空查询计划缓存和结果缓存，业务数据大量变更或提示词调整后可调用
+    """
+    try:
+        nl2sql_cache.clear()
+        return {"status": "success", "data": nl2sql_cache.stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"清空 NL2SQL 缓存失败: {str(e)}")
+
+
+# 新增接口：查看各个 LLM 上游的负载和延迟
+@dev_router.get("/llm_upstreams")
+async def get_llm_upstreams():
+    """
+    查看各个 LLM 上游的在途请求数、首 token 延迟均值、失败次数和熔断状态
+    """
+    try:
+        return {"status": "success", "data": llm_router.stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"查询 LLM 上游状态失败: {str(e)}")
+
+
+# 新增接口：查看各个模型的并发占用和排队情况
+@dev_router.get("/llm_scheduler")
+async def get_llm_scheduler():
+    """
+    查看各个模型的并发上限、按优先级的占用数和排队数
+    """
+    try:
+        return {"status": "success", "data": llm_scheduler.stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"查询 LLM 调度状态失败: {str(e)}")
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, Query, HTTPException
+from fastapi import APIRouter, Query, HTTPException, Request
 from fastapi.responses import StreamingResponse
 from models.lg_models import CaseIdResponse, CaseInfoResponse, CaseChatRequest, ForwardAiRequest, ForwardEmbedRequest, GenerateReplyRequest, GenerateExtractIssuesReplyRequest
 from services.lg_service import (
@@ -12,6 +12,11 @@ from services.lg_service import (
     )
 from tools.embedding_service import embedding_service
 from tools import openai_chat
+from tools.openai_chat import select_model_name
+from tools.streaming import stop_on_disconnect
+from tools.timing import with_timing_event
+from tools.llm_scheduler import llm_scheduler, AdmissionError, BATCH
+from services.chat_utils import admission_exception
 from typing import List
 
 # Create a new router with the /lg prefix
@@ -43,16 +48,20 @@ async def get_case_info(
         raise HTTPException(status_code=500, detail=str(e))
 
 @lg_router.post("/chat")
-async def chat_train(request: CaseChatRequest):
+async def chat_train(request: CaseChatRequest, http_request: Request):
     """
     SSE 接口，用于
     """
     try:
+        # 模型并发已满且排队已满时直接返回 429，不再开始流式响应
+        llm_scheduler.check(select_model_name(True))
         # 返回 StreamingResponse
         return StreamingResponse(
-            content = chat_with_llm(request),
+            content = stop_on_disconnect(http_request, with_timing_event(chat_with_llm(request)), "/lg/chat"),
             media_type="text/event-stream",
         )
+    except AdmissionError as e:
+        raise admission_exception(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -67,64 +76,84 @@ async def search_kb(text: str = Query(..., description="Search text")):
         raise HTTPException(status_code=500, detail=str(e))
 
 @lg_router.post("/generate_current_reply")
-async def generate_current_reply(request: GenerateReplyRequest):
+async def generate_current_reply(request: GenerateReplyRequest, http_request: Request):
     """
     SSE 接口, 生成回复
     针对当前 用户问题以及 历史对话 和 知识库内容 生成回复
     """
     try:
+        # 模型并发已满且排队已满时直接返回 429，不再开始流式响应
+        llm_scheduler.check(select_model_name(request.if_r1))
         # 返回 StreamingResponse
         return StreamingResponse(
-            content = generate_reply_by_llm(request.chat_history, request.kb_content, request.user_input, request.if_r1),
+            content = stop_on_disconnect(http_request, with_timing_event(generate_reply_by_llm(request.chat_history, request.kb_content, request.user_input, request.if_r1)), "/lg/generate_current_reply"),
             media_type="text/event-stream",
         )
+    except AdmissionError as e:
+        raise admission_exception(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 # endpoit 从聊天记录中提取用户咨询问题列表
 @lg_router.post("/extract_issues")
-async def extract_issues(request: GenerateReplyRequest):
+async def extract_issues(request: GenerateReplyRequest, http_request: Request):
     """
     从聊天记录中提取用户咨询问题列表
     """
     try:
+        # 模型并发已满且排队已满时直接返回 429，不再开始流式响应
+        llm_scheduler.check(select_model_name(request.if_r1), BATCH)
         # 返回 StreamingResponse
         return StreamingResponse(
-            content = extract_issues_from_chat(request.chat_history,request.if_r1),
+            content = stop_on_disconnect(http_request, with_timing_event(extract_issues_from_chat(request.chat_history,request.if_r1)), "/lg/extract_issues"),
             media_type="text/event-stream",
         )
+    except AdmissionError as e:
+        raise admission_exception(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # endpoit 功能要求：依据提取到的问题，参考坐席回复和知识库，生成参考答案，充实知识库。或结合问答，生成培训案例
 @lg_router.post("/generate_extract_issues_reply_by_kb")
-async def generate_extract_issues_reply_with_kb(request: GenerateExtractIssuesReplyRequest):
+async def generate_extract_issues_reply_with_kb(request: GenerateExtractIssuesReplyRequest, http_request: Request):
     """
     依据提取到的问题，参考坐席回复和知识库，生成参考答案，充实知识库。或结合问答，生成培训案例
     """
     try:
+        # 模型并发已满且排队已满时直接返回 429，不再开始流式响应
+        llm_scheduler.check(select_model_name(request.if_r1), BATCH)
         # 返回 StreamingResponse
         return StreamingResponse(
-            content = generate_extract_issues_reply_with_kb_by_ai(request.chat_history, request.issues, request.if_r1, request.kb_content),
+            content = stop_on_disconnect(http_request, with_timing_event(generate_extract_issues_reply_with_kb_by_ai(request.chat_history, request.issues, request.if_r1, request.kb_content)), "/lg/generate_extract_issues_reply_by_kb"),
             media_type="text/event-stream",
         )
+    except AdmissionError as e:
+        raise admission_exception(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
 
 @lg_router.post("/forward_ai")
-async def forward_post(request: ForwardAiRequest):
+async def forward_post(request: ForwardAiRequest, http_request: Request):
     # 转发 post 请求到 AI 服务 去掉前缀 
     try:
+        # 模型并发已满且排队已满时直接返回 429，不再开始流式响应
+        llm_scheduler.check(openai_chat.resolve_model_name(request.model_name))
         # 返回 StreamingResponse
         return StreamingResponse(
-            content = openai_chat.get_chat_response_stream_langchain(request.messages, 
-                                                                     request.system_prompt, 
-                                                                     request.model_name, 
-                                                                     request.if_r1),
+            content = stop_on_disconnect(
+                http_request,
+                with_timing_event(openai_chat.get_chat_response_stream_langchain(request.messages,
+                                                                                 request.system_prompt,
+                                                                                 request.model_name,
+                                                                                 request.if_r1)),
+                "/lg/forward_ai",
+            ),
             media_type="text/event-stream",
         )
+    except AdmissionError as e:
+        raise admission_exception(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
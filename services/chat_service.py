@@ -1,20 +1,26 @@
-import asyncio
 import os
-from fastapi import HTTPException
 import time
 
 from tools.utils import deprecated
 from tools.openai_chat import get_chat_response_stream_langchain, get_chat_response
+from tools.sse import sse_event, StreamResult
 from services.tobacco_study import get_random_question
 from tools.embedding_service import embedding_service
+from tools.question_law_table import question_law_table, build_question_query
+from tools.hybrid_retrieval import hybrid_retriever, law_bm25_index, RAG_HYBRID_ENABLED
+from tools.context_builder import build_context
+from tools.timing import span, record_span
+from tools.stage_graph import StageGraph
+from tools.chart_builder import build_chart_data, CHART_BUILDER_ENABLED
+from tools.schema_catalog import schema_catalog, SCHEMA_CATALOG_ENABLED
+from tools.nl2sql_cache import nl2sql_cache
 from models.law import LawSlice
-from database.connection import get_db_connection, release_db_connection
+from database.guarded_query import execute_guarded_query, QueryResult
 from services.chat_manage import add_message_to_chat, get_chat_history
 
-from typing import AsyncIterator, List
+from typing import AsyncIterator, List, Optional
 from models.chat import ChatTrainRequest, ChatAnalysisRequest
 
-import json
 
 
 # ----------配置日志-------------
@@ -76,13 +82,31 @@ DEFAULT_SYSTEM_PROMPT = f"""\
 async def rag_search(question: str) -> List[dict]:
     """Perform RAG search using embedding service"""
     # Get embedding for the question
-    embedding = await embedding_service.get_embedding(question)
+    with span("embedding"):
+        embedding = await embedding_service.get_embedding(question)
     # logger.debug(f"Embedding for question: {embedding}")
+    # Fuse vector and BM25 hits when hybrid retrieval is enabled and the BM25 index is loaded
+    if RAG_HYBRID_ENABLED and law_bm25_index.ready:
+        with span("hybrid_search"):
+            return await hybrid_retriever.search(question, embedding)
     # Search for similar content in database
-    results = await embedding_service.search_similar(embedding)
+    with span("vector_search"):
+        results = await embedding_service.search_similar(embedding)
     
     return results
 
+def format_rag_context(results: List[dict]) -> str:
+    """格式化RAG结果"""
+    return "\n".join(
+        f"相关文档 {i+1}:\n"
+        f"法律ID: {result['law_id']}\n"
+        f"法律名称: {result['law_name']}\n"
+        f"章节: {result['chapter']}\n"
+        f"文章内容: {result['article_content']}\n"
+        f"相似度: {result['similarity']:.2f}\n"
+        for i, result in enumerate(results)
+    )
+
 @deprecated
 def format_to_markdown(law_slices: List[LawSlice]) -> str:
     markdown_str = ""
@@ -103,16 +127,11 @@ async def optimize_query_with_llm(query: str) -> str:
 如果用户表达的意思混乱，不要进行询问。尽可能的优化成正常的问句。不要对内容进行修改。
 直接输出优化结果，不要进行询问
 """}]
-    return await get_chat_response(messages)
+    # 改写结果只取决于问题本身，可以缓存
+    return await get_chat_response(messages, use_cache=True)
 
-@deprecated
-async def select_table(query: str) -> dict:
-    """
-    根据查询选择适当的表格
-    """
-    # 这里可以根据数据库schema信息选择表格
-    # 示例实现，实际应根据具体数据库schema调整
-    return """
+# 内置的表格信息，schema 目录未构建或不可用时使用
+DEFAULT_TABLE_INFO = """
 [DB_ID] tobacco
 [Schema]
 # Table: exam_question
@@ -147,6 +166,17 @@ async def select_table(query: str) -> dict:
 ]
 """
 
+async def select_table(query: str) -> str:
+    """
+    根据查询选择适当的表格
+    优先从 schema 目录中按向量相似度挑选相关的表格，目录为空或编码失败时使用内置的表格信息
+    """
+    if SCHEMA_CATALOG_ENABLED:
+        table_info = await schema_catalog.select_tables(query)
+        if table_info:
+            return table_info
+    return DEFAULT_TABLE_INFO
+
 def generate_sql_reasoning(query: str, table_info: dict) -> AsyncIterator[str]:
     """
     生成SQL查询的推理过程
@@ -162,7 +192,7 @@ def generate_sql_reasoning(query: str, table_info: dict) -> AsyncIterator[str]:
     }]
     return get_chat_response_stream_langchain(messages)
 
-def final_output(query:str, query_result:str)-> AsyncIterator[str]:
+def final_output(query:str, query_result:str, result: Optional[StreamResult] = None)-> AsyncIterator[str]:
     """
     生成结果的回答
     """
@@ -176,7 +206,7 @@ def final_output(query:str, query_result:str)-> AsyncIterator[str]:
         如果查询结果无法推断回答用户问题，则告知。“非常抱歉，无法从已查询内容回答您的问题”
         """
     }]
-    return get_chat_response_stream_langchain(messages)
+    return get_chat_response_stream_langchain(messages, result=result)
 
 async def generate_sql(query: str, table_info: dict, reasoning: str) -> str:
     """
@@ -212,18 +242,31 @@ remember only output the sql by json.Do not explain
         "role": "user",
         "content": prompt
     }]
-    llm_response = await get_chat_response(messages, if_json=True)
+    # 生成的 SQL 此时尚未执行，不写入 LLM 响应缓存，否则执行失败的 SQL 会在缓存有效期内被反复返回；
+    # 执行成功的 SQL 由 nl2sql_cache.set_plan 缓存
+    llm_response = await get_chat_response(messages, if_json=True, use_cache=False)
     # 提取 SQL 语句
     if isinstance(llm_response, dict):
         return llm_response.get("sql") or llm_response.get("SQL") or llm_response
     return llm_response
 
-async def format_results(results: List[tuple], sql_query: str, user_query: str) -> str:
+async def execute_sql(sql_query: str) -> QueryResult:
+    """
+    在业务库上执行生成的 SQL（只读事务、语句超时、代价检查、行数上限）
+    """
+    return await execute_guarded_query(sql_query, db_type="prod")
+
+async def format_results(results: List[tuple], sql_query: str, user_query: str, columns: Optional[List[str]] = None):
     """
-    格式化SQL查询结果
+    格式化SQL查询结果为前端绘图数据
+    结构明确时（一列分类一列数值等）直接在本地聚合，无法判断时再交给 LLM
     """
     if not results:
         return "查询结果集无内容"
+    if CHART_BUILDER_ENABLED:
+        chart_data = build_chart_data(results, columns)
+        if chart_data is not None:
+            return chart_data
     
     # 构造messages，要求LLM根据SQL语句和查询结果输出前端绘图用数据
     messages = [{
@@ -252,101 +295,150 @@ SQL查询：
     }]
     
     logger.debug(messages)
-    llm_response = await get_chat_response(messages,if_json=True)
+    # 提示词中包含查询结果本身，数据变化时缓存键随之变化，可以缓存
+    llm_response = await get_chat_response(messages, if_json=True, use_cache=True)
     
     return llm_response
 
+def _stage_event(name: str, ms: float, cached: bool = False) -> str:
+    """阶段耗时进度事件，cached 表示该阶段命中缓存"""
+    data = {"stage": name, "ms": ms}
+    if cached:
+        data["cached"] = True
+    return sse_event(data, event="progress")
+
+async def _cached(value):
+    """命中缓存的阶段直接返回缓存的值"""
+    return value
+
+async def _plan_sql(optimized_query: str, table_info: str) -> str:
+    """优化后的问题命中查询计划缓存时复用其 SQL，否则生成 SQL"""
+    plan = nl2sql_cache.get_plan(optimized_query)
+    if plan is not None:
+        return plan["sql"]
+    # 推理过程仅展示给用户，SQL 生成不以其为依据，与推理过程的流式输出并发进行
+    return await generate_sql(optimized_query, table_info, "")
+
+async def _execute_sql_cached(sql_query: str) -> tuple:
+    """返回 (查询结果, 绘图数据)，结果缓存未命中时执行 SQL，绘图数据为 None"""
+    cached = nl2sql_cache.get_result(sql_query)
+    if cached is not None:
+        return cached
+    return await execute_sql(sql_query), None
+
+async def _format_executed(executed: tuple, sql_query: str, optimized_query: str):
+    query_result, chart_data = executed
+    if chart_data is not None:
+        return chart_data
+    return await format_results(query_result.rows, sql_query, optimized_query, query_result.columns)
+
 async def chat_with_ai_analysis(request: ChatAnalysisRequest) -> AsyncIterator[str]:
     """
     与 AI 进行数据分析对话，生成 SQL 并执行查询
+    各阶段按依赖关系并发执行（优化问题与选择表格同时进行，SQL 生成与执行不等待推理过程的流式输出），
+    前端仍按 step1 ~ step8 的顺序收到事件，每个阶段完成后附带一个 progress 耗时事件
+    重复的问题命中查询计划缓存时跳过问题优化、选表、推理和 SQL 生成，近期执行过的 SQL 直接复用结果和绘图数据
     :param request: 包含用户输入和数据库ID的请求
     :return: 返回查询结果的流式响应
     """
-    conn = None 
     # 预留设计
     database_id = request.database_id
     user_query = request.user_input
     chat_id = request.chat_id
-    history = get_chat_history(chat_id)
-    await add_message_to_chat(chat_id, "user", user_query)
+    plan = nl2sql_cache.get_plan(user_query)
+    graph = StageGraph()
+    if plan is None:
+        graph.add("optimize_query", optimize_query_with_llm, user_query)
+        # 表格选择只依赖用户原始问题，不必等待问题优化
+        graph.add("select_table", select_table, user_query)
+        graph.add("generate_sql", _plan_sql, deps=("optimize_query", "select_table"))
+    else:
+        graph.add("optimize_query", _cached, plan["optimized_query"])
+        graph.add("generate_sql", _cached, plan["sql"])
+    graph.add("execute_sql", _execute_sql_cached, deps=("generate_sql",))
+    graph.add("format_results", _format_executed, deps=("execute_sql", "generate_sql", "optimize_query"))
+    # 加载对话历史并保存用户问题，与其他阶段并发执行，保存结果前等待完成
+    # 历史加载到内存后才能追加用户问题，否则保存时会用只含本次问题的记录覆盖数据库中的历史
+    graph.add("history_load", get_chat_history, chat_id)
+    graph.add("save_question", add_message_to_chat, chat_id, "user", user_query, after=("history_load",))
+    plan_cached = plan is not None
     try:
         # step 1: 优化用户问题
-        yield "event:step1\ndata:优化用户的问题\n\n"
-        await asyncio.sleep(0.1)  # 异步睡眠 100 毫秒
+        yield sse_event("优化用户的问题", event="step1")
         logger.warning("1. 开始优化用户的问题")
-        optimized_query = await optimize_query_with_llm(user_query)
-        yield f"event:update\ndata:{optimized_query}\n\n"
-        await asyncio.sleep(0.1)  # 异步睡眠 100 毫秒
+        optimized_query = await graph.result("optimize_query")
+        yield sse_event(optimized_query, event="update")
+        yield _stage_event("optimize_query", graph.duration_ms("optimize_query"), plan_cached)
         # step 2: 选择表格
-        yield "event:step2\ndata:选择表格中\n\n"
-        await asyncio.sleep(0.1)  # 异步睡眠 100 毫秒
+        yield sse_event("选择表格中", event="step2")
         logger.warning("2. 选择表格，返回表格信息")
-        table_info = await select_table(optimized_query)
-        yield f"event:update\ndata:Form has been selected, form information has been prepared\n\n"
-        await asyncio.sleep(0.1)  # 异步睡眠 100 毫秒
+        if not plan_cached:
+            table_info = await graph.result("select_table")
+        yield sse_event("Form has been selected, form information has been prepared", event="update")
+        if not plan_cached:
+            yield _stage_event("select_table", graph.duration_ms("select_table"))
         # step 3: 生成SQL推理过程
-        yield "event:step3\ndata:生成 SQL 推理过程\n\n"
-        await asyncio.sleep(0.01)  # 异步睡眠 10 毫秒
+        yield sse_event("生成 SQL 推理过程", event="step3")
         logger.warning("3. 生成 SQL 推理过程解释")
-        reasoning = generate_sql_reasoning(optimized_query, table_info)
-        async for chunk in reasoning:
-            yield chunk
-        # yield f"event:update\ndata:evidence for generate: {reasoning}\n\n"
-        
+        if plan_cached:
+            yield sse_event("已命中缓存的查询计划，跳过推理过程", event="update")
+        else:
+            start_time = time.perf_counter()
+            async for chunk in generate_sql_reasoning(optimized_query, table_info):
+                yield chunk
+            reasoning_seconds = time.perf_counter() - start_time
+            record_span("sql_reasoning", reasoning_seconds)
+            yield _stage_event("sql_reasoning", round(reasoning_seconds * 1000, 2))
+
         # step 4: 生成SQL
-        yield "event:step4\ndata:生成 sql 并提取\n\n"
-        await asyncio.sleep(0.01)  # 异步睡眠 10 毫秒
+        yield sse_event("生成 sql 并提取", event="step4")
         logger.warning("4. 生成 sql 并提取")
-        sql_query = await generate_sql(optimized_query, table_info, reasoning)
-        yield f"event:update\ndata:{sql_query}\n\n"
-        await asyncio.sleep(0.01)  # 异步睡眠 10 毫秒
+        sql_query = await graph.result("generate_sql")
+        yield sse_event(sql_query, event="update")
+        yield _stage_event("generate_sql", graph.duration_ms("generate_sql"), plan_cached)
 
         # step 5: 执行SQL
-        yield "event:step5\ndata: 执行 sql\n\n"
-        await asyncio.sleep(0.01)  # 异步睡眠 10 毫秒
+        yield sse_event("执行 sql", event="step5")
         logger.warning("5. 执行 sql")
-        db_type = "prod"
-        conn = get_db_connection(db_type)
-        cursor = conn.cursor()
-        
-        cursor.execute(sql_query)
-        results = cursor.fetchall()
-        logger.debug(results)
-        yield f"event:update\ndata:SQL执行成功，获取到{len(results)}条结果\n\n"
-        await asyncio.sleep(0.01)  # 异步睡眠 10 毫秒
+        query_result, cached_chart_data = await graph.result("execute_sql")
+        result_cached = cached_chart_data is not None
+        truncated_note = f"（超过上限，仅取前{len(query_result.rows)}条）" if query_result.truncated else ""
+        yield sse_event(f"SQL执行成功，获取到{len(query_result.rows)}条结果{truncated_note}", event="update")
+        yield _stage_event("execute_sql", graph.duration_ms("execute_sql"), result_cached)
 
         # step 6: 格式化结果
-        yield "event:step6\ndata:格式化结果\n\n"
-        await asyncio.sleep(0.01)  # 异步睡眠 10 毫秒
+        yield sse_event("格式化结果", event="step6")
         logger.warning("6.格式化结果")
-        formatted_results = await format_results(results, sql_query, optimized_query)
-        yield f"event:sqldata\ndata:{formatted_results}\n\n"
-        await asyncio.sleep(0.01)  # 异步睡眠 10 毫秒
-        yield f"event:update\ndata:格式化成功\n\n"
-        await asyncio.sleep(0.01)  # 异步睡眠 10 毫秒
+        formatted_results = await graph.result("format_results")
+        yield sse_event(formatted_results, event="sqldata")
+        yield sse_event("格式化成功", event="update")
+        yield _stage_event("format_results", graph.duration_ms("format_results"), result_cached)
+        # SQL 已成功执行，记录查询计划；缓存的结果不重新写入，避免过期时间被不断延长
+        nl2sql_cache.set_plan(user_query, optimized_query, sql_query)
+        if not result_cached:
+            nl2sql_cache.set_result(sql_query, query_result, formatted_results)
 
         # step 7: 保存结果
-        yield "event:step7\ndata:保存结果\n\n"
-        await asyncio.sleep(0.01)  # 异步睡眠 10 毫秒
+        yield sse_event("保存结果", event="step7")
         logger.warning("7. 保存结果")
-        yield "event:update\ndata:结果已保存到对话历史\n\n"
-        await asyncio.sleep(0.01)  # 异步睡眠 10 毫秒
+        await graph.result("save_question")
+        yield sse_event("结果已保存到对话历史", event="update")
         # step 8: 最终输出
-        yield "event:step8\ndata:最终输出\n\n"
-        await asyncio.sleep(0.01)  # 异步睡眠 10 毫秒
+        yield sse_event("最终输出", event="step8")
         logger.warning("8. 最终输出")
-        final_output_from_llm = final_output(optimized_query, formatted_results)
+        final_result = StreamResult()
+        final_output_from_llm = final_output(optimized_query, formatted_results, result=final_result)
         async for chunk_output in final_output_from_llm:
             yield chunk_output
 
-        await add_message_to_chat(chat_id, "assistant", chunk_output)
+        await add_message_to_chat(chat_id, "assistant", final_result.content)
     except Exception as e:
         logger.error(f"SQL执行失败: {e}")
-        yield f"event:ERROR\ndata:SQL执行失败: {str(e)}\n\n"
+        yield sse_event(f"SQL执行失败: {str(e)}", event="ERROR")
     finally:
-        if conn:
-            release_db_connection(conn,db_type=db_type)
-    
+        # 出错或客户端断开时，取消仍在运行的阶段
+        await graph.cancel()
+
 async def chat_with_ai(request: ChatTrainRequest) -> AsyncIterator[str]:
     """
     与 AI 聊天，返回流式响应。
@@ -356,9 +448,14 @@ async def chat_with_ai(request: ChatTrainRequest) -> AsyncIterator[str]:
     try:
         # 获取 chat_id
         chat_id = request.chat_id
-        # 加载历史消息
-        history = get_chat_history(chat_id)
-        finally_input = request.user_input
+        # 加载历史消息（复制一份，之后写入的本轮用户消息不计入历史）
+        with span("history_load"):
+            history = list(await get_chat_history(chat_id))
+        if request.if_r1:
+            model_name = os.getenv("R1_MODEL_NAME")
+        else:
+            model_name = os.getenv("ai_chat_model")
+        logger.debug(f"user need to use model: {model_name}")
         __if_kb = False
         if request.if_kb:
             __if_kb = True
@@ -366,6 +463,11 @@ async def chat_with_ai(request: ChatTrainRequest) -> AsyncIterator[str]:
             __if_kb = True
         else:
             __if_kb = False
+
+        rag_question_low_results = []
+        # 不开启 RAG 时直接发送用户输入
+        def render_user_input(docs):
+            return request.user_input
         
         # 判断是否开启 RAG
         if __if_kb:
@@ -373,97 +475,57 @@ async def chat_with_ai(request: ChatTrainRequest) -> AsyncIterator[str]:
                 # 先获取用户当前的题目信息
                 logger.warning(f"针对用户当前的题目id: {request.question_id} 检索相关内容")
                 # 根据id 查询题目信息
-                question_option_info_full = get_random_question(request.question_id)
-                # 构建 RAG 用的 题目和选项
-                question_option = f"q:{question_option_info_full.q_stem};\noptions:{question_option_info_full.options}"
-                # 调用RAG搜索
-                rag_question_low_results = await rag_search(question_option)
-                # 格式化RAG结果
-                rag_context = "\n".join(
-                    f"相关文档 {i+1}:\n"
-                    f"法律ID: {result['law_id']}\n"
-                    f"法律名称: {result['law_name']}\n"
-                    f"章节: {result['chapter']}\n"
-                    f"文章内容: {result['article_content']}\n"
-                    f"相似度: {result['similarity']:.2f}\n"
-                    for i, result in enumerate(rag_question_low_results)
-                )
-                yield f"event:rag\n{rag_context}\n\n"
-                user_input_with_kb = f"""\
-相关文档:
-{rag_context}
-
-用户当前查看题目信息:
+                with span("question_fetch"):
+                    question_option_info_full = await get_random_question(request.question_id)
+                # 优先使用预计算的题目-法条检索表，未命中时再实时编码并检索
+                rag_question_low_results = question_law_table.get(question_option_info_full.id)
+                if rag_question_low_results is None:
+                    # 构建 RAG 用的 题目和选项
+                    question_option = build_question_query(question_option_info_full.q_stem, question_option_info_full.options)
+                    # 调用RAG搜索
+                    rag_question_low_results = await rag_search(question_option)
+                question_info = f"""\
 题目:{question_option_info_full.q_stem}\n
 类型:{question_option_info_full.q_type}\n
 选项:{question_option_info_full.options}\n
-正确答案:{question_option_info_full.answer}
-
-用户提问:
-{request.user_input}
-"""
-                finally_input = user_input_with_kb
+正确答案:{question_option_info_full.answer}"""
             except:
                 # 如果问题id出错
                 logger.warning("问题id出错，对用户输入进行 rag 搜索")
                 # 调用RAG搜索
                 rag_question_low_results = await rag_search(request.user_input)
-                # 格式化RAG结果
-                rag_context = "\n".join(
-                    f"相关文档 {i+1}:\n"
-                    f"法律ID: {result['law_id']}\n"
-                    f"法律名称: {result['law_name']}\n"
-                    f"章节: {result['chapter']}\n"
-                    f"文章内容: {result['article_content']}\n"
-                    f"相似度: {result['similarity']:.2f}\n"
-                    for i, result in enumerate(rag_question_low_results)
-                )
-                # logger.info(rag_context)
-                logger.info("返回rag结果")
-                yield f"event:rag\n{rag_context}\n\n"
-
-                user_input_with_kb = f"""
+                question_info = "无"
+
+            def render_user_input(docs):
+                return f"""\
 相关文档:
-{rag_context}
+{format_rag_context(docs)}
 
 用户当前查看题目信息:
-无
+{question_info}
 
 用户提问:
 {request.user_input}
-"""         
-                finally_input = user_input_with_kb
-          
-        await add_message_to_chat(chat_id, "user", request.user_input)
-        # 构造消息列表
-        messages = history.copy()  # 复制历史消息
-        messages.append({"role": "user", "content": finally_input})  # 添加当前用户输入
-        if request.if_r1:
-            model_name = os.getenv("R1_MODEL_NAME")
-        else:
-            model_name = os.getenv("ai_chat_model")
-        logger.debug(f"user need to use model: {model_name}")
-        async for chunk in get_chat_response_stream_langchain(messages,system_prompt=DEFAULT_SYSTEM_PROMPT,model_name=model_name):
-            yield chunk
-    
-        full_response = chunk
+"""
 
-        # 1. 找到 "data: " 的位置
-        data_start = full_response.find("data:") + len("data:")
-        # 2. 提取 data 部分
-        data_str = full_response[data_start:].strip()
-        # print(data_str)
-        # 将 data 字符串解析为 JSON 对象
-        data = json.loads(data_str)
+        # 按模型的 token 预算组装上下文：保留系统提示词和本轮提问，裁剪低相似度文档和最早的历史对话
+        messages, rag_question_low_results, _ = build_context(
+            model_name, DEFAULT_SYSTEM_PROMPT, history, rag_question_low_results, render_user_input
+        )
+        if __if_kb:
+            logger.info("返回rag结果")
+            yield sse_event(format_rag_context(rag_question_low_results), event="rag")
 
-        # 获取 content 字段
-        content = data["content"]
+        await add_message_to_chat(chat_id, "user", request.user_input)
+        # 流结束后完整回复写入 stream_result，无需再解析 Done 事件
+        stream_result = StreamResult()
+        async for chunk in get_chat_response_stream_langchain(messages,system_prompt=DEFAULT_SYSTEM_PROMPT,model_name=model_name,result=stream_result):
+            yield chunk
 
         # 保存 AI 回复到历史记录
-        await add_message_to_chat(request.chat_id, "assistant", content)
-    except json.JSONDecodeError as e:
-        logger.error("json 解析失败")
-        pass
+        await add_message_to_chat(request.chat_id, "assistant", stream_result.content)
     except Exception as e:
-        raise HTTPException(status_code=5000, detail=f"AI 模块错误，请联系管理员: {str(e)}")
+        # 响应已经开始流式输出，无法再返回错误状态码，以 ERROR 事件告知前端
+        logger.error(f"AI 模块错误: {e}")
+        yield sse_event(f"AI 模块错误，请联系管理员: {str(e)}", event="ERROR")
 
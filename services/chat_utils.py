@@ -1,5 +1,11 @@
 from typing import List, Dict
+from fastapi import HTTPException
 from tools.openai_chat import get_chat_response
+from tools.llm_scheduler import AdmissionError
+
+def admission_exception(e: AdmissionError) -> HTTPException:
+    """模型并发已满（429）或排队超时（503）时直接返回错误，并告知客户端多久后重试"""
+    return HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(int(e.retry_after) + 1)})
 
 async def generate_title(messages: List[dict]) -> str:
     """
@@ -21,4 +27,5 @@ Artificial Intelligence in Healthcare
 Prompt: {messages}
         """
     }]
-    return await get_chat_response(messages_payload)
\ No newline at end of file
+    # 标题只取决于对话内容，可以缓存
+    return await get_chat_response(messages_payload, use_cache=True)
\ No newline at end of file
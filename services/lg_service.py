@@ -6,9 +6,11 @@ from fastapi import HTTPException
 from models.lg_models import (CaseChatRequest,  
                               CaseInfoResponse,  
                               )
-from database.connection import get_db_connection, release_db_connection
+from database.async_connection import get_async_db_connection
 from tools.embedding_service import embedding_service
 from tools.openai_chat import get_chat_response_stream_langchain
+from tools.llm_scheduler import BATCH
+from tools.sse import sse_event
 
 # ----------配置日志-------------
 from tools.ray_logger import LoggerHandler
@@ -63,14 +65,13 @@ async def chat_with_llm(request: CaseChatRequest) -> AsyncIterator[str]:
         logger.error("json 解析失败")
         pass
     except Exception as e:
-        raise HTTPException(status_code=5000, detail=f"AI 模块错误，请联系管理员: {e}")
+        # 响应已经开始流式输出，无法再返回错误状态码，以 ERROR 事件告知前端
+        logger.error(f"AI 模块错误: {e}")
+        yield sse_event(f"AI 模块错误，请联系管理员: {str(e)}", event="ERROR")
 
 async def get_case_ids_from_db(creatby: str, createtime_start: str, createtime_end: str) -> List[str]:
-    connection = None
     try:
-        connection = get_db_connection(db_type="lg")
-        with connection.cursor() as cursor:
-            sql = f"""
+        sql = f"""
                 SELECT 
                     c.caseid
                 FROM 
@@ -80,23 +81,19 @@ async def get_case_ids_from_db(creatby: str, createtime_start: str, createtime_e
                     AND c.createtime >= '{createtime_start} 01:00:01.100'
                     AND c.createtime <= '{createtime_end} 23:59:59.100'
                 """
-            cursor.execute(sql)
-            results = cursor.fetchall()
-            return [{"caseid": result[0]} for result in results]
+        async with get_async_db_connection(db_type="lg") as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(sql)
+                results = await cursor.fetchall()
+        return [{"caseid": result[0]} for result in results]
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if connection:
-            release_db_connection(connection, db_type="lg")
 
 async def get_case_info_from_db(
     creatby: str, createtime_start: str, createtime_end: str, caseid: str
 ) -> CaseInfoResponse:
-    connection = None
     try:
-        connection = get_db_connection(db_type="lg")
-        with connection.cursor() as cursor:
-            sql = f"""
+        sql = f"""
 SELECT
 	c.caseid,
     c.problemdescription,   
@@ -134,32 +131,31 @@ WHERE
     AND c.createtime BETWEEN '{createtime_start} 01:00:01.100' AND '{createtime_end} 23:59:59.100'
     AND c.caseid = '{caseid}';
                 """
-            cursor.execute(sql)
-            result = cursor.fetchone()
-            # print(result)
-            if result:
-                return CaseInfoResponse(
-                    caseid=result[0],
-                    problemdescription=result[1],
-                    problemreply=result[2],
-                    think=result[3],
-                    ai_comment=result[4],
-                    transcription=result[5],
-                    score=result[6],
-                    fit=result[7],
-                    callee=result[8],
-                    caller=result[9],
-                    calltime=result[10],
-                    kb_content=result[11],
-                )
-            else:
-                raise HTTPException(status_code=404, detail="Case not found")
+        async with get_async_db_connection(db_type="lg") as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(sql)
+                result = await cursor.fetchone()
+        # print(result)
+        if result:
+            return CaseInfoResponse(
+                caseid=result[0],
+                problemdescription=result[1],
+                problemreply=result[2],
+                think=result[3],
+                ai_comment=result[4],
+                transcription=result[5],
+                score=result[6],
+                fit=result[7],
+                callee=result[8],
+                caller=result[9],
+                calltime=result[10],
+                kb_content=result[11],
+            )
+        else:
+            raise HTTPException(status_code=404, detail="Case not found")
     except Exception as e:
         logger.error(f"查询数据库失败: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if connection:
-            release_db_connection(connection, db_type="lg")
 
 async def get_kb_from_db(text: str) -> Optional[str]:
     """Perform RAG search using embedding service"""
@@ -203,7 +199,9 @@ async def generate_reply_by_llm(kb_content: List[dict], chat_history: List[dict]
             yield chunk
 
     except Exception as e:
-        raise HTTPException(status_code=5000, detail=f"AI 模块错误，请联系管理员: {str(e)}")
+        # 响应已经开始流式输出，无法再返回错误状态码，以 ERROR 事件告知前端
+        logger.error(f"AI 模块错误: {e}")
+        yield sse_event(f"AI 模块错误，请联系管理员: {str(e)}", event="ERROR")
     
 async def extract_issues_from_chat(chat_history: List[dict], __if_r1: bool) -> AsyncIterator[str]:
     """
@@ -251,11 +249,14 @@ async def extract_issues_from_chat(chat_history: List[dict], __if_r1: bool) -> A
             __model_name = os.getenv("ai_chat_model")
         logger.debug(f"user need to use model: {__model_name}")
 
-        async for chunk in get_chat_response_stream_langchain(messages, model_name=__model_name, system_prompt=__system_prompt,if_r1=__if_r1):
+        # 批量整理类任务，按 batch 优先级调度，不挤占在线对话的并发名额
+        async for chunk in get_chat_response_stream_langchain(messages, model_name=__model_name, system_prompt=__system_prompt,if_r1=__if_r1,priority=BATCH):
             yield chunk
 
     except Exception as e:
-        raise HTTPException(status_code=5000, detail=f"AI 模块错误，请联系管理员: {str(e)}")
+        # 响应已经开始流式输出，无法再返回错误状态码，以 ERROR 事件告知前端
+        logger.error(f"AI 模块错误: {e}")
+        yield sse_event(f"AI 模块错误，请联系管理员: {str(e)}", event="ERROR")
 
 async def generate_extract_issues_reply_with_kb_by_ai(chat_history: List[dict], issues: List[str], __if_r1: bool, kb_content:str) -> AsyncIterator[str]:
     """
@@ -314,11 +315,14 @@ async def generate_extract_issues_reply_with_kb_by_ai(chat_history: List[dict],
             __model_name = os.getenv("ai_chat_model")
         logger.debug(f"user need to use model: {__model_name}")
 
-        async for chunk in get_chat_response_stream_langchain(messages, model_name=__model_name, system_prompt=__system_prompt,if_r1=__if_r1):
+        # 批量整理类任务，按 batch 优先级调度，不挤占在线对话的并发名额
+        async for chunk in get_chat_response_stream_langchain(messages, model_name=__model_name, system_prompt=__system_prompt,if_r1=__if_r1,priority=BATCH):
             yield chunk
 
     except Exception as e:
-        raise HTTPException(status_code=5000, detail=f"AI 模块错误，请联系管理员: {str(e)}")
+        # 响应已经开始流式输出，无法再返回错误状态码，以 ERROR 事件告知前端
+        logger.error(f"AI 模块错误: {e}")
+        yield sse_event(f"AI 模块错误，请联系管理员: {str(e)}", event="ERROR")
 
 
 import asyncio
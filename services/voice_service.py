@@ -2,8 +2,25 @@ import requests
 from models.common import VoiceCloneRequest
 from fastapi import HTTPException
 import os
+import asyncio
 import aiohttp
+import openai
 from openai import AsyncOpenAI
+from tools.resilience import RetryPolicy, RetryableStatusError, CircuitOpenError, get_circuit_breaker
+
+# TTS / ASR 重试策略：指数退避加随机抖动，仅对网络错误和服务端错误重试
+TTS_RETRY_POLICY = RetryPolicy(
+    max_attempts=3,
+    retry_on=(openai.APIConnectionError, openai.InternalServerError, openai.RateLimitError),
+)
+ASR_RETRY_POLICY = RetryPolicy(
+    max_attempts=3,
+    retry_on=(aiohttp.ClientError, asyncio.TimeoutError, RetryableStatusError),
+)
+
+def circuit_open_exception(e: CircuitOpenError) -> HTTPException:
+    """熔断打开时直接返回 503，并告知客户端多久后重试"""
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after) + 1)})
 
 async def text_to_speech(tts_text: str) -> bytes:
     """
@@ -11,19 +28,43 @@ async def text_to_speech(tts_text: str) -> bytes:
     :param text: 要转换的文本内容
     :return: 音频文件的二进制数据
     """
+    tts_url = os.getenv("TTS_URL")
     try:
-        client = AsyncOpenAI(base_url=os.getenv("TTS_URL"),api_key=os.getenv("TTS_API_KEY"))
+        # 重试由 TTS_RETRY_POLICY 负责，关闭客户端自带的重试
+        client = AsyncOpenAI(base_url=tts_url,api_key=os.getenv("TTS_API_KEY"),max_retries=0)
         
-        response = await client.audio.speech.create(
+        response = await TTS_RETRY_POLICY.call(
+            client.audio.speech.create,
             model="tts-1",
             voice="zh-CN-XiaoxiaoNeural",
-            input=tts_text
+            input=tts_text,
+            breaker=get_circuit_breaker(f"tts:{tts_url}"),
         )
         
         return response.content
+    except CircuitOpenError as e:
+        raise circuit_open_exception(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"TTS service error: {str(e)}")
 
+async def _post_asr(url: str, headers: dict, file_content: bytes, filename: str) -> str:
+    """
+    发起一次 ASR 请求（每次重试都需要重新构建 multipart/form-data 请求体）
+    """
+    data = aiohttp.FormData()
+    data.add_field('file', file_content, filename=filename, content_type='audio/wav')
+    data.add_field('model', os.getenv("asr_model"))
+
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, headers=headers, data=data) as response:
+            if response.status == 200:
+                result = await response.json()
+                return result.get("text", "")
+            error_detail = await response.text()
+            if response.status >= 500 or response.status == 429:
+                raise RetryableStatusError(response.status, error_detail)
+            raise HTTPException(status_code=response.status, detail=f"API 请求失败: {error_detail}")
+
 async def speech_to_text(file_content: bytes, filename: str) -> str:
     # print("1. 开始调用 speech_to_text 函数")
     # print(f"2. 文件名: {filename}, 文件大小: {len(file_content)} 字节")
@@ -34,42 +75,25 @@ async def speech_to_text(file_content: bytes, filename: str) -> str:
         "Authorization": "Bearer "+key,
     }
 
-    # print("3. 构建 multipart/form-data 请求体")
-    data = aiohttp.FormData()
-    data.add_field('file', file_content, filename=filename, content_type='audio/wav')
-    data.add_field('model', os.getenv("asr_model"))
+    try:
+        return await ASR_RETRY_POLICY.call(
+            _post_asr, url, headers, file_content, filename,
+            breaker=get_circuit_breaker(f"asr:{url}"),
+        )
 
-    # print("4. 准备发起 API 请求")
-    # print(f"5. 请求 URL: {url}")
-    # print(f"6. 请求头: {headers}")
-    # print(f"7. 请求体: {data}")
+    except CircuitOpenError as e:
+        raise circuit_open_exception(e)
 
-    try:
-        # print("8. 创建 aiohttp.ClientSession")
-        async with aiohttp.ClientSession() as session:
-            # print("9. 发起 POST 请求")
-            async with session.post(url, headers=headers, data=data) as response:
-                # print(f"10. 请求完成，状态码: {response.status}")
-
-                if response.status == 200:
-                    # print("11. 请求成功，解析响应")
-                    result = await response.json()
-                    # print(f"12. 响应内容: {result}")
-                    return result.get("text", "")
-                else:
-                    # print("13. 请求失败，打印错误信息")
-                    error_detail = await response.text()
-                    # print(f"14. 错误详情: {error_detail}")
-                    raise HTTPException(status_code=response.status, detail=f"API 请求失败: {error_detail}")
-
-    except aiohttp.ClientError as e:
-        # print("15. 捕获到 aiohttp.ClientError 异常")
-        # print(f"16. 异常详情: {str(e)}")
+    except HTTPException:
+        raise
+
+    except RetryableStatusError as e:
+        raise HTTPException(status_code=e.status, detail=f"API 请求失败: {e.detail}")
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         raise HTTPException(status_code=500, detail=f"网络请求失败: {str(e)}")
 
     except Exception as e:
-        # print("17. 捕获到未知异常")
-        # print(f"18. 异常详情: {str(e)}")
         raise HTTPException(status_code=500, detail=f"未知错误: {str(e)}")
 
 async def clone_voice(request: VoiceCloneRequest) -> bytes:
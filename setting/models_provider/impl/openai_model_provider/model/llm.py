@@ -5,7 +5,7 @@ from langchain_core.messages import BaseMessage, get_buffer_string
 from langchain_core.runnables import RunnableConfig
 from langchain_openai.chat_models import ChatOpenAI
 
-from common.config.tokenizer_manage_config import TokenizerManage
+from common.config.tokenizer_manage_config.TokenizerManage import TokenizerManage
 from setting.models_provider.base_model_provider import MCBotBaseModel
 
 def custom_get_token_ids(text: str):
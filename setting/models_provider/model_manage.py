@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+from typing import Dict, Optional, Type
+
+import httpx
+
+from setting.models_provider.base_model_provider import MCBotBaseModel
+
+# Shared connection pool for every LLM client
+LLM_POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "100"))
+LLM_POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "20"))
+LLM_POOL_KEEPALIVE_EXPIRY = float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "60"))
+
+
+class ModelManage:
+    """
+    Registry of chat model clients.
+
+    Instances are keyed by model class, model name, base URL, API key and
+    parameters and reused across calls; classes whose is_cache_model() returns
+    False get a fresh instance each time. Every instance shares one
+    httpx.AsyncClient, so requests reuse pooled keep-alive connections instead
+    of opening a new TLS connection per call.
+    """
+    cache_model: Dict[str, object] = {}
+    http_async_client: Optional[httpx.AsyncClient] = None
+
+    @staticmethod
+    def get_http_async_client() -> httpx.AsyncClient:
+        if ModelManage.http_async_client is None or ModelManage.http_async_client.is_closed:
+            ModelManage.http_async_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=LLM_POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=LLM_POOL_KEEPALIVE_EXPIRY,
+                ),
+            )
+        return ModelManage.http_async_client
+
+    @staticmethod
+    def cache_key(model_class: Type, model_name: str, base_url: str, api_key: str, **params) -> str:
+        api_key_hash = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+        return json.dumps(
+            [f"{model_class.__module__}.{model_class.__qualname__}", model_name, base_url, api_key_hash, params],
+            sort_keys=True,
+            default=str,
+        )
+
+    @staticmethod
+    def is_cache_model(model_class: Type) -> bool:
+        """Classes from setting.models_provider decide for themselves; plain LangChain classes are cached."""
+        if issubclass(model_class, MCBotBaseModel):
+            return model_class.is_cache_model()
+        return True
+
+    @staticmethod
+    def get_model(model_class: Type, model_name: str, base_url: str, api_key: str,
+                  base_url_param: str = "base_url", **params):
+        """
+        Return a chat model client for this configuration.
+        :param base_url_param: keyword the class takes the base URL as (ChatDeepSeek uses api_base)
+        """
+        key = ModelManage.cache_key(model_class, model_name, base_url, api_key, **params)
+        model = ModelManage.cache_model.get(key)
+        if model is not None:
+            return model
+        http_async_client = ModelManage.get_http_async_client()
+        if issubclass(model_class, MCBotBaseModel):
+            model = model_class.new_instance("LLM", model_name, {"api_base": base_url, "api_key": api_key},
+                                             http_async_client=http_async_client, **params)
+        else:
+            model = model_class(
+                model=model_name,
+                api_key=api_key,
+                http_async_client=http_async_client,
+                **{base_url_param: base_url},
+                **params,
+            )
+        if ModelManage.is_cache_model(model_class):
+            ModelManage.cache_model[key] = model
+        return model
+
+    @staticmethod
+    async def close():
+        """Drop cached clients and close the shared connection pool."""
+        ModelManage.cache_model.clear()
+        if ModelManage.http_async_client is not None:
+            await ModelManage.http_async_client.aclose()
+            ModelManage.http_async_client = None
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.chat import ChatAnalysisRequest
+from services import chat_service
+from database.guarded_query import QueryResult
+from tools.sse import sse_event
+
+# Run chat_with_ai_analysis with every LLM and DB step replaced by a fixed
+# delay. Optimizing the question and selecting the table should overlap, and
+# SQL generation and execution should overlap the reasoning stream; the step
+# events must still arrive in order, each stage followed by a progress event,
+# and the chat history must be loaded before the question is saved.
+# Asking again should be served from the plan and result caches.
+# Usage: python tests/analysis_pipeline_offline.py
+DELAY = 0.2
+
+
+async def slow(value, delay: float = DELAY):
+    await asyncio.sleep(delay)
+    return value
+
+
+async def fake_reasoning(query, table_info):
+    for token in ("先", "按", "周", "统计"):
+        await asyncio.sleep(DELAY / 4)
+        yield sse_event(token, event="update")
+
+
+async def fake_final_output(query, query_result, result=None):
+    await asyncio.sleep(DELAY)
+    result.content = "共 3 场考试"
+    yield sse_event(result.content, event="update")
+
+
+CALLS = []
+
+
+async def fake_get_chat_history(chat_id):
+    await asyncio.sleep(DELAY / 2)
+    CALLS.append("history_load")
+    return []
+
+
+async def fake_add_message_to_chat(chat_id, role, content):
+    CALLS.append(role)
+
+
+def patch():
+    chat_service.optimize_query_with_llm = lambda query: slow(query + "?")
+    chat_service.select_table = lambda query: slow("[Schema]")
+    chat_service.generate_sql = lambda query, table_info, reasoning: slow("SELECT 1")
+    chat_service.execute_sql = lambda sql_query: slow(QueryResult(rows=[(1,), (2,), (3,)], columns=["n"]))
+    chat_service.format_results = lambda results, sql_query, user_query, columns=None: slow('{"categories":[],"values":[]}')
+    chat_service.generate_sql_reasoning = fake_reasoning
+    chat_service.final_output = fake_final_output
+    chat_service.get_chat_history = fake_get_chat_history
+    chat_service.add_message_to_chat = fake_add_message_to_chat
+
+
+async def test():
+    patch()
+    request = ChatAnalysisRequest(user_input="第一周考了几场", chat_id="c1", database_id="tobacco")
+    start_time = time.perf_counter()
+    events = [event async for event in chat_service.chat_with_ai_analysis(request)]
+    elapsed = time.perf_counter() - start_time
+    names = [event.split("\n", 1)[0][len("event:"):] for event in events]
+    steps = [name for name in names if name.startswith("step")]
+    progress = [event.split("data:", 1)[1].strip() for event in events if event.startswith("event:progress")]
+    print(f"{len(events)} events in {elapsed:.2f}s (one after another: {7 * DELAY:.2f}s)")
+    print("steps:", steps)
+    print("progress:", progress)
+    assert steps == [f"step{i}" for i in range(1, 9)], "step events out of order"
+    assert "ERROR" not in names
+    assert elapsed < 6 * DELAY, "stages did not overlap"
+    # The history is in memory before the question is appended, which happens before the answer
+    assert CALLS == ["history_load", "user", "assistant"], CALLS
+
+    # The same question again skips straight to the final answer
+    repeated = ChatAnalysisRequest(user_input="第一周考了几场？", chat_id="c1", database_id="tobacco")
+    start_time = time.perf_counter()
+    events = [event async for event in chat_service.chat_with_ai_analysis(repeated)]
+    elapsed = time.perf_counter() - start_time
+    steps = [event.split("\n", 1)[0] for event in events if event.startswith("event:step")]
+    cached = [event.split("data:", 1)[1].strip() for event in events if '"cached": true' in event]
+    print(f"repeated question: {len(events)} events in {elapsed:.2f}s, cached stages: {cached}")
+    print(chat_service.nl2sql_cache.stats())
+    assert len(steps) == 8 and len(cached) == 4
+    assert elapsed < 2 * DELAY, "repeated question was not served from the caches"
+
+    # A failing stage ends the stream with an ERROR event and cancels the rest
+    chat_service.nl2sql_cache.clear()
+    async def broken(sql_query):
+        raise RuntimeError("relation does not exist")
+    chat_service.execute_sql = broken
+    events = [event async for event in chat_service.chat_with_ai_analysis(request)]
+    print("on failure:", events[-1].strip().replace("\n", " "))
+    assert events[-1].startswith("event:ERROR")
+
+
+if __name__ == "__main__":
+    asyncio.run(test())
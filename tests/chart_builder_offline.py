@@ -0,0 +1,52 @@
+import datetime
+import os
+import sys
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.chart_builder import build_chart_data, NULL_CATEGORY
+
+# Shapes of SQL results that build_chart_data turns into bar chart data
+# locally, and the ambiguous ones it must leave to the LLM (None).
+# Usage: python tests/chart_builder_offline.py
+
+
+def check(name: str, rows, columns, expected):
+    chart = build_chart_data(rows, columns)
+    print(f"{name:>28}: {chart}")
+    assert chart == expected, f"{name}: expected {expected}, got {chart}"
+
+
+def test():
+    # Category and numeric column: repeated categories are summed, in the order they first appear
+    check("category + numeric",
+          [("第三周", 2), ("第一周", Decimal("1.5")), ("第三周", 3), (None, 1), ("第一周", Decimal("0.5"))],
+          ["week_name", "score"],
+          {"categories": ["第三周", "第一周", NULL_CATEGORY], "values": [5, 2, 1]})
+    check("dates + fractional values",
+          [(datetime.date(2024, 3, 2), 1.25), (datetime.date(2024, 3, 1), 2)],
+          ["day", "avg_score"],
+          {"categories": ["2024-03-02", "2024-03-01"], "values": [1.25, 2]})
+
+    # One row of numbers: one bar per column, named after the column
+    check("single numeric row",
+          [(12, Decimal("87.50"), None)],
+          ["exam_count", "avg_score", "max_score"],
+          {"categories": ["exam_count", "avg_score"], "values": [12, 87.5]})
+
+    # Only a category column: rows are counted per category
+    check("category counts",
+          [("通过",), ("未通过",), ("通过",), ("通过",)],
+          ["status"],
+          {"categories": ["通过", "未通过"], "values": [3, 1]})
+
+    # Ambiguous shapes are left to the LLM
+    check("week, count (two numeric)", [(1, 3), (2, 5), (3, 4)], ["week", "count"], None)
+    check("distinct categories only", [("张三",), ("李四",)], ["name"], None)
+    check("two category columns", [("张三", "一组", 3)], ["name", "group", "score"], None)
+    check("empty result", [], ["week", "count"], {"categories": [], "values": []})
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp
+import uvicorn
+from fastapi import FastAPI
+from tests.fake_llm_server import start_server
+from tools import openai_chat
+from tools.llm_router import LLMRouter, Upstream
+from tools.streaming import STREAM_DISCONNECTS
+from routers.lg_router import lg_router
+from routers.api_router import api_router
+from services import chat_service
+
+# Serve /lg/forward_ai and /api/chat/train with uvicorn in front of a slow
+# fake SSE upstream and drop the client connection, once mid-stream and once
+# before the first token. The upstream request should end within a poll
+# interval or two instead of running to completion, the concurrency slot
+# should be free and the cancelled stream should be counted.
+# Runs with ASGI spec 2.3 (Starlette listens for the disconnect itself) and
+# 2.4 (only a failed write would notice it, so stop_on_disconnect has to).
+# Usage: python tests/disconnect_offline.py
+MODEL = "fake-model"
+TOKENS = 200
+os.environ["ai_chat_model"] = MODEL
+FORWARD_AI = ("/lg/forward_ai", {"messages": [{"role": "user", "content": "q"}], "model_name": MODEL, "if_r1": False})
+CHAT_TRAIN = ("/api/chat/train", {"user_input": "q", "chat_id": "c1", "if_r1": False, "if_user_kb": False})
+
+
+def metric(counter, **labels) -> float:
+    return counter.labels(**labels)._value.get()
+
+
+async def noop(*args):
+    return []
+
+
+async def wait_idle(upstream_app, timeout: float = 3.0) -> float:
+    start_time = time.perf_counter()
+    while upstream_app["stats"]["in_flight"] and time.perf_counter() - start_time < timeout:
+        await asyncio.sleep(0.05)
+    return time.perf_counter() - start_time
+
+
+async def run_case(title: str, base_url: str, upstream_app, read_events: int, wait: float = 0.0,
+                   route: tuple = FORWARD_AI, spec_version: str = "2.4"):
+    path, payload = route
+    cancelled = metric(openai_chat.LLM_STREAMS_CANCELLED, model=MODEL)
+    disconnects = metric(STREAM_DISCONNECTS, route=path)
+    tokens_before = upstream_app["stats"]["tokens_sent"]
+    async with aiohttp.ClientSession() as session:
+        response = await session.post(f"{base_url}{path}", json=payload)
+        events = 0
+        while events < read_events:
+            line = await response.content.readline()
+            assert line, f"stream ended after {events} events"
+            if line.startswith(b"event:"):
+                events += 1
+        await asyncio.sleep(wait)
+        response.close()
+    idle_after = await wait_idle(upstream_app)
+    stats = upstream_app["stats"]
+    tokens_sent = stats["tokens_sent"] - tokens_before
+    print(f"{title}: upstream idle {idle_after:.2f}s after disconnect, "
+          f"{tokens_sent}/{TOKENS} tokens generated, in flight {stats['in_flight']}")
+    assert stats["in_flight"] == 0, "upstream request still running after the client left"
+    assert tokens_sent < TOKENS, "upstream generated the whole response"
+    assert not any(openai_chat.llm_scheduler.stats().get(MODEL, {}).get("active", {}).values()), "slot not released"
+    assert metric(openai_chat.LLM_STREAMS_CANCELLED, model=MODEL) == cancelled + 1, "cancelled stream not counted"
+    # Under 2.3 Starlette cancels the response itself, so only 2.4 goes through stop_on_disconnect's own path
+    if spec_version == "2.4":
+        assert metric(STREAM_DISCONNECTS, route=path) == disconnects + 1, "disconnect not counted"
+
+
+def with_spec_version(app, spec_version: str):
+    async def asgi(scope, receive, send):
+        if scope["type"] == "http":
+            scope = {**scope, "asgi": {**scope.get("asgi", {}), "spec_version": spec_version}}
+        await app(scope, receive, send)
+    return asgi
+
+
+async def test(spec_version: str):
+    app = FastAPI()
+    app.include_router(lg_router)
+    app.include_router(api_router)
+    # No chat history database offline
+    chat_service.get_chat_history = noop
+    chat_service.add_message_to_chat = noop
+    config = uvicorn.Config(with_spec_version(app, spec_version), host="127.0.0.1", port=0, log_level="warning")
+    server = uvicorn.Server(config)
+    serve = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    base_url = f"http://127.0.0.1:{server.servers[0].sockets[0].getsockname()[1]}"
+    try:
+        runner, upstream_url, upstream_app = await start_server("slow", ttft=0.1, token_delay=0.05, tokens=TOKENS)
+        openai_chat.llm_router = LLMRouter([Upstream("slow", upstream_url, "key")])
+        try:
+            await run_case(f"ASGI {spec_version} mid-stream", base_url, upstream_app, read_events=5,
+                           spec_version=spec_version)
+            await run_case(f"ASGI {spec_version} /api/chat/train mid-stream", base_url, upstream_app, read_events=5,
+                           route=CHAT_TRAIN, spec_version=spec_version)
+        finally:
+            await runner.cleanup()
+
+        runner, upstream_url, upstream_app = await start_server("stalled", ttft=10, tokens=TOKENS)
+        openai_chat.llm_router = LLMRouter([Upstream("stalled", upstream_url, "key")])
+        try:
+            await run_case(f"ASGI {spec_version} before first token", base_url, upstream_app, read_events=0, wait=0.3,
+                           spec_version=spec_version)
+        finally:
+            await runner.cleanup()
+    finally:
+        server.should_exit = True
+        await serve
+
+
+if __name__ == "__main__":
+    for spec_version in ("2.3", "2.4"):
+        asyncio.run(test(spec_version))
@@ -0,0 +1,47 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.fake_embedding_server import start_server, fake_vector
+from tools.embedding_service import EmbeddingService
+
+# Fire CONCURRENCY embedding requests at the local stand-in server, first one
+# HTTP request per text, then micro-batched, and compare throughput.
+CONCURRENCY = 200
+
+
+async def run(service: EmbeddingService, texts: list) -> float:
+    start_time = time.time()
+    vectors = await asyncio.gather(*(service.get_embedding(text) for text in texts))
+    elapsed = time.time() - start_time
+    for text, vector in zip(texts, vectors):
+        assert abs(vector[0] - fake_vector(text)[0]) < 1e-6, "vector returned to the wrong caller"
+    await service.close()
+    return elapsed
+
+
+async def test():
+    runner, base_url, app = await start_server()
+    texts = [f"q:题目{i};options:A|B|C|D" for i in range(CONCURRENCY)]
+    try:
+        os.environ["EMBEDDING_SERVICE_URL"] = f"{base_url}/getBGEencodeByText"
+        os.environ.pop("EMBEDDING_BATCH_SERVICE_URL", None)
+        single = await run(EmbeddingService(), texts)
+        single_requests = app["stats"]["requests"]
+
+        app["stats"]["requests"] = 0
+        os.environ["EMBEDDING_BATCH_SERVICE_URL"] = f"{base_url}/getBGEencodeByTexts"
+        batched = await run(EmbeddingService(), texts)
+        batched_requests = app["stats"]["requests"]
+    finally:
+        await runner.cleanup()
+
+    print(f"single : {single_requests} requests, {CONCURRENCY / single:.0f} texts/s")
+    print(f"batched: {batched_requests} requests, {CONCURRENCY / batched:.0f} texts/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(test())
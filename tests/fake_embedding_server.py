@@ -0,0 +1,56 @@
+import asyncio
+import hashlib
+import numpy as np
+from aiohttp import web
+
+# Local stand-in for the BGE embedding service, for offline testing.
+# /getBGEencodeByText   {"msg": "..."}         -> {"sentence": [...]}
+# /getBGEencodeByTexts  {"msgs": ["...", ...]} -> {"sentences": [[...], ...]}
+# Vectors are deterministic per text; every request sleeps LATENCY seconds.
+
+DIM = 1024
+LATENCY = 0.05
+
+
+def fake_vector(text: str) -> list:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:4], "little")
+    vector = np.random.default_rng(seed).standard_normal(DIM).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def create_app(latency: float = LATENCY) -> web.Application:
+    app = web.Application()
+    stats = app["stats"] = {"requests": 0, "texts": 0}
+
+    async def encode(request):
+        body = await request.json()
+        stats["requests"] += 1
+        stats["texts"] += 1
+        await asyncio.sleep(latency)
+        return web.json_response({"sentence": fake_vector(body["msg"])})
+
+    async def encode_batch(request):
+        body = await request.json()
+        stats["requests"] += 1
+        stats["texts"] += len(body["msgs"])
+        await asyncio.sleep(latency)
+        return web.json_response({"sentences": [fake_vector(text) for text in body["msgs"]]})
+
+    app.router.add_post("/getBGEencodeByText", encode)
+    app.router.add_post("/getBGEencodeByTexts", encode_batch)
+    return app
+
+
+async def start_server(host: str = "127.0.0.1", port: int = 0, latency: float = LATENCY):
+    """Start the server in the running loop; returns (runner, base_url, app)."""
+    app = create_app(latency)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://{host}:{port}", app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host="127.0.0.1", port=8989)
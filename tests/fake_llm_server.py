@@ -0,0 +1,76 @@
+import asyncio
+import json
+import time
+from aiohttp import web
+
+# Local stand-in for an OpenAI-compatible chat completion server, for offline testing.
+# POST /v1/chat/completions  streams `tokens` chunks (TOKENS by default) as SSE when "stream" is set,
+# otherwise returns one completion. The first chunk waits TTFT seconds, later
+# ones TOKEN_DELAY seconds; set app["control"]["fail"] to answer every request with a 503.
+
+TOKENS = 20
+TTFT = 0.05
+TOKEN_DELAY = 0.005
+
+
+def create_app(name: str = "fake", ttft: float = TTFT, token_delay: float = TOKEN_DELAY,
+               tokens: int = TOKENS) -> web.Application:
+    app = web.Application()
+    control = app["control"] = {"fail": False}
+    stats = app["stats"] = {"requests": 0, "in_flight": 0, "max_in_flight": 0, "tokens_sent": 0}
+
+    def chunk(body: dict, delta: dict, finish_reason=None) -> bytes:
+        data = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": body["model"], "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+        return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+    async def completions(request):
+        body = await request.json()
+        stats["requests"] += 1
+        if control["fail"]:
+            return web.json_response({"error": {"message": f"{name} unavailable"}}, status=503)
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            await asyncio.sleep(ttft)
+            if not body.get("stream"):
+                return web.json_response({
+                    "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": f"{name} " * tokens},
+                                 "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 10, "completion_tokens": tokens, "total_tokens": tokens + 10},
+                })
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            await response.write(chunk(body, {"role": "assistant", "content": ""}))
+            for _ in range(tokens):
+                await response.write(chunk(body, {"content": f"{name} "}))
+                stats["tokens_sent"] += 1
+                await asyncio.sleep(token_delay)
+            await response.write(chunk(body, {}, finish_reason="stop"))
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+        finally:
+            stats["in_flight"] -= 1
+
+    app.router.add_post("/v1/chat/completions", completions)
+    return app
+
+
+async def start_server(name: str = "fake", host: str = "127.0.0.1", port: int = 0,
+                       ttft: float = TTFT, token_delay: float = TOKEN_DELAY, tokens: int = TOKENS):
+    """Start the server in the running loop; returns (runner, base_url, app)."""
+    app = create_app(name, ttft, token_delay, tokens)
+    # Cancel the handler when the client goes away, as real inference servers abort the generation
+    runner = web.AppRunner(app, handler_cancellation=True)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://{host}:{port}/v1", app
+
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host="127.0.0.1", port=8990)
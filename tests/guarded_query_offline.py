@@ -0,0 +1,116 @@
+import asyncio
+import os
+import sys
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from psycopg import errors
+from database import guarded_query
+from database.guarded_query import execute_guarded_query, SQLGuardError
+
+# Run execute_guarded_query against a fake connection that records what is
+# sent. Stacked statements must be rejected before anything runs, the
+# EXPLAIN must go over the extended protocol, and over-cost plans, timeouts
+# and the row cap must be enforced.
+# Usage: python tests/guarded_query_offline.py
+
+
+class FakeCursor:
+    def __init__(self, connection, name=None):
+        self.connection = connection
+        self.name = name
+        self.description = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def execute(self, query, params=None, **kwargs):
+        self.connection.sent.append((self.name, query, kwargs))
+        if self.connection.fail is not None:
+            raise self.connection.fail
+        self.description = [SimpleNamespace(name="n")]
+
+    async def fetchone(self):
+        return ([{"Plan": {"Total Cost": self.connection.cost}}],)
+
+    async def fetchmany(self, size):
+        self.connection.fetched = size
+        return [(i,) for i in range(min(size, self.connection.total_rows))]
+
+
+class FakeConnection:
+    def __init__(self, cost=10.0, total_rows=5000, fail=None):
+        self.cost = cost
+        self.total_rows = total_rows
+        self.fail = fail
+        self.sent = []
+        self.fetched = None
+
+    async def execute(self, query, params=None, **kwargs):
+        self.sent.append((None, query, kwargs))
+
+    def cursor(self, name=None):
+        return FakeCursor(self, name)
+
+
+def use(connection: FakeConnection) -> FakeConnection:
+    @asynccontextmanager
+    async def get_connection(db_type="dev"):
+        yield connection
+    guarded_query.get_async_db_connection = get_connection
+    return connection
+
+
+async def expect_rejected(reason: str, sql_query, **kwargs) -> FakeConnection:
+    connection = use(FakeConnection(**{key: kwargs.pop(key) for key in ("cost", "fail") if key in kwargs}))
+    try:
+        await execute_guarded_query(sql_query, **kwargs)
+    except SQLGuardError as e:
+        assert e.reason == reason, f"{sql_query!r}: rejected as {e.reason}, expected {reason}"
+        print(f"{reason:>20}: {e}")
+        return connection
+    raise AssertionError(f"{sql_query!r} was not rejected")
+
+
+async def test():
+    # Stacked statements are refused before a connection is even used
+    for sql_query in ("SELECT 1; COMMIT; DELETE FROM tobacco.x",
+                      "SELECT 1;\n-- trailing comment\nDROP TABLE t;",
+                      "SELECT 1 /* ; */; UPDATE t SET a = 1"):
+        connection = await expect_rejected("multiple_statements", sql_query)
+        assert not connection.sent, "statements were sent before the check"
+
+    # Semicolons inside literals, identifiers, comments and dollar quotes are not separators
+    for sql_query in ("SELECT ';' AS a;", "SELECT 'it''s; fine'", 'SELECT 1 AS "a;b" -- x; y',
+                      "SELECT $tag$ ; $tag$", "SELECT E'\\'; ' AS a /* a /* nested ; */ */;"):
+        connection = use(FakeConnection(total_rows=1))
+        await execute_guarded_query(sql_query)
+        declared = connection.sent[-1][1]
+        assert not declared.rstrip().endswith(";"), declared
+    print("single statements with quoted semicolons pass")
+
+    # Read-only transaction and timeout first, EXPLAIN over the extended protocol, then the row cap
+    connection = use(FakeConnection())
+    result = await execute_guarded_query("SELECT n FROM t;", max_rows=100)
+    assert [query for _, query, _ in connection.sent[:2]] == ["SET TRANSACTION READ ONLY",
+                                                              "SET LOCAL statement_timeout = 10000"]
+    explain = connection.sent[2]
+    assert explain[1] == "EXPLAIN (FORMAT JSON) SELECT n FROM t" and explain[2].get("binary") is True
+    assert connection.sent[3][0] == "guarded_query", "rows were not read through a server-side cursor"
+    assert connection.fetched == 101 and len(result.rows) == 100 and result.truncated
+    print(f"row cap: fetched {connection.fetched}, kept {len(result.rows)}, truncated={result.truncated}")
+
+    connection = await expect_rejected("cost", "SELECT * FROM big", cost=5e6, max_cost=1e6)
+    assert all(name is None for name, _, _ in connection.sent), "query ran after an over-cost plan"
+    await expect_rejected("timeout", "SELECT pg_sleep(60)", fail=errors.QueryCanceled("canceling statement"))
+    await expect_rejected("read_only", "SELECT nextval('s')", fail=errors.ReadOnlySqlTransaction("read-only"))
+    await expect_rejected("invalid", {"foo": 1})
+
+
+if __name__ == "__main__":
+    asyncio.run(test())
@@ -0,0 +1,76 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.fake_llm_server import start_server
+from tools import openai_chat
+from tools.llm_router import LLMRouter, Upstream
+from tools.sse import StreamResult
+
+# Route streams over two local fake SSE servers, one fast and one slow, and
+# check that traffic follows the faster one, that a 503 or a refused
+# connection before the first token fails over without the caller seeing an
+# error, and print the per-upstream stats.
+# Usage: python tests/llm_router_offline.py
+MODEL = "fake-model"
+STREAMS = 40
+CONCURRENCY = 8
+
+
+async def run_streams(count: int) -> list:
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def one():
+        async with semaphore:
+            result = StreamResult()
+            async for _ in openai_chat.get_chat_response_stream_langchain(
+                    [{"role": "user", "content": "q"}], model_name=MODEL, result=result):
+                pass
+            assert result.done and result.content, "stream did not finish"
+            return result.content.split()[0]
+
+    return await asyncio.gather(*(one() for _ in range(count)))
+
+
+def print_stats(title: str):
+    print(title)
+    for stats in openai_chat.llm_router.stats():
+        print(f"  {stats['name']:<5} requests={stats['requests']:<3} failures={stats['failures']:<3} "
+              f"ewma_ttft_ms={stats['ewma_ttft_ms']} circuit={stats['circuit']}")
+
+
+async def test():
+    fast_runner, fast_url, fast_app = await start_server("fast", ttft=0.02)
+    slow_runner, slow_url, slow_app = await start_server("slow", ttft=0.3)
+    openai_chat.llm_router = LLMRouter([Upstream("fast", fast_url, "key"), Upstream("slow", slow_url, "key")])
+    try:
+        start_time = time.time()
+        served = await run_streams(STREAMS)
+        print(f"{STREAMS} streams in {time.time() - start_time:.2f}s: "
+              f"fast={served.count('fast')} slow={served.count('slow')}")
+        assert served.count("fast") > served.count("slow"), "router did not prefer the faster upstream"
+        print_stats("latency-aware routing:")
+
+        fast_app["control"]["fail"] = True
+        served = await run_streams(10)
+        assert served == ["slow"] * 10, "503 did not fail over"
+        print_stats("fast upstream answering 503:")
+        fast_app["control"]["fail"] = False
+    finally:
+        await fast_runner.cleanup()
+
+    try:
+        # The fast upstream is gone and connections are refused (fresh upstream, circuit still closed)
+        openai_chat.llm_router = LLMRouter([Upstream("gone", fast_url, "key"), Upstream("slow", slow_url, "key")])
+        served = await run_streams(10)
+        assert served == ["slow"] * 10, "refused connection did not fail over"
+        print_stats("fast upstream stopped:")
+    finally:
+        await slow_runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(test())
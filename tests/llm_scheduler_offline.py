@@ -0,0 +1,73 @@
+import asyncio
+import importlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.fake_llm_server import start_server
+from tools import openai_chat
+from tools.llm_router import LLMRouter, Upstream
+from tools.llm_scheduler import LLMScheduler, BATCH, INTERACTIVE, QueueFullError, QueueTimeoutError
+
+# A burst of batch streams against one fake SSE server with LIMIT slots,
+# then interactive streams arriving while the burst is running. Interactive
+# requests should wait far less than the batch ones, and overflowing the
+# queue should fail fast instead of waiting.
+# Usage: python tests/llm_scheduler_offline.py
+llm_scheduler_module = importlib.import_module("tools.llm_scheduler")
+MODEL = "fake-model"
+LIMIT = 4
+BATCH_STREAMS = 24
+INTERACTIVE_STREAMS = 6
+
+
+async def timed_stream(priority: str) -> float:
+    """Seconds until the first update event of one stream."""
+    start_time = time.perf_counter()
+    first = None
+    async for event in openai_chat.get_chat_response_stream_langchain(
+            [{"role": "user", "content": "q"}], model_name=MODEL, priority=priority):
+        if first is None:
+            first = time.perf_counter() - start_time
+    return first
+
+
+async def test():
+    runner, base_url, app = await start_server("fake", ttft=0.05, token_delay=0.01)
+    openai_chat.llm_router = LLMRouter([Upstream("fake", base_url, "key")])
+    llm_scheduler_module.LLM_CONCURRENCY_LIMITS[MODEL] = LIMIT
+    openai_chat.llm_scheduler = scheduler = LLMScheduler(timeout=30)
+    try:
+        batch = [asyncio.create_task(timed_stream(BATCH)) for _ in range(BATCH_STREAMS)]
+        await asyncio.sleep(0.1)
+        interactive = await asyncio.gather(*(timed_stream(INTERACTIVE) for _ in range(INTERACTIVE_STREAMS)))
+        batch = await asyncio.gather(*batch)
+        print(f"slots={LIMIT} (batch at most {scheduler.queues[MODEL].batch_limit}), "
+              f"upstream max in flight={app['stats']['max_in_flight']}")
+        print(f"batch       first event: mean {sum(batch) / len(batch):.2f}s, max {max(batch):.2f}s")
+        print(f"interactive first event: mean {sum(interactive) / len(interactive):.2f}s, max {max(interactive):.2f}s")
+        assert app["stats"]["max_in_flight"] <= LIMIT, "concurrency cap exceeded"
+        assert max(interactive) < max(batch), "interactive requests waited behind batch work"
+
+        # Queue overflow fails fast, queue timeout after the configured wait
+        llm_scheduler_module.LLM_QUEUE_SIZE = 2
+        openai_chat.llm_scheduler = scheduler = LLMScheduler(timeout=0.2)
+        streams = [asyncio.create_task(timed_stream(INTERACTIVE)) for _ in range(LIMIT + 2)]
+        await asyncio.sleep(0.02)
+        try:
+            scheduler.check(MODEL, INTERACTIVE)
+            raise AssertionError("full queue was not rejected")
+        except QueueFullError as e:
+            print(f"queue full: {e.status_code} retry after {e.retry_after:.2f}s")
+        results = await asyncio.gather(*streams, return_exceptions=True)
+        timeouts = [result for result in results if isinstance(result, QueueTimeoutError)]
+        print(f"queue timeout: {len(timeouts)} of {len(results)} streams, status {timeouts[0].status_code if timeouts else None}")
+        print(scheduler.stats())
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(test())
@@ -0,0 +1,53 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import connection as db
+from database.pool_monitor import get_in_use_counts
+
+# Release a connection with the wrong db_type: it must still go back to the
+# pool it was checked out from (and be counted as returned there) before the
+# ValueError is raised, so a misrouted release cannot drain the pool.
+# Usage: python tests/pool_release_offline.py
+
+
+class FakePool:
+    def __init__(self, name: str, size: int = 2):
+        self.name = name
+        self.free = [object() for _ in range(size)]
+
+    def getconn(self):
+        if not self.free:
+            raise RuntimeError(f"connection pool {self.name} exhausted")
+        return self.free.pop()
+
+    def putconn(self, connection):
+        self.free.append(connection)
+
+
+def test():
+    db.connection_pools.update(dev=FakePool("dev"), prod=FakePool("prod"))
+
+    # Misrouted releases, more of them than the pool holds
+    for _ in range(5):
+        connection = db.get_db_connection("dev")
+        try:
+            db.release_db_connection(connection, "prod")
+        except ValueError as e:
+            print("rejected:", e)
+        else:
+            raise AssertionError("a misrouted release was accepted")
+        assert connection in db.connection_pools["dev"].free, "connection did not go back to its pool"
+        assert connection not in db.connection_pools["prod"].free, "connection was put into the wrong pool"
+    assert get_in_use_counts().get("dev", 0) == 0
+    print("free connections:", {name: len(pool.free) for name, pool in db.connection_pools.items()})
+
+    # A normal release is unaffected
+    with db.db_connection("prod") as connection:
+        assert get_in_use_counts() == {"prod": 1}
+    assert connection in db.connection_pools["prod"].free and get_in_use_counts() == {}
+
+
+if __name__ == "__main__":
+    test()
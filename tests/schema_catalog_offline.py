@@ -0,0 +1,93 @@
+import asyncio
+import importlib
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from services import chat_service
+from tools.embedding_service import embedding_service
+
+# Table selection over a hand-built catalog with one-hot "embeddings": the
+# best-matching tables are picked, the tables they reference are added, the
+# catalog survives a save/load round trip, and a failing embedding service
+# falls back to the built-in table info instead of failing the request.
+# Usage: python tests/schema_catalog_offline.py
+schema_catalog_module = importlib.import_module("tools.schema_catalog")
+DIM = 8
+
+
+def vector(i: int) -> list:
+    v = np.zeros(DIM)
+    v[i] = 1.0
+    return v.tolist()
+
+
+def column(name: str, type_: str, numeric: bool = False, primary_key: bool = False,
+           comment: str = None, maps_to: str = None, examples=()) -> dict:
+    return {"name": name, "type": type_, "numeric": numeric, "nullable": not primary_key,
+            "primary_key": primary_key, "comment": comment, "maps_to": maps_to, "examples": list(examples)}
+
+
+def table(name: str, columns: list, vectors: list, references=(), comment: str = None) -> dict:
+    return {"schema": "tobacco", "name": name, "comment": comment, "columns": columns,
+            "references": list(references), "vectors": vectors}
+
+
+TABLES = [
+    table("exam_question", [column("id", "INTEGER", True, True, examples=["1", "2"]),
+                            column("question", "TEXT", comment="题干", examples=["烟草专卖法"])],
+          [vector(0), vector(1)], comment="考试题目"),
+    table("exam_user_answer", [column("questionid", "INTEGER", True, maps_to="exam_question.id"),
+                               column("score", "NUMERIC(9,2)", True, examples=["2.0", "3.33"])],
+          [vector(2), vector(3)], references=["exam_question"]),
+    table("users", [column("name", "TEXT")], [vector(4)]),
+    table("logs", [column("msg", "TEXT")], [vector(5)]),
+]
+
+
+def embed_as(index: int):
+    async def get_embedding(text: str):
+        return vector(index)
+    return get_embedding
+
+
+async def test():
+    path = os.path.join(tempfile.mkdtemp(), "schema_catalog.json")
+    catalog = schema_catalog_module.SchemaCatalog(path=path)
+    catalog._swap(TABLES, {"embedding_model": embedding_service.model_name})
+    chat_service.schema_catalog = catalog
+
+    # A column of exam_user_answer matches best; exam_question comes in through the foreign key
+    embedding_service.get_embedding = embed_as(3)
+    table_info = await catalog.select_tables("平均分是多少", top_k=1)
+    picked = [line.split("# Table: ")[1] for line in table_info.splitlines() if line.startswith("# Table: ")]
+    print("picked:", picked)
+    assert picked == ["exam_user_answer", "exam_question"]
+    assert "(questionid:INTEGER, Maps to exam_question.id)" in table_info
+
+    # Ranking alone, no references to follow
+    embedding_service.get_embedding = embed_as(4)
+    table_info = await catalog.select_tables("有哪些用户", top_k=1)
+    assert "# Table: users" in table_info and "# Table: exam_question" not in table_info
+
+    # Save and load keep the version
+    catalog.save()
+    loaded = schema_catalog_module.SchemaCatalog(path=path)
+    loaded.load()
+    assert loaded.version == catalog.version and loaded.stats()["vectors"] == 6
+    print("round trip version:", loaded.version)
+
+    # Embedding service down: no tables from the catalog, the built-in info is used
+    async def unavailable(text: str):
+        raise ConnectionError("embedding service unavailable")
+    embedding_service.get_embedding = unavailable
+    assert await catalog.select_tables("平均分是多少", top_k=1) is None
+    assert await chat_service.select_table("平均分是多少") == chat_service.DEFAULT_TABLE_INFO
+    print("embedding failure falls back to the built-in table info")
+
+
+if __name__ == "__main__":
+    asyncio.run(test())
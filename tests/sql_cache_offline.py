@@ -0,0 +1,96 @@
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("ai_chat_model", "fake-model")
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+from models.chat import ChatAnalysisRequest
+from database.guarded_query import QueryResult, SQLGuardError
+from services import chat_service
+from tools import openai_chat
+from tools.llm_cache import llm_response_cache
+from tools.sse import sse_event
+
+# The SQL the model generates must not be served from the LLM response cache:
+# when it fails to run, asking the same question again has to reach the model
+# for new SQL. Other get_chat_response callers still hit the cache.
+# Usage: python tests/sql_cache_offline.py
+SQL_ANSWERS = ["SELECT count(*) FROM tobacco.missing_table", "SELECT count(*) FROM tobacco.exam"]
+
+
+class FakeModel:
+    """Stands in for the chat model; prompts asking for SQL get the next of SQL_ANSWERS."""
+
+    def __init__(self):
+        self.sql_calls = 0
+        self.other_calls = 0
+
+    def __call__(self, messages):
+        if "PostgreSQL data analyst" in messages[-1]["content"]:
+            self.sql_calls += 1
+            sql = SQL_ANSWERS[min(self.sql_calls, len(SQL_ANSWERS)) - 1]
+            return AIMessage(content=json.dumps({"sql": sql}))
+        self.other_calls += 1
+        return AIMessage(content="第一周考了几场考试？")
+
+
+class FakeRouter:
+    async def call(self, model_name, invoke):
+        return await invoke(None)
+
+
+async def fake_reasoning(query, table_info):
+    yield sse_event("推理", event="update")
+
+
+async def fake_final_output(query, query_result, result=None):
+    result.content = "共 3 场考试"
+    yield sse_event(result.content, event="update")
+
+
+async def noop(*args):
+    return []
+
+
+async def test():
+    model = FakeModel()
+    openai_chat.llm_router = FakeRouter()
+    openai_chat._get_llm = lambda upstream, model_name: RunnableLambda(model)
+    await llm_response_cache.clear()
+    chat_service.nl2sql_cache.clear()
+    chat_service.select_table = lambda query: asyncio.sleep(0, "[Schema]")
+    chat_service.generate_sql_reasoning = fake_reasoning
+    chat_service.final_output = fake_final_output
+    chat_service.get_chat_history = noop
+    chat_service.add_message_to_chat = noop
+
+    executed = []
+
+    async def execute_sql(sql_query):
+        executed.append(sql_query)
+        if "missing_table" in sql_query:
+            raise SQLGuardError("relation does not exist", "invalid")
+        return QueryResult(rows=[("第一周", 3)], columns=["week", "count"])
+    chat_service.execute_sql = execute_sql
+
+    request = ChatAnalysisRequest(user_input="第一周考了几场", chat_id="c1", database_id="tobacco")
+    events = [event async for event in chat_service.chat_with_ai_analysis(request)]
+    assert events[-1].startswith("event:ERROR"), events[-1]
+    print("first run failed:", events[-1].strip().replace("\n", " "))
+
+    # Same question again: the model is asked for SQL again and the new SQL runs
+    events = [event async for event in chat_service.chat_with_ai_analysis(request)]
+    assert not any(event.startswith("event:ERROR") for event in events)
+    print("executed:", executed, "sql calls:", model.sql_calls, "other calls:", model.other_calls)
+    assert model.sql_calls == 2 and executed == SQL_ANSWERS, "failed SQL was served again"
+    # Optimizing the question is still cached
+    assert model.other_calls == 1
+
+
+if __name__ == "__main__":
+    asyncio.run(test())
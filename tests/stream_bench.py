@@ -0,0 +1,67 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import AIMessageChunk
+from setting.models_provider.model_manage import ModelManage
+from tools import openai_chat, streaming
+
+# CPU per 1k tokens of get_chat_response_stream_langchain against a fake model
+# that streams instantly, compared with the previous `full += chunk` loop.
+# Usage: python tests/stream_bench.py
+
+TOKEN = "烟草专卖"
+
+
+class FakeLLM:
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+
+    async def astream(self, messages, **kwargs):
+        for _ in range(self.tokens):
+            yield AIMessageChunk(content=TOKEN)
+        yield AIMessageChunk(content="", usage_metadata={"input_tokens": 10, "output_tokens": self.tokens, "total_tokens": self.tokens + 10})
+
+
+async def previous_stream(llm):
+    """The loop as it was before StreamAccumulator: merge chunks on every token."""
+    flag = 1
+    async for chunk in llm.astream([], stream_usage=True):
+        if flag == 1:
+            full = chunk
+            flag = 0
+        full += chunk
+        yield f"event:update\ndata:{chunk.content}\n\n"
+    yield f"event: Done\ndata:{full.content[:0]}\n\n"
+
+
+async def measure(make_stream, tokens: int) -> tuple:
+    frames = 0
+    start = time.process_time()
+    async for _ in make_stream():
+        frames += 1
+    cpu = time.process_time() - start
+    return cpu / tokens * 1000 * 1000, frames
+
+
+async def main():
+    print(f"{'tokens':>7} {'variant':<26} {'ms CPU / 1k tokens':>19} {'frames':>7}")
+    for tokens in (1000, 4000, 16000):
+        llm = FakeLLM(tokens)
+        ModelManage.get_model = staticmethod(lambda *args, **kwargs: llm)
+        variants = [
+            ("previous (full += chunk)", lambda: previous_stream(llm)),
+            ("accumulator", lambda: openai_chat.get_chat_response_stream_langchain([{"role": "user", "content": "q"}])),
+            ("accumulator + 256B frames", lambda: openai_chat.get_chat_response_stream_langchain([{"role": "user", "content": "q"}])),
+        ]
+        for name, make_stream in variants:
+            streaming.SSE_COALESCE_BYTES = 256 if name.endswith("frames") else 0
+            cpu_per_1k, frames = await measure(make_stream, tokens)
+            print(f"{tokens:>7} {name:<26} {cpu_per_1k:>19.2f} {frames:>7}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
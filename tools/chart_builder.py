@@ -0,0 +1,105 @@
+import datetime
+import decimal
+import os
+from typing import List, Optional, Sequence
+import numpy as np
+from prometheus_client import Counter
+
+# Build bar chart data from SQL results locally; the LLM is only asked when the shape is ambiguous
+CHART_BUILDER_ENABLED = os.getenv("CHART_BUILDER_ENABLED", "True") == "True"
+
+CHART_BUILDS = Counter(
+    "mcbot_chart_builds_total",
+    "SQL results turned into chart data locally, or left to the LLM as ambiguous",
+    ["result"],
+)
+
+_NUMERIC_TYPES = (int, float, decimal.Decimal)
+NULL_CATEGORY = "未知"
+
+
+def _is_numeric(value) -> bool:
+    # bool is an int subclass but reads as a category
+    return isinstance(value, _NUMERIC_TYPES) and not isinstance(value, bool)
+
+
+def _column_kinds(rows: Sequence[tuple], width: int) -> List[Optional[str]]:
+    """
+    "numeric" or "category" per column, judged from its non-null values as
+    psycopg decoded them from the column types; None for all-null columns.
+    """
+    kinds = []
+    for i in range(width):
+        values = [row[i] for row in rows if row[i] is not None]
+        if not values:
+            kinds.append(None)
+        elif all(_is_numeric(value) for value in values):
+            kinds.append("numeric")
+        else:
+            kinds.append("category")
+    return kinds
+
+
+def _category(value) -> str:
+    if value is None:
+        return NULL_CATEGORY
+    if isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+def _to_list(values: np.ndarray) -> list:
+    """Plain JSON numbers, ints when every value is whole."""
+    if np.all(np.mod(values, 1) == 0):
+        return [int(value) for value in values]
+    return [round(float(value), 4) for value in values]
+
+
+def _group(categories: List[str], weights: Optional[np.ndarray]) -> dict:
+    """
+    Sum weights (or count rows when None) per category, keeping the order in
+    which categories first appear so the query's ORDER BY survives.
+    """
+    keys, first_index, inverse = np.unique(np.array(categories, dtype=object),
+                                           return_index=True, return_inverse=True)
+    totals = np.bincount(inverse.ravel(), weights=weights, minlength=len(keys))
+    order = np.argsort(first_index)
+    return {"categories": [str(key) for key in keys[order]], "values": _to_list(totals[order])}
+
+
+def build_chart_data(rows: Sequence[tuple], columns: Optional[Sequence[str]] = None) -> Optional[dict]:
+    """
+    Turn SQL rows into {"categories": [...], "values": [...]} for the bar chart.
+
+    Handles the unambiguous shapes:
+    - one category column and one numeric column: values summed per category
+    - one row of numeric columns only: one bar per column, named after it
+    - one category column with repeated values: rows counted per category
+    Returns None for anything else (several category or numeric columns,
+    a bare list of numbers, ...), which is left to the LLM.
+    """
+    if not rows:
+        return {"categories": [], "values": []}
+    width = len(rows[0])
+    columns = list(columns) if columns else [f"column{i + 1}" for i in range(width)]
+    kinds = _column_kinds(rows, width)
+    category_columns = [i for i, kind in enumerate(kinds) if kind == "category"]
+    numeric_columns = [i for i, kind in enumerate(kinds) if kind == "numeric"]
+
+    chart = None
+    if len(category_columns) == 1 and len(numeric_columns) == 1:
+        category_index, value_index = category_columns[0], numeric_columns[0]
+        weights = np.array([float(row[value_index]) if row[value_index] is not None else 0.0 for row in rows])
+        chart = _group([_category(row[category_index]) for row in rows], weights)
+    elif not category_columns and numeric_columns and len(rows) == 1:
+        chart = {
+            "categories": [columns[i] for i in numeric_columns],
+            "values": _to_list(np.array([float(rows[0][i] or 0) for i in numeric_columns])),
+        }
+    elif len(category_columns) == 1 and not numeric_columns:
+        categories = [_category(row[category_columns[0]]) for row in rows]
+        if len(set(categories)) < len(categories):
+            chart = _group(categories, None)
+
+    CHART_BUILDS.labels(result="local" if chart is not None else "ambiguous").inc()
+    return chart
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+from prometheus_client import Histogram
+from setting.models_provider.impl.openai_model_provider.model.llm import custom_get_token_ids
+from tools.lru_cache import LRUTTLCache
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+# Prompt token budget per model, e.g. {"qwen2.5-72b-instruct": 28000}; other models use CONTEXT_TOKEN_BUDGET
+CONTEXT_TOKEN_BUDGETS: Dict[str, int] = json.loads(os.getenv("CONTEXT_TOKEN_BUDGETS", "{}"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "8000"))
+# Tokens kept free for the model's answer
+CONTEXT_RESPONSE_TOKENS = int(os.getenv("CONTEXT_RESPONSE_TOKENS", "1024"))
+# Share of the budget (after the system prompt) always left for history when RAG documents are trimmed
+CONTEXT_HISTORY_MIN_SHARE = float(os.getenv("CONTEXT_HISTORY_MIN_SHARE", "0.25"))
+# RAG documents below this similarity are never sent
+RAG_MIN_SIMILARITY = float(os.getenv("RAG_MIN_SIMILARITY", "0"))
+
+# Token counts kept for the system prompt and history messages, which are re-sent every turn
+CONTEXT_TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("CONTEXT_TOKEN_CACHE_MAX_ENTRIES", "16384"))
+CONTEXT_TOKEN_CACHE_TTL = float(os.getenv("CONTEXT_TOKEN_CACHE_TTL", "86400"))
+
+# Per-message overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+PROMPT_TOKENS = Histogram(
+    "mcbot_prompt_tokens",
+    "Prompt tokens per section after context assembly",
+    ["section"],
+    buckets=(64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768),
+)
+
+_CJK_RE = re.compile(r"[一-鿿　-〿＀-￯]")
+_tokenizer_available = True
+_token_counts = LRUTTLCache(name="token_count", max_entries=CONTEXT_TOKEN_CACHE_MAX_ENTRIES,
+                            ttl=CONTEXT_TOKEN_CACHE_TTL)
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count tokens with the TokenizerManage tokenizer. Without it (transformers
+    or the local tokenizer files missing) estimate one token per CJK
+    character and one per four other characters.
+    """
+    global _tokenizer_available
+    if not text:
+        return 0
+    if _tokenizer_available:
+        try:
+            return len(custom_get_token_ids(text))
+        except Exception as e:
+            _tokenizer_available = False
+            logger.warning(f"Tokenizer unavailable, estimating token counts: {e}")
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_tokens_cached(text: str) -> int:
+    """
+    count_tokens for text seen on every turn (system prompt, history), so
+    each message goes through the tokenizer once rather than once per turn.
+    """
+    if not text:
+        return 0
+    key = hashlib.sha1(text.encode("utf-8")).digest()
+    tokens = _token_counts.get(key)
+    if tokens is None:
+        tokens = count_tokens(text)
+        _token_counts.set(key, tokens)
+    return tokens
+
+
+def count_message_tokens(message: dict, cached: bool = False) -> int:
+    counter = count_tokens_cached if cached else count_tokens
+    return counter(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+def get_token_budget(model_name: Optional[str]) -> int:
+    """Prompt tokens available for a model, with room left for the answer."""
+    return CONTEXT_TOKEN_BUDGETS.get(model_name, CONTEXT_TOKEN_BUDGET) - CONTEXT_RESPONSE_TOKENS
+
+
+def build_context(model_name: Optional[str], system_prompt: str, history: List[dict], documents: List[dict],
+                  render_user: Callable[[List[dict]], str]) -> Tuple[List[dict], List[dict], dict]:
+    """
+    Fit the system prompt, chat history, RAG documents and the current user
+    message into the model's token budget.
+
+    The system prompt and the current question are always kept. RAG documents
+    below RAG_MIN_SIMILARITY are dropped, then the least similar ones while the
+    user message would leave less than CONTEXT_HISTORY_MIN_SHARE of the budget
+    for history. History fills what is left, newest turns first.
+
+    Args:
+        documents: RAG documents, most similar first, each with a "similarity".
+        render_user: Builds the current user message from the kept documents.
+
+    Returns:
+        (messages without the system prompt, kept documents, tokens per section)
+    """
+    budget = get_token_budget(model_name)
+    system_tokens = count_tokens_cached(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+    available = budget - system_tokens
+
+    kept_documents = [doc for doc in documents if doc.get("similarity", 1.0) >= RAG_MIN_SIMILARITY]
+    kept_documents.sort(key=lambda doc: doc.get("similarity", 1.0), reverse=True)
+    user_message = {"role": "user", "content": render_user(kept_documents)}
+    user_tokens = count_message_tokens(user_message)
+    user_limit = available * (1 - CONTEXT_HISTORY_MIN_SHARE)
+    while kept_documents and user_tokens > user_limit:
+        kept_documents.pop()
+        user_message = {"role": "user", "content": render_user(kept_documents)}
+        user_tokens = count_message_tokens(user_message)
+    rag_tokens = user_tokens - count_message_tokens({"content": render_user([])}) if kept_documents else 0
+
+    # Newest turns first, stop at the first one that no longer fits
+    remaining = available - user_tokens
+    kept_history: List[dict] = []
+    history_tokens = 0
+    for message in reversed(history):
+        tokens = count_message_tokens(message, cached=True)
+        if tokens > remaining - history_tokens:
+            break
+        kept_history.append(message)
+        history_tokens += tokens
+    kept_history.reverse()
+    # Do not start the kept history with an assistant reply whose question was dropped
+    while kept_history and len(kept_history) < len(history) and kept_history[0]["role"] == "assistant":
+        history_tokens -= count_message_tokens(kept_history.pop(0), cached=True)
+
+    report = {
+        "model": model_name,
+        "budget": budget,
+        "system": system_tokens,
+        "history": history_tokens,
+        "rag": rag_tokens,
+        "user": user_tokens - rag_tokens,
+        "total": system_tokens + history_tokens + user_tokens,
+        "dropped_turns": len(history) - len(kept_history),
+        "dropped_documents": len(documents) - len(kept_documents),
+    }
+    for section in ("system", "history", "rag", "user", "total"):
+        PROMPT_TOKENS.labels(section=section).observe(report[section])
+    logger.info(f"Prompt context tokens: {report}")
+    return kept_history + [user_message], kept_documents, report
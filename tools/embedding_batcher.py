@@ -0,0 +1,73 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+
+class EmbeddingBatcher:
+    """
+    Collects embedding requests that arrive within a short window and sends
+    them to the embedding service as one batched call.
+
+    Args:
+        fetch_batch: Coroutine function taking a list of texts and returning
+            one vector per text, in the same order.
+        max_batch_size: A batch is sent as soon as it holds this many texts.
+        max_wait_ms: Longest time the first request of a batch waits for others.
+    """
+
+    def __init__(self, fetch_batch: Callable[[List[str]], Awaitable[List[List[float]]]],
+                 max_batch_size: int = 32, max_wait_ms: float = 5):
+        self.fetch_batch = fetch_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+
+    async def submit(self, text: str) -> List[float]:
+        """Queue a text for the next batch and wait for its vector."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        """Take the pending requests and send them in the background."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._send(batch))
+        # Keep a reference so the task is not garbage collected while running
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: List[Tuple[str, asyncio.Future]]):
+        """Send one batch, de-duplicating identical texts, and resolve each caller's future."""
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            vectors = await self.fetch_batch(texts)
+            if len(vectors) != len(texts):
+                raise ValueError(f"Embedding batch returned {len(vectors)} vectors for {len(texts)} texts")
+        except Exception as e:
+            logger.error(f"Embedding batch of {len(texts)} texts failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        by_text = dict(zip(texts, vectors))
+        for text, future in batch:
+            if not future.done():
+                future.set_result(by_text[text])
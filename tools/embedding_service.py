@@ -1,22 +1,126 @@
-from typing import List
+from typing import List, Optional
 import numpy as np
-from database.connection import get_db_connection, release_db_connection
+from database.async_connection import get_async_db_connection
+from database.vector import to_vector_param
+from tools.lru_cache import LRUTTLCache
+from tools.embedding_batcher import EmbeddingBatcher
+from tools.vector_index import law_vector_index, LAW_INDEX_ENABLED, LAW_INDEX_TABLE
+from tools.resilience import RetryPolicy, CircuitOpenError, get_circuit_breaker
+import hashlib
 import os
+import re
+import unicodedata
 import aiohttp
-import asyncio
 
 # ----------配置日志-------------
 from tools.ray_logger import LoggerHandler
 log_file = "main.log"
 logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
 # -----------日志配置完成----------
+
+# Connection pool and timeout settings for the embedding HTTP session
+EMBEDDING_POOL_LIMIT = int(os.getenv("EMBEDDING_POOL_LIMIT", "100"))
+EMBEDDING_POOL_LIMIT_PER_HOST = int(os.getenv("EMBEDDING_POOL_LIMIT_PER_HOST", "20"))
+EMBEDDING_KEEPALIVE_TIMEOUT = float(os.getenv("EMBEDDING_KEEPALIVE_TIMEOUT", "60"))
+EMBEDDING_CONNECT_TIMEOUT = float(os.getenv("EMBEDDING_CONNECT_TIMEOUT", "3"))
+EMBEDDING_TOTAL_TIMEOUT = float(os.getenv("EMBEDDING_TOTAL_TIMEOUT", "10"))
+
+# Query embedding cache bounds
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "8192"))
+EMBEDDING_CACHE_MAX_MB = float(os.getenv("EMBEDDING_CACHE_MAX_MB", "64"))
+EMBEDDING_CACHE_TTL = float(os.getenv("EMBEDDING_CACHE_TTL", "86400"))
+
+# Backoff between retries: random in [0, min(max, base * 2 ** attempt)] seconds
+EMBEDDING_RETRY_BASE_DELAY = float(os.getenv("EMBEDDING_RETRY_BASE_DELAY", "0.2"))
+EMBEDDING_RETRY_MAX_DELAY = float(os.getenv("EMBEDDING_RETRY_MAX_DELAY", "2"))
+
+# Micro-batching of concurrent requests, enabled by setting EMBEDDING_BATCH_SERVICE_URL
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "32"))
+EMBEDDING_BATCH_MAX_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_MAX_WAIT_MS", "5"))
+
+# Rows get_top5_laws_by_quevec can return
+STORED_PROCEDURE_TOP_K = 5
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+def normalize_text(text: str) -> str:
+    """Normalize text before hashing so equivalent inputs share a cache entry."""
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
 class EmbeddingService:
     def __init__(self, model_name: str = "bge-m3"):
         self.model_name = model_name
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._batcher: Optional[EmbeddingBatcher] = None
+        # Vectors are stored as float32 arrays to keep the cache compact
+        self.cache = LRUTTLCache(
+            name="embedding",
+            max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+            ttl=EMBEDDING_CACHE_TTL,
+            max_bytes=int(EMBEDDING_CACHE_MAX_MB * 1024 * 1024),
+            sizeof=lambda vector: vector.nbytes,
+        )
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """
+        Return the shared keep-alive session, creating it on first use.
+        Must be called from within the running event loop.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=EMBEDDING_POOL_LIMIT,
+                limit_per_host=EMBEDDING_POOL_LIMIT_PER_HOST,
+                keepalive_timeout=EMBEDDING_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=300,
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=EMBEDDING_TOTAL_TIMEOUT,
+                connect=EMBEDDING_CONNECT_TIMEOUT,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def startup(self):
+        """Create the shared HTTP session on app startup."""
+        self._get_session()
+
+    async def close(self):
+        """Close the shared HTTP session on app shutdown."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
         
+    def _cache_key(self, text: str) -> str:
+        """Hash of the model name and the normalized text."""
+        return hashlib.sha256(f"{self.model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
     async def get_embedding(self, text: str, max_retries: int = 3) -> List[float]:
+        """
+        Get embedding vector for input text, served from the cache when the
+        same text was embedded recently.
+        
+        Args:
+            text: The input text to get embedding for.
+            max_retries: Maximum number of retries if the request fails.
+        
+        Returns:
+            A list of floats representing the embedding vector, or None if the request fails.
+        """
+        key = self._cache_key(text)
+        vector = self.cache.get(key)
+        if vector is not None:
+            return vector.tolist()
+
+        embedding = await self._fetch_embedding(text, max_retries)
+        if embedding is not None:
+            self.cache.set(key, np.asarray(embedding, dtype=np.float32))
+        return embedding
+
+    async def _fetch_embedding(self, text: str, max_retries: int = 3) -> List[float]:
         """
         Get embedding vector for input text by calling a remote embedding service.
+        Concurrent calls are sent as one batched request when
+        EMBEDDING_BATCH_SERVICE_URL is configured.
         
         Args:
             text: The input text to get embedding for.
@@ -28,6 +132,9 @@ class EmbeddingService:
         Raises:
             Exception: If the request fails after retries.
         """
+        if os.getenv("EMBEDDING_BATCH_SERVICE_URL"):
+            return await self._get_batcher().submit(text)
+
         # Get the service URL from environment variables
         service_url = os.getenv("EMBEDDING_SERVICE_URL", "http://172.16.99.91:8989/getBGEencodeByText")
         
@@ -35,54 +142,94 @@ class EmbeddingService:
         payload = {
             "msg": text
         }
-        
-        retries = 0
-        while retries < max_retries:
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(service_url, json=payload) as response:
-                        # Check if the request was successful
-                        if response.status == 200:
-                            # Parse the response JSON
-                            result = await response.json()
-                            # Assuming the response contains a field "embedding" with the vector
-                            if "sentence" in result:
-                                return result["sentence"]
-                            else:
-                                raise ValueError("Response does not contain 'sentence' field")
-                        else:
-                            # Handle non-200 status codes
-                            raise Exception(f"Embedding service returned status code {response.status}")
-            except Exception as e:
-                # Log the error and retry
-                retries += 1
-                logger.error(f"Attempt {retries} failed: {e}")
-                if retries < max_retries:
-                    await asyncio.sleep(1)  # Wait for 1 second before retrying
+        return await self._post_with_retries(service_url, payload, "sentence", max_retries)
+
+    def _get_batcher(self) -> EmbeddingBatcher:
+        """Return the request batcher, creating it on first use."""
+        if self._batcher is None:
+            self._batcher = EmbeddingBatcher(
+                self._fetch_embedding_batch,
+                max_batch_size=EMBEDDING_BATCH_MAX_SIZE,
+                max_wait_ms=EMBEDDING_BATCH_MAX_WAIT_MS,
+            )
+        return self._batcher
+
+    async def _fetch_embedding_batch(self, texts: List[str], max_retries: int = 3) -> List[List[float]]:
+        """
+        Get embedding vectors for several texts with one call to the batch endpoint.
+        The endpoint takes {"msgs": [...]} and returns {"sentences": [[...], ...]}
+        in the same order.
+        """
+        service_url = os.getenv("EMBEDDING_BATCH_SERVICE_URL")
+        payload = {
+            "msgs": texts
+        }
+        return await self._post_with_retries(service_url, payload, "sentences", max_retries)
+
+    async def _post_with_retries(self, service_url: str, payload: dict, field: str, max_retries: int = 3):
+        """
+        POST payload to the embedding service and return result[field].
+        Failures are retried with exponential backoff and jitter; while the
+        endpoint's circuit is open, calls fail fast with CircuitOpenError.
+        """
+        policy = RetryPolicy(max_attempts=max_retries, base_delay=EMBEDDING_RETRY_BASE_DELAY,
+                             max_delay=EMBEDDING_RETRY_MAX_DELAY)
+        breaker = get_circuit_breaker(f"embedding:{service_url}")
+        try:
+            return await policy.call(self._post_json, service_url, payload, field, breaker=breaker)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            raise Exception(f"Failed to get embedding after {max_retries} retries: {e}")
+
+    async def _post_json(self, service_url: str, payload: dict, field: str):
+        """Single POST to the embedding service, returns result[field]."""
+        session = self._get_session()
+        async with session.post(service_url, json=payload) as response:
+            # Check if the request was successful
+            if response.status == 200:
+                # Parse the response JSON
+                result = await response.json()
+                if field in result:
+                    return result[field]
                 else:
-                    # If all retries fail, raise an exception
-                    raise Exception(f"Failed to get embedding after {max_retries} retries: {e}")
-        
-        # If all retries fail, return None
-        return None
+                    raise ValueError(f"Response does not contain '{field}' field")
+            else:
+                # Handle non-200 status codes
+                raise Exception(f"Embedding service returned status code {response.status}")
     
     async def search_similar(self, embedding: List[float], top_k: int = 5) -> List[dict]:
-        """Search for similar content in database using embedding vector"""
-        conn = None
+        """
+        Search for similar content using embedding vector, from the in-memory index when enabled and loaded;
+        falls back to the database when the index search fails
+        """
+        if LAW_INDEX_ENABLED and law_vector_index.ready:
+            try:
+                return law_vector_index.search(embedding, top_k)
+            except Exception as e:
+                logger.error(f"In-memory index search failed, searching the database: {e}")
         try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            # Convert embedding to PostgreSQL array format
-            embedding_array = "[" + ",".join(map(str, embedding)) + "]"
-            
-            # Updated query to call the stored procedure
-            query = """
-            SELECT * FROM "tobacco"."get_top5_laws_by_quevec"(%s::public.vector)
-            LIMIT %s;
-            """
-            cursor.execute(query, (embedding_array, top_k))
-            results = cursor.fetchall()
+            if top_k <= STORED_PROCEDURE_TOP_K:
+                # Updated query to call the stored procedure, the vector is sent in binary form
+                query = """
+                SELECT * FROM "tobacco"."get_top5_laws_by_quevec"(%b::public.vector)
+                LIMIT %s;
+                """
+            else:
+                # The stored procedure returns at most 5 rows; larger candidate sets (hybrid retrieval) query the table directly
+                query = f"""
+                SELECT law_id, law_name, chapter, article_content, 1 - (embedding <=> %b::public.vector) AS similarity
+                FROM {LAW_INDEX_TABLE}
+                WHERE embedding IS NOT NULL
+                ORDER BY embedding <=> %b::public.vector
+                LIMIT %s;
+                """
+            async with get_async_db_connection() as conn:
+                async with conn.cursor() as cursor:
+                    vector = to_vector_param(embedding)
+                    params = (vector, top_k) if top_k <= STORED_PROCEDURE_TOP_K else (vector, vector, top_k)
+                    await cursor.execute(query, params)
+                    results = await cursor.fetchall()
             
             # Map the results to a list of dictionaries
             return [{
@@ -96,9 +243,6 @@ class EmbeddingService:
         except Exception as e:
             logger.error(f"Database search failed: {e}")
             return []
-        finally:
-            if conn:
-                release_db_connection(conn)
 
     async def lg_search_kb_by_chat(self, embedding: List[float]) -> List[dict]:
         """
@@ -110,22 +254,20 @@ class EmbeddingService:
         Returns:
             List[dict]: List of matching documents with title, content and similarity score
         """
-        conn = None
         try:
             # Validate embedding input
             if not embedding or not isinstance(embedding, list):
                 logger.error("Invalid embedding input")
                 return []
-                
-            conn = get_db_connection(db_type="lg")
-            cursor = conn.cursor()
             
-            # 直接传递 embedding 列表给 PostgreSQL
+            # 以二进制格式传递 float32 向量给 PostgreSQL
             query = """
-                SELECT * FROM csm.use_vec_get_top_kgcont(%s::public.vector);
+                SELECT * FROM csm.use_vec_get_top_kgcont(%b::public.vector);
             """
-            cursor.execute(query, (embedding,))
-            results = cursor.fetchall()
+            async with get_async_db_connection(db_type="lg") as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(query, (to_vector_param(embedding),))
+                    results = await cursor.fetchall()
             
             return [{
                 "title": row[0],
@@ -136,9 +278,6 @@ class EmbeddingService:
         except Exception as e:
             logger.error(f"LG Knowledge base search failed: {e}")
             return []
-        finally:
-            if conn:
-                release_db_connection(conn,db_type="lg")
 
 
 # Singleton instance
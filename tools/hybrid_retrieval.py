@@ -0,0 +1,302 @@
+from collections import Counter as TermCounter, defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+import math
+import os
+import re
+import time
+import aiohttp
+import numpy as np
+from prometheus_client import Counter, Histogram
+from database.async_connection import get_async_db_connection
+from tools.embedding_service import embedding_service
+from tools.resilience import RetryPolicy, get_circuit_breaker
+from tools.vector_index import LAW_INDEX_TABLE
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+# Fuse BM25 hits with the vector hits in rag_search
+RAG_HYBRID_ENABLED = os.getenv("RAG_HYBRID_ENABLED") == "True"
+# Candidates taken from each retriever before fusion, and documents kept after it
+RAG_CANDIDATES = int(os.getenv("RAG_CANDIDATES", "20"))
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "5"))
+# Reciprocal rank fusion constant
+RAG_RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+# Optional cross-encoder: POST {"query": ..., "texts": [...]} -> [{"index": i, "score": s}, ...]
+RERANK_SERVICE_URL = os.getenv("RERANK_SERVICE_URL")
+RERANK_TIMEOUT = float(os.getenv("RERANK_TIMEOUT", "3"))
+
+RETRIEVAL_STAGE_SECONDS = Histogram(
+    "mcbot_retrieval_stage_seconds",
+    "Latency of each retrieval stage",
+    ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+RETRIEVAL_STAGE_RESULTS = Histogram(
+    "mcbot_retrieval_stage_results",
+    "Documents returned by each retrieval stage",
+    ["stage"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50),
+)
+# Which retriever found each returned document: "bm25" counts what vector search alone would have missed
+RETRIEVAL_SOURCE_HITS = Counter(
+    "mcbot_retrieval_source_hits_total",
+    "Returned documents by the retrievers that found them",
+    ["source"],
+)
+
+# Article numbers such as 第三十三条 are kept as one token
+_ARTICLE_RE = re.compile(r"第[一二三四五六七八九十百千零〇两\d]+[条章节款项]")
+_CJK_RE = re.compile(r"[一-鿿]+")
+_WORD_RE = re.compile(r"[A-Za-z0-9]+")
+
+try:
+    import jieba
+except ImportError:
+    jieba = None
+    logger.info("jieba is not installed, BM25 falls back to character bigrams")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Tokenize Chinese legal text for BM25: article numbers as whole tokens,
+    then jieba words (search mode), or CJK character bigrams without jieba.
+    """
+    text = text or ""
+    tokens = _ARTICLE_RE.findall(text)
+    text = _ARTICLE_RE.sub(" ", text)
+    if jieba is not None:
+        tokens += [word.lower() for word in jieba.cut_for_search(text) if word.strip() and not _is_punctuation(word)]
+        return tokens
+    for run in _CJK_RE.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        tokens += [run[i:i + 2] for i in range(len(run) - 1)]
+    tokens += [word.lower() for word in _WORD_RE.findall(text)]
+    return tokens
+
+
+def _is_punctuation(word: str) -> bool:
+    return not (_CJK_RE.search(word) or _WORD_RE.search(word))
+
+
+class BM25Index:
+    """Okapi BM25 over the law slices, with an inverted index of term frequencies."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.rows: List[dict] = []
+        # term -> (document indices, term frequencies)
+        self._postings: Dict[str, tuple] = {}
+        self._idf: Dict[str, float] = {}
+        self._doc_norm: Optional[np.ndarray] = None
+        self.loaded_at: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return len(self.rows) > 0
+
+    def build(self, rows: List[dict]) -> None:
+        """Index rows by law name, chapter and article content."""
+        postings = defaultdict(list)
+        lengths = []
+        for i, row in enumerate(rows):
+            tokens = tokenize(f"{row['law_name']} {row['chapter']} {row['article_content']}")
+            lengths.append(len(tokens))
+            for term, tf in TermCounter(tokens).items():
+                postings[term].append((i, tf))
+
+        count = len(rows)
+        lengths = np.asarray(lengths, dtype=np.float32)
+        avg_length = float(lengths.mean()) if count else 0.0
+        idf = {term: math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5)) for term, docs in postings.items()}
+        # Length normalization part of the BM25 denominator, per document
+        doc_norm = self.k1 * (1 - self.b + self.b * lengths / (avg_length or 1))
+
+        postings = {
+            term: (np.fromiter((i for i, _ in docs), dtype=np.int64, count=len(docs)),
+                   np.fromiter((tf for _, tf in docs), dtype=np.float32, count=len(docs)))
+            for term, docs in postings.items()
+        }
+
+        # Swap everything at once so concurrent searches never see a half-built index
+        self.rows, self._postings, self._idf, self._doc_norm = rows, postings, idf, doc_norm
+        self.loaded_at = time.time()
+
+    async def load(self) -> dict:
+        """Load (or reload) the law slices from the database and rebuild the index."""
+        query = f"""
+            SELECT law_id, law_name, chapter, article_content
+            FROM {LAW_INDEX_TABLE};
+        """
+        async with get_async_db_connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(query)
+                results = await cursor.fetchall()
+        self.build([{
+            "law_id": row[0],
+            "law_name": row[1],
+            "chapter": row[2],
+            "article_content": row[3],
+        } for row in results])
+        stats = self.stats()
+        logger.info(f"BM25 law index loaded: {stats}")
+        return stats
+
+    async def warm_up(self):
+        """Load the index on startup; failures are logged and rag_search stays vector-only."""
+        try:
+            await self.load()
+        except Exception as e:
+            logger.error(f"BM25 law index load failed, retrieval stays vector-only: {e}")
+
+    def search(self, query: str, top_k: int = RAG_CANDIDATES) -> List[dict]:
+        rows, postings, idf, doc_norm = self.rows, self._postings, self._idf, self._doc_norm
+        if not rows:
+            return []
+        scores = np.zeros(len(rows), dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in postings:
+                continue
+            indices, tf = postings[term]
+            scores[indices] += idf[term] * tf * (self.k1 + 1) / (tf + doc_norm[indices])
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > top_k:
+            matched = matched[np.argpartition(-scores[matched], top_k - 1)[:top_k]]
+        matched = matched[np.argsort(-scores[matched])]
+        return [{**rows[i], "bm25_score": float(scores[i])} for i in matched]
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "tokenizer": "jieba" if jieba is not None else "bigram",
+            "rows": len(self.rows),
+            "terms": len(self._postings),
+            "loaded_at": self.loaded_at,
+        }
+
+
+def reciprocal_rank_fusion(result_lists: Dict[str, List[dict]], k: int = RAG_RRF_K) -> List[dict]:
+    """
+    Merge ranked lists by law_id with RRF: score = sum(1 / (k + rank)).
+    Each fused document records the retrievers that found it in "sources".
+    """
+    fused: Dict[object, dict] = {}
+    for source, results in result_lists.items():
+        for rank, result in enumerate(results, start=1):
+            doc = fused.setdefault(result["law_id"], {**result, "rrf_score": 0.0, "sources": []})
+            doc.update({key: value for key, value in result.items() if key not in doc})
+            doc["rrf_score"] += 1 / (k + rank)
+            doc["sources"].append(source)
+    return sorted(fused.values(), key=lambda doc: doc["rrf_score"], reverse=True)
+
+
+class HybridRetriever:
+    """
+    Vector search plus BM25, fused with reciprocal rank fusion and optionally
+    reranked by a cross-encoder service. Stages that are unavailable (BM25
+    index not loaded, reranker down) are skipped.
+    """
+
+    def __init__(self, bm25: BM25Index):
+        self.bm25 = bm25
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._rerank_policy = RetryPolicy(max_attempts=1)
+
+    async def search(self, query: str, embedding: List[float], top_k: int = RAG_TOP_K,
+                     candidates: int = RAG_CANDIDATES) -> List[dict]:
+        with _stage("vector"):
+            vector_results = await embedding_service.search_similar(embedding, candidates)
+        _record_results("vector", vector_results)
+        with _stage("bm25"):
+            bm25_results = self.bm25.search(query, candidates)
+        _record_results("bm25", bm25_results)
+
+        with _stage("fusion"):
+            fused = reciprocal_rank_fusion({"vector": vector_results, "bm25": bm25_results})[:candidates]
+
+        if RERANK_SERVICE_URL and fused:
+            try:
+                with _stage("rerank"):
+                    fused = await self.rerank(query, fused)
+            except Exception as e:
+                logger.error(f"Rerank failed, using fused order: {e}")
+
+        results = fused[:top_k]
+        _record_results("final", results)
+        for doc in results:
+            RETRIEVAL_SOURCE_HITS.labels(source="+".join(sorted(doc["sources"]))).inc()
+            # The prompt shows "similarity": prefer the reranker score, then the vector similarity
+            doc["similarity"] = doc.get("rerank_score", doc.get("similarity", 0.0))
+        return results
+
+    async def rerank(self, query: str, docs: List[dict]) -> List[dict]:
+        """Reorder docs by cross-encoder relevance to the query."""
+        breaker = get_circuit_breaker(f"rerank:{RERANK_SERVICE_URL}")
+        scores = await self._rerank_policy.call(self._post_rerank, query, docs, breaker=breaker)
+        for item in scores:
+            docs[item["index"]]["rerank_score"] = float(item["score"])
+        return sorted(docs, key=lambda doc: doc.get("rerank_score", float("-inf")), reverse=True)
+
+    async def _post_rerank(self, query: str, docs: List[dict]) -> List[dict]:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=RERANK_TIMEOUT))
+        payload = {
+            "query": query,
+            "texts": [f"{doc['law_name']} {doc['chapter']}\n{doc['article_content']}" for doc in docs],
+        }
+        async with self._session.post(RERANK_SERVICE_URL, json=payload) as response:
+            if response.status != 200:
+                raise Exception(f"Rerank service returned status code {response.status}")
+            return await response.json()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+def evaluate_recall(cases: Iterable[tuple], retrieve: Dict[str, List[List[dict]]], k: int = RAG_TOP_K) -> dict:
+    """
+    Offline recall@k per stage.
+
+    Args:
+        cases: (query, relevant law_ids) pairs.
+        retrieve: stage name -> one result list per case, in the same order.
+    """
+    cases = list(cases)
+    report = {}
+    for stage, results_per_case in retrieve.items():
+        recalls = []
+        for (_, relevant), results in zip(cases, results_per_case):
+            relevant = set(relevant)
+            if relevant:
+                found = {doc["law_id"] for doc in results[:k]}
+                recalls.append(len(found & relevant) / len(relevant))
+        report[stage] = sum(recalls) / len(recalls) if recalls else None
+    return report
+
+
+@contextmanager
+def _stage(name: str):
+    """Time a retrieval stage into mcbot_retrieval_stage_seconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        RETRIEVAL_STAGE_SECONDS.labels(stage=name).observe(time.perf_counter() - start)
+
+
+def _record_results(stage: str, results: List[dict]):
+    RETRIEVAL_STAGE_RESULTS.labels(stage=stage).observe(len(results))
+
+
+# Singleton instances
+law_bm25_index = BM25Index()
+hybrid_retriever = HybridRetriever(law_bm25_index)
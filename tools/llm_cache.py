@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Any, Optional
+from tools.lru_cache import LRUTTLCache
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+# Cache temperature-0 non-streaming responses of get_chat_response
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "True") == "True"
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "2048"))
+LLM_CACHE_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", "32"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+# Optional SQLite file that keeps responses across restarts
+LLM_CACHE_DISK_PATH = os.getenv("LLM_CACHE_DISK_PATH")
+
+
+def llm_cache_key(model: str, messages: list, if_json: bool) -> str:
+    """Hash of everything that determines a temperature-0 response."""
+    payload = json.dumps({"model": model, "messages": messages, "if_json": if_json},
+                         ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiskResponseStore:
+    """SQLite key-value store with per-entry expiry; calls run in a worker thread."""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        """Open a connection, commit on success and always close it."""
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _get(self, key: str) -> Optional[str]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, expires_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] < time.time():
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return None
+            return row[0]
+
+    def _set(self, key: str, value: str, ttl: Optional[float]):
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                         (key, value, expires_at))
+
+    def _clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM llm_cache")
+
+    async def get(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value: str, ttl: Optional[float]):
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+    async def clear(self):
+        await asyncio.to_thread(self._clear)
+
+
+class LLMResponseCache:
+    """
+    Two-level response cache: an in-memory LRU in front of an optional disk
+    store. Values are stored as JSON text so callers always get a fresh copy
+    of parsed (if_json) responses. Disk errors are logged and treated as misses.
+    """
+
+    def __init__(self, ttl: Optional[float] = LLM_CACHE_TTL, disk: Optional[DiskResponseStore] = None):
+        self.ttl = ttl
+        self.memory = LRUTTLCache(
+            name="llm_response",
+            max_entries=LLM_CACHE_MAX_ENTRIES,
+            ttl=ttl,
+            max_bytes=int(LLM_CACHE_MAX_MB * 1024 * 1024),
+            sizeof=lambda value: len(value.encode("utf-8")),
+        )
+        self.disk = disk
+
+    async def get(self, key: str) -> Optional[Any]:
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            try:
+                value = await self.disk.get(key)
+            except Exception as e:
+                logger.error(f"LLM cache disk read failed: {e}")
+            if value is not None:
+                self.memory.set(key, value)
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key: str, response: Any):
+        value = json.dumps(response, ensure_ascii=False)
+        self.memory.set(key, value)
+        if self.disk is not None:
+            try:
+                await self.disk.set(key, value, self.ttl)
+            except Exception as e:
+                logger.error(f"LLM cache disk write failed: {e}")
+
+    async def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            await self.disk.clear()
+
+    def stats(self) -> dict:
+        return {**self.memory.stats(), "disk": self.disk.path if self.disk is not None else None}
+
+
+# Singleton instance
+llm_response_cache = LLMResponseCache(
+    disk=DiskResponseStore(LLM_CACHE_DISK_PATH) if LLM_CACHE_DISK_PATH else None,
+)
@@ -0,0 +1,209 @@
+import json
+import os
+import time
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+import openai
+from prometheus_client import Counter, Gauge, Histogram
+from tools.resilience import CircuitOpenError, get_circuit_breaker
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+# OpenAI-compatible upstreams as a JSON list:
+# [{"name": "a", "base_url": "http://a/v1", "api_key": "...", "models": ["qwen"]}, ...]
+# "models" is optional (serves every model). Without LLM_UPSTREAMS the single
+# upstream ray_ai_base_url / ray_ai_api_key_default is used.
+LLM_UPSTREAMS = os.getenv("LLM_UPSTREAMS")
+# Smoothing factor of the TTFT moving average, and the TTFT assumed for an upstream not measured yet
+LLM_ROUTER_EWMA_ALPHA = float(os.getenv("LLM_ROUTER_EWMA_ALPHA", "0.3"))
+LLM_ROUTER_INITIAL_TTFT = float(os.getenv("LLM_ROUTER_INITIAL_TTFT", "1.0"))
+
+UPSTREAM_IN_FLIGHT = Gauge(
+    "mcbot_llm_upstream_in_flight",
+    "Requests in flight per LLM upstream",
+    ["upstream"],
+)
+UPSTREAM_TTFT = Histogram(
+    "mcbot_llm_upstream_ttft_seconds",
+    "Time to first token per LLM upstream",
+    ["upstream"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32),
+)
+UPSTREAM_FAILURES = Counter(
+    "mcbot_llm_upstream_failures_total",
+    "Requests that failed before the first token, per LLM upstream",
+    ["upstream"],
+)
+
+# Errors that mean the upstream is unavailable; anything else (bad request, auth) is not retried elsewhere
+FAILOVER_ERRORS = (openai.APIConnectionError, openai.InternalServerError, openai.RateLimitError, CircuitOpenError)
+
+
+class Upstream:
+    """One OpenAI-compatible endpoint and what has been observed about it."""
+
+    def __init__(self, name: str, base_url: str, api_key: str, models: Optional[List[str]] = None):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.models = models
+        self.breaker = get_circuit_breaker(f"llm:{name}")
+        self.in_flight = 0
+        self.ewma_ttft: Optional[float] = None
+        self.requests = 0
+        self.failures = 0
+
+    def serves(self, model_name: str) -> bool:
+        return not self.models or model_name in self.models
+
+    def score(self) -> float:
+        """Expected wait: smoothed TTFT scaled by the requests already queued on it."""
+        ttft = self.ewma_ttft if self.ewma_ttft is not None else LLM_ROUTER_INITIAL_TTFT
+        return ttft * (self.in_flight + 1)
+
+    def record_ttft(self, seconds: float):
+        UPSTREAM_TTFT.labels(upstream=self.name).observe(seconds)
+        if self.ewma_ttft is None:
+            self.ewma_ttft = seconds
+        else:
+            self.ewma_ttft = LLM_ROUTER_EWMA_ALPHA * seconds + (1 - LLM_ROUTER_EWMA_ALPHA) * self.ewma_ttft
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "models": self.models,
+            "in_flight": self.in_flight,
+            "ewma_ttft_ms": round(self.ewma_ttft * 1000, 2) if self.ewma_ttft is not None else None,
+            "requests": self.requests,
+            "failures": self.failures,
+            "circuit": self.breaker.state,
+        }
+
+
+class LLMRouter:
+    """
+    Spreads LLM calls over several upstreams serving the same model.
+
+    Each call goes to the upstream with the lowest expected wait
+    (EWMA TTFT x (in flight + 1)). If it fails with a connection-level error
+    before the first token, the call moves on to the next upstream; once
+    tokens have been sent, errors are raised to the caller as before.
+    """
+
+    def __init__(self, upstreams: List[Upstream]):
+        self.upstreams = upstreams
+
+    @classmethod
+    def from_env(cls) -> "LLMRouter":
+        if LLM_UPSTREAMS:
+            configs = json.loads(LLM_UPSTREAMS)
+        else:
+            configs = [{"name": "default", "base_url": os.getenv("ray_ai_base_url"),
+                        "api_key": os.getenv("ray_ai_api_key_default")}]
+        return cls([Upstream(config.get("name") or config["base_url"], config["base_url"],
+                             config.get("api_key"), config.get("models")) for config in configs])
+
+    @property
+    def max_retries(self) -> int:
+        """Client-side retries per upstream: with failover available, move on instead of retrying."""
+        return 0 if len(self.upstreams) > 1 else 2
+
+    def candidates(self, model_name: str) -> List[Upstream]:
+        """Upstreams serving the model, best first."""
+        upstreams = [upstream for upstream in self.upstreams if upstream.serves(model_name)]
+        if not upstreams:
+            raise ValueError(f"No LLM upstream serves model {model_name}")
+        return sorted(upstreams, key=lambda upstream: upstream.score())
+
+    def _begin(self, upstream: Upstream):
+        upstream.breaker.before_call()
+        upstream.in_flight += 1
+        upstream.requests += 1
+        UPSTREAM_IN_FLIGHT.labels(upstream=upstream.name).set(upstream.in_flight)
+
+    def _end(self, upstream: Upstream):
+        upstream.in_flight -= 1
+        UPSTREAM_IN_FLIGHT.labels(upstream=upstream.name).set(upstream.in_flight)
+
+    def _fail(self, upstream: Upstream, error: Exception):
+        if not isinstance(error, CircuitOpenError):
+            upstream.breaker.record_failure()
+        upstream.failures += 1
+        UPSTREAM_FAILURES.labels(upstream=upstream.name).inc()
+        logger.warning(f"LLM upstream {upstream.name} failed before first token, failing over: {error}")
+
+    async def stream(self, model_name: str, open_stream: Callable[[Upstream], AsyncIterator]) -> AsyncIterator:
+        """
+        Stream from the best upstream, failing over until the first chunk arrives.
+        :param open_stream: returns the chunk stream for an upstream
+        """
+        last_error = None
+        for upstream in self.candidates(model_name):
+            try:
+                self._begin(upstream)
+            except CircuitOpenError as e:
+                last_error = e
+                continue
+            start_time = time.perf_counter()
+            started = False
+            chunks = open_stream(upstream)
+            try:
+                async for chunk in chunks:
+                    if not started:
+                        started = True
+                        upstream.record_ttft(time.perf_counter() - start_time)
+                        upstream.breaker.record_success()
+                    yield chunk
+                if not started:
+                    upstream.breaker.record_success()
+                return
+            except FAILOVER_ERRORS as e:
+                if started:
+                    raise
+                self._fail(upstream, e)
+                last_error = e
+            except BaseException:
+                if not started:
+                    upstream.breaker.release_probe()
+                raise
+            finally:
+                self._end(upstream)
+                # Closing early (client gone) ends the upstream request instead of leaving it to the GC
+                aclose = getattr(chunks, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+        raise last_error
+
+    async def call(self, model_name: str, invoke: Callable[[Upstream], Awaitable]):
+        """Run a non-streaming call on the best upstream, failing over on connection-level errors."""
+        last_error = None
+        for upstream in self.candidates(model_name):
+            try:
+                self._begin(upstream)
+            except CircuitOpenError as e:
+                last_error = e
+                continue
+            try:
+                result = await invoke(upstream)
+                upstream.breaker.record_success()
+                return result
+            except FAILOVER_ERRORS as e:
+                self._fail(upstream, e)
+                last_error = e
+            except BaseException:
+                upstream.breaker.release_probe()
+                raise
+            finally:
+                self._end(upstream)
+        raise last_error
+
+    def stats(self) -> List[dict]:
+        return [upstream.stats() for upstream in self.upstreams]
+
+
+# Singleton instance
+llm_router = LLMRouter.from_env()
@@ -0,0 +1,219 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Optional
+from prometheus_client import Counter, Gauge, Histogram
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+# Concurrent generations per model, e.g. {"deepseek-r1": 4}; other models use LLM_CONCURRENCY_LIMIT
+LLM_CONCURRENCY_LIMITS: Dict[str, int] = json.loads(os.getenv("LLM_CONCURRENCY_LIMITS", "{}"))
+LLM_CONCURRENCY_LIMIT = int(os.getenv("LLM_CONCURRENCY_LIMIT", "32"))
+# Share of a model's slots batch work may hold, so interactive requests always find room
+LLM_BATCH_MAX_SHARE = float(os.getenv("LLM_BATCH_MAX_SHARE", "0.5"))
+# Waiting requests per model and priority before new ones are rejected, and how long one may wait
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "64"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+PRIORITIES = (INTERACTIVE, BATCH)
+
+QUEUE_DEPTH = Gauge(
+    "mcbot_llm_queue_depth",
+    "Requests waiting for an LLM slot",
+    ["model", "priority"],
+)
+ACTIVE = Gauge(
+    "mcbot_llm_active",
+    "LLM generations holding a slot",
+    ["model", "priority"],
+)
+QUEUE_WAIT = Histogram(
+    "mcbot_llm_queue_wait_seconds",
+    "Time spent waiting for an LLM slot",
+    ["model", "priority"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+REJECTED = Counter(
+    "mcbot_llm_admission_rejected_total",
+    "LLM requests rejected by admission control",
+    ["model", "priority", "reason"],
+)
+
+
+class AdmissionError(Exception):
+    """An LLM request was not admitted; status_code and retry_after are meant for the HTTP response."""
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueFullError(AdmissionError):
+    status_code = 429
+
+
+class QueueTimeoutError(AdmissionError):
+    status_code = 503
+
+
+class ModelQueue:
+    """
+    Slots and wait queues of one model.
+
+    Interactive requests may use every slot, batch requests at most
+    batch_limit of them. Freed slots go to waiting interactive requests
+    first, then to batch requests.
+    """
+
+    def __init__(self, model_name: str, limit: int):
+        self.model_name = model_name
+        self.limit = limit
+        self.batch_limit = max(1, int(limit * LLM_BATCH_MAX_SHARE))
+        self.active = {priority: 0 for priority in PRIORITIES}
+        self.waiters: Dict[str, Deque[asyncio.Future]] = {priority: deque() for priority in PRIORITIES}
+        # Smoothed time a slot is held, for the Retry-After estimate
+        self.ewma_hold = 1.0
+
+    def _can_run(self, priority: str) -> bool:
+        if sum(self.active.values()) >= self.limit:
+            return False
+        return priority == INTERACTIVE or self.active[BATCH] < self.batch_limit
+
+    def _take(self, priority: str):
+        self.active[priority] += 1
+        ACTIVE.labels(model=self.model_name, priority=priority).set(self.active[priority])
+
+    def _update_depth(self, priority: str):
+        QUEUE_DEPTH.labels(model=self.model_name, priority=priority).set(len(self.waiters[priority]))
+
+    def retry_after(self, priority: str) -> float:
+        """Rough time until a request queued now would get a slot."""
+        ahead = len(self.waiters[INTERACTIVE]) + (len(self.waiters[BATCH]) if priority == BATCH else 0)
+        limit = self.limit if priority == INTERACTIVE else self.batch_limit
+        return self.ewma_hold * (ahead + 1) / limit
+
+    def check(self, priority: str):
+        """Raise QueueFullError if a request of this priority would be rejected right now."""
+        if not self._can_run(priority) and len(self.waiters[priority]) >= LLM_QUEUE_SIZE:
+            REJECTED.labels(model=self.model_name, priority=priority, reason="queue_full").inc()
+            raise QueueFullError(f"LLM queue for {self.model_name} ({priority}) is full", self.retry_after(priority))
+
+    async def acquire(self, priority: str, timeout: float):
+        start_time = time.perf_counter()
+        # Only jump in directly when nobody of equal or higher priority is waiting
+        waiting_ahead = self.waiters[INTERACTIVE] or (priority == BATCH and self.waiters[BATCH])
+        if not waiting_ahead and self._can_run(priority):
+            self._take(priority)
+            QUEUE_WAIT.labels(model=self.model_name, priority=priority).observe(0)
+            return
+        self.check(priority)
+
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[priority].append(future)
+        self._update_depth(priority)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                REJECTED.labels(model=self.model_name, priority=priority, reason="timeout").inc()
+                raise QueueTimeoutError(f"Timed out after {timeout:.0f}s waiting for an LLM slot for {self.model_name}",
+                                        self.retry_after(priority))
+        except asyncio.CancelledError:
+            # Granted just as the caller went away: hand the slot on
+            if future.done() and not future.cancelled():
+                self.release(priority)
+            else:
+                future.cancel()
+            raise
+        finally:
+            if future in self.waiters[priority]:
+                self.waiters[priority].remove(future)
+            self._update_depth(priority)
+        QUEUE_WAIT.labels(model=self.model_name, priority=priority).observe(time.perf_counter() - start_time)
+
+    def release(self, priority: str, held: Optional[float] = None):
+        self.active[priority] -= 1
+        ACTIVE.labels(model=self.model_name, priority=priority).set(self.active[priority])
+        if held is not None:
+            self.ewma_hold = 0.2 * held + 0.8 * self.ewma_hold
+        self._wake()
+
+    def _wake(self):
+        for priority in PRIORITIES:
+            waiters = self.waiters[priority]
+            while waiters and self._can_run(priority):
+                future = waiters.popleft()
+                if future.done():
+                    continue
+                self._take(priority)
+                future.set_result(None)
+            self._update_depth(priority)
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "batch_limit": self.batch_limit,
+            "active": dict(self.active),
+            "waiting": {priority: len(self.waiters[priority]) for priority in PRIORITIES},
+            "ewma_hold_s": round(self.ewma_hold, 3),
+        }
+
+
+class LLMScheduler:
+    """
+    Admission control in front of LLM generation: per-model concurrency caps,
+    interactive/batch priority and bounded wait queues.
+
+    Requests over the cap wait up to LLM_QUEUE_TIMEOUT for a slot
+    (QueueTimeoutError after that); when the wait queue is full they are
+    rejected at once with QueueFullError.
+    """
+
+    def __init__(self, timeout: float = LLM_QUEUE_TIMEOUT):
+        self.timeout = timeout
+        self.queues: Dict[str, ModelQueue] = {}
+
+    def _queue(self, model_name: str) -> ModelQueue:
+        queue = self.queues.get(model_name)
+        if queue is None:
+            limit = LLM_CONCURRENCY_LIMITS.get(model_name, LLM_CONCURRENCY_LIMIT)
+            queue = self.queues[model_name] = ModelQueue(model_name, limit)
+        return queue
+
+    def check(self, model_name: str, priority: str = INTERACTIVE):
+        """
+        Fail fast before a streaming response is started, while an HTTP error
+        status can still be returned.
+        """
+        self._queue(model_name).check(priority)
+
+    @asynccontextmanager
+    async def slot(self, model_name: str, priority: str = INTERACTIVE):
+        """Hold one of the model's generation slots for the duration of the block."""
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority {priority}")
+        queue = self._queue(model_name)
+        await queue.acquire(priority, self.timeout)
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            queue.release(priority, time.perf_counter() - start_time)
+
+    def stats(self) -> dict:
+        return {model_name: queue.stats() for model_name, queue in self.queues.items()}
+
+
+# Singleton instance
+llm_scheduler = LLMScheduler()
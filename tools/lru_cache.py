@@ -0,0 +1,130 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+from prometheus_client import Counter, Gauge
+
+CACHE_EVENTS = Counter(
+    "mcbot_cache_events_total",
+    "Cache lookups and evictions",
+    ["cache", "event"],
+)
+CACHE_ENTRIES = Gauge(
+    "mcbot_cache_entries",
+    "Entries currently held in the cache",
+    ["cache"],
+)
+CACHE_BYTES = Gauge(
+    "mcbot_cache_bytes",
+    "Approximate bytes held in the cache",
+    ["cache"],
+)
+
+
+class LRUTTLCache:
+    """
+    In-memory LRU cache with a per-entry TTL, bounded by entry count and
+    optionally by total size in bytes.
+
+    Args:
+        name: Cache name used as the metrics label.
+        max_entries: Maximum number of entries kept.
+        ttl: Seconds an entry stays valid, None for no expiry.
+        max_bytes: Maximum total size of the values, None for no limit.
+        sizeof: Function returning the size of a value in bytes, required with max_bytes.
+    """
+
+    def __init__(self, name: str, max_entries: int = 1024, ttl: Optional[float] = 3600,
+                 max_bytes: Optional[int] = None, sizeof: Optional[Callable[[Any], int]] = None):
+        if max_bytes is not None and sizeof is None:
+            raise ValueError("sizeof is required when max_bytes is set")
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and not self._expired(entry)
+
+    def _expired(self, entry) -> bool:
+        return entry[0] is not None and entry[0] < time.time()
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def _update_gauges(self):
+        CACHE_ENTRIES.labels(cache=self.name).set(len(self._data))
+        CACHE_BYTES.labels(cache=self.name).set(self._bytes)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value and mark it as recently used, or default on a miss."""
+        entry = self._data.get(key)
+        if entry is not None and self._expired(entry):
+            self._remove(key)
+            CACHE_EVENTS.labels(cache=self.name, event="expired").inc()
+            self._update_gauges()
+            entry = None
+        if entry is None:
+            self.misses += 1
+            CACHE_EVENTS.labels(cache=self.name, event="miss").inc()
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        CACHE_EVENTS.labels(cache=self.name, event="hit").inc()
+        return entry[2]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Store a value, evicting least recently used entries when over the bounds."""
+        ttl = self.ttl if ttl is None else ttl
+        size = self.sizeof(value) if self.sizeof else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        if key in self._data:
+            self._remove(key)
+        expires_at = time.time() + ttl if ttl is not None else None
+        self._data[key] = (expires_at, size, value)
+        self._bytes += size
+        while len(self._data) > self.max_entries or (
+                self.max_bytes is not None and self._bytes > self.max_bytes):
+            oldest_key = next(iter(self._data))
+            self._remove(oldest_key)
+            self.evictions += 1
+            CACHE_EVENTS.labels(cache=self.name, event="eviction").inc()
+        self._update_gauges()
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove an entry and return its value."""
+        if key not in self._data:
+            return default
+        value = self._data[key][2]
+        self._remove(key)
+        self._update_gauges()
+        return value
+
+    def clear(self):
+        """Remove all entries."""
+        self._data.clear()
+        self._bytes = 0
+        self._update_gauges()
+
+    def stats(self) -> dict:
+        """Return hit/miss/eviction counters and the current size."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
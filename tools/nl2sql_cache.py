@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import re
+from typing import Any, Optional, Tuple
+from tools.embedding_service import normalize_text
+from tools.lru_cache import LRUTTLCache
+from tools.schema_catalog import schema_catalog, SCHEMA_CATALOG_ENABLED
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+# Reuse the SQL generated for a question, and the rows and chart data of recently run SQL
+NL2SQL_CACHE_ENABLED = os.getenv("NL2SQL_CACHE_ENABLED", "True") == "True"
+NL2SQL_PLAN_CACHE_MAX_ENTRIES = int(os.getenv("NL2SQL_PLAN_CACHE_MAX_ENTRIES", "2048"))
+NL2SQL_PLAN_CACHE_TTL = float(os.getenv("NL2SQL_PLAN_CACHE_TTL", "86400"))
+# Results go stale as the data changes, so they are kept much shorter than plans
+NL2SQL_RESULT_CACHE_MAX_ENTRIES = int(os.getenv("NL2SQL_RESULT_CACHE_MAX_ENTRIES", "256"))
+NL2SQL_RESULT_CACHE_MAX_MB = float(os.getenv("NL2SQL_RESULT_CACHE_MAX_MB", "32"))
+NL2SQL_RESULT_CACHE_TTL = float(os.getenv("NL2SQL_RESULT_CACHE_TTL", "300"))
+
+# Trailing punctuation does not change what is being asked
+_TRAILING_PUNCTUATION_RE = re.compile(r"[\s?？。.!！~～]+$")
+
+
+def normalize_question(question: str) -> str:
+    """Normalize a question so trivially different spellings share a plan."""
+    return _TRAILING_PUNCTUATION_RE.sub("", normalize_text(question).lower())
+
+
+def _result_size(entry: Tuple[Any, Any]) -> int:
+    query_result, chart = entry
+    return len(json.dumps([query_result.rows, chart], ensure_ascii=False, default=str).encode("utf-8"))
+
+
+class NL2SQLCache:
+    """
+    Plan cache and result cache for the analysis pipeline.
+
+    The plan cache maps a normalized question to the optimized question and
+    the SQL that was generated for it. Plans are only stored after the SQL
+    has run, and each plan is stored under both the raw and the optimized
+    question. The result cache maps SQL to its QueryResult and chart data.
+    Both are keyed on the schema version, and both are cleared when the
+    schema catalog changes.
+    """
+
+    def __init__(self):
+        self.plans = LRUTTLCache(name="nl2sql_plan", max_entries=NL2SQL_PLAN_CACHE_MAX_ENTRIES,
+                                 ttl=NL2SQL_PLAN_CACHE_TTL)
+        self.results = LRUTTLCache(name="nl2sql_result", max_entries=NL2SQL_RESULT_CACHE_MAX_ENTRIES,
+                                   ttl=NL2SQL_RESULT_CACHE_TTL,
+                                   max_bytes=int(NL2SQL_RESULT_CACHE_MAX_MB * 1024 * 1024), sizeof=_result_size)
+
+    @staticmethod
+    def schema_version() -> str:
+        """Version of the schema the prompts are built from; the built-in table info when the catalog is unused."""
+        if SCHEMA_CATALOG_ENABLED and schema_catalog.ready():
+            return schema_catalog.version
+        return "builtin"
+
+    def _key(self, kind: str, text: str) -> str:
+        payload = f"{self.schema_version()}\0{kind}\0{text}"
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get_plan(self, question: str) -> Optional[dict]:
+        """{"optimized_query": ..., "sql": ...} generated earlier for the question, or None."""
+        if not NL2SQL_CACHE_ENABLED:
+            return None
+        return self.plans.get(self._key("plan", normalize_question(question)))
+
+    def set_plan(self, question: str, optimized_query: str, sql_query: str):
+        if not NL2SQL_CACHE_ENABLED:
+            return
+        plan = {"optimized_query": optimized_query, "sql": sql_query}
+        for text in {normalize_question(question), normalize_question(optimized_query)}:
+            self.plans.set(self._key("plan", text), plan)
+
+    def get_result(self, sql_query: str) -> Optional[Tuple[Any, Any]]:
+        """(QueryResult, chart data) of the SQL when it ran recently, or None."""
+        if not NL2SQL_CACHE_ENABLED:
+            return None
+        return self.results.get(self._key("result", sql_query))
+
+    def set_result(self, sql_query: str, query_result, chart):
+        if NL2SQL_CACHE_ENABLED:
+            self.results.set(self._key("result", sql_query), (query_result, chart))
+
+    def clear(self):
+        self.plans.clear()
+        self.results.clear()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": NL2SQL_CACHE_ENABLED,
+            "schema_version": self.schema_version(),
+            "plans": self.plans.stats(),
+            "results": self.results.stats(),
+        }
+
+
+# Singleton instance
+nl2sql_cache = NL2SQLCache()
+
+
+def _on_schema_change():
+    logger.info(f"Schema catalog changed to {schema_catalog.version}, clearing the NL2SQL caches")
+    nl2sql_cache.clear()
+
+
+schema_catalog.on_change(_on_schema_change)
@@ -5,13 +5,22 @@ from services.chat_tools_impl import tools
 from services.chat_tools_pydantic import tools_parse
 from langchain_core.output_parsers.openai_tools import PydanticToolsParser
 import os
-from typing import List, Dict, AsyncIterator
+from typing import List, Dict, AsyncIterator, Optional
 import json
 import time
+import asyncio
+from prometheus_client import Counter
 
 from tools.utils import deprecated
 
 from openai import AsyncOpenAI, OpenAI
+from setting.models_provider.model_manage import ModelManage
+from tools.llm_cache import llm_response_cache, llm_cache_key, LLM_CACHE_ENABLED
+from tools.streaming import StreamAccumulator, coalesce
+from tools.sse import SSEEncoder, StreamResult
+from tools.llm_router import llm_router, Upstream
+from tools.llm_scheduler import llm_scheduler, INTERACTIVE
+from tools.timing import record_span
 
 # ----------配置日志-------------
 from tools.ray_logger import LoggerHandler
@@ -19,6 +28,19 @@ log_file = "main.log"
 logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
 # -----------日志配置完成----------
 
+LLM_STREAMS_CANCELLED = Counter(
+    "mcbot_llm_streams_cancelled_total",
+    "LLM streams closed before the model finished, e.g. because the client disconnected",
+    ["model"],
+)
+LLM_TOKENS_SAVED = Counter(
+    "mcbot_llm_tokens_saved_total",
+    "Estimated completion tokens not generated because the stream was cancelled",
+    ["model"],
+)
+# 各模型完整回复 token 数的平滑均值，用于估算流被取消后节省的 token 数
+_completion_tokens_ewma: Dict[str, float] = {}
+
 @deprecated
 async def get_chat_response_stream_httpx(messages: List[Dict[str, str]], system_prompt: str = "") -> AsyncIterator[str]:
     """
@@ -139,28 +161,57 @@ async def get_chat_response_stream_asyoai(messages: List[Dict[str, str]], system
     end_time = time.time()
     print(f"all out put Consume time:{end_time - start_time}")
 
-async def get_chat_response(messages: List[Dict[str, str]], system_prompt: str = "", if_json: bool = False) -> str:
+def resolve_model_name(model_name: Optional[str]) -> Optional[str]:
+    """模型名根据传入参数从环境变量中获取，如果环境变量中没有则直接使用传入的参数"""
+    return os.getenv(model_name) if model_name and os.getenv(model_name) else model_name
+
+def select_model_name(if_r1: bool) -> Optional[str]:
+    """按是否开启 R1 选择模型"""
+    return os.getenv("R1_MODEL_NAME") if if_r1 else os.getenv("ai_chat_model")
+
+def _get_llm(upstream: Upstream, model_name: str, if_r1: bool = False):
+    """
+    从注册表获取上游对应的 LangChain 模型，相同配置复用同一实例和连接池
+    r1 系列使用 ChatDeepSeek 以处理 reasoning_content 额外参数
+    """
+    if if_r1:
+        return ModelManage.get_model(
+            ChatDeepSeek,
+            model_name,
+            base_url=upstream.base_url,
+            api_key=upstream.api_key,
+            base_url_param="api_base",
+            temperature=0,
+            max_tokens=None,
+            timeout=None,
+            max_retries=llm_router.max_retries,
+        )
+    return ModelManage.get_model(
+        ChatOpenAI,
+        model_name,
+        base_url=upstream.base_url,
+        api_key=upstream.api_key,
+        temperature=0,
+        max_tokens=None,
+        timeout=None,
+        max_retries=llm_router.max_retries,
+    )
+
+async def get_chat_response(messages: List[Dict[str, str]], system_prompt: str = "", if_json: bool = False, use_cache: bool = True, priority: str = INTERACTIVE) -> str:
     """
     获取 OpenAI 聊天模型的完整响应（非流式）
     :param messages: 聊天消息列表，格式为 [{"role": "system"|"user"|"assistant", "content": "消息内容"}, ...]
     :param system_prompt: 系统提示词
     :param if_json: 是否返回JSON格式的响应，如果为True则解析并返回SQL或SQL键的值
+    :param use_cache: 是否使用响应缓存（temperature=0 时相同输入的结果相同），为False时总是请求模型。
+        只有结果完全由提示词决定、且无需事后校验的调用才应缓存（问题优化、标题生成、提示词中带有查询结果的绘图数据格式化）；
+        生成 SQL 等结果需执行后才知道是否可用的调用应传入 False，由调用方在校验通过后自行缓存
+    :param priority: 调度优先级 interactive / batch，超出模型并发上限时排队
     :return: 返回完整的聊天响应内容或解析后的SQL语句
     """
     model_name = os.getenv("ai_chat_model")
     logger.info(f"Using model: {model_name}")
     
-    # 初始化 LangChain 的 ChatOpenAI
-    llm = ChatOpenAI(
-        model=model_name,
-        temperature=0,
-        max_tokens=None,
-        timeout=None,
-        max_retries=2,
-        api_key=os.getenv("ray_ai_api_key_default"),
-        base_url=os.getenv("ray_ai_base_url"),
-    )
-    
     # 添加系统提示词
     if not system_prompt and messages[0]["role"] != "system":
         system_message = {
@@ -175,62 +226,56 @@ async def get_chat_response(messages: List[Dict[str, str]], system_prompt: str =
         }
         messages.insert(0, system_message)
 
+    # 相同模型、消息和输出格式命中缓存时直接返回，跳过一次完整的模型调用
+    use_cache = use_cache and LLM_CACHE_ENABLED
+    if use_cache:
+        cache_key = llm_cache_key(model_name, messages, if_json)
+        cached_response = await llm_response_cache.get(cache_key)
+        if cached_response is not None:
+            logger.info("LLM response served from cache")
+            return cached_response
+
     start_time = time.time()
     try:
         # 配置chain
-        if if_json:
-            from langchain_core.output_parsers import JsonOutputParser
-            chain = llm | JsonOutputParser()
-            response = await chain.ainvoke(messages)
-        else:
-            response = await llm.ainvoke(messages)
+        async with llm_scheduler.slot(model_name, priority):
+            if if_json:
+                from langchain_core.output_parsers import JsonOutputParser
+                response = await llm_router.call(
+                    model_name, lambda upstream: (_get_llm(upstream, model_name) | JsonOutputParser()).ainvoke(messages))
+            else:
+                response = await llm_router.call(
+                    model_name, lambda upstream: _get_llm(upstream, model_name).ainvoke(messages))
         
         # 记录性能指标
         end_time = time.time()
+        record_span("llm_total", end_time - start_time)
         time_diff_ms = (end_time - start_time) * 1000
         logger.info(f"LLM response time: {time_diff_ms:.2f} ms")
         
         logger.debug(response.content if hasattr(response, 'content') else response)
     
-        return response.content if hasattr(response, 'content') else response
+        result = response.content if hasattr(response, 'content') else response
+        if use_cache:
+            await llm_response_cache.set(cache_key, result)
+        return result
     except Exception as e:
         logger.error(f"Error getting chat response: {str(e)}")
         raise
 
-async def get_chat_response_stream_langchain(messages: List[Dict[str, str]], system_prompt: str = "", model_name: str="ai_chat_model", if_r1: bool=False) -> AsyncIterator[str]:
+async def get_chat_response_stream_langchain(messages: List[Dict[str, str]], system_prompt: str = "", model_name: str="ai_chat_model", if_r1: bool=False, result: Optional[StreamResult] = None, priority: str = INTERACTIVE) -> AsyncIterator[str]:
     """
     获取 OpenAI 聊天模型的流式响应
     :param messages: 聊天消息列表，格式为 [{"role": "system"|"user"|"assistant", "content": "消息内容"}, ...]
-    :return: 返回一个异步迭代器，每次迭代返回一个聊天结果的片段
+    :param result: 传入时在流结束后写入完整响应，调用方无需再解析 Done 事件
+    :param priority: 调度优先级 interactive / batch，超出模型并发上限时排队
+    :return: 返回一个异步迭代器，每次迭代返回一个聊天结果的片段 (SSE 事件)
     """
-    # 模型名根据传入参数从环境变量中获取，如果环境变量中没有则直接使用传入的参数
-    model_name = os.getenv(model_name) if os.getenv(model_name) else model_name
+    model_name = resolve_model_name(model_name)
     logger.info(model_name)
     if not os.getenv("GLOBAL_R1")=="True":
         if_r1=False
 
-    if if_r1:
-        # 针对 deepseek r1 系列的 reasoning_content 额外参数的处理
-        llm = ChatDeepSeek(
-            model=model_name,
-            temperature=0,
-            max_tokens=None,
-            timeout=None,
-            max_retries=2,
-            api_key=os.getenv("ray_ai_api_key_default"),
-            api_base=os.getenv("ray_ai_base_url"),
-        )
-    else:
-        # 初始化 LangChain 的 ChatOpenAI
-        llm = ChatOpenAI(
-            model=model_name,
-            temperature=0,
-            max_tokens=None,
-            timeout=None,
-            max_retries=2,
-            api_key=os.getenv("ray_ai_api_key_default"),
-            base_url=os.getenv("ray_ai_base_url"),
-        )
     # 假如方法中传入参数system prompt 则在 messages 最前面加上，否则加上默认提示词
     if not system_prompt and messages[0]["role"] != "system":
         system_message = {
@@ -246,68 +291,113 @@ async def get_chat_response_stream_langchain(messages: List[Dict[str, str]], sys
         }
         messages.insert(0, system_message)
     # print(messages)
-    start_time = time.time()
-    # 将时间戳转换为人类可读格式，精确到毫秒
-    readable_start_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start_time)) + f".{int(start_time * 1000) % 1000:03d}"
-    logger.info(f"now begin stream llm: {readable_start_time}")
-    flag = 1
-    r1_think_flag = 0
-    
+    # 占用模型的并发名额，超出上限时按优先级排队，流结束或客户端断开时释放
+    async with llm_scheduler.slot(model_name, priority):
+        start_time = time.time()
+        # 将时间戳转换为人类可读格式，精确到毫秒
+        readable_start_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start_time)) + f".{int(start_time * 1000) % 1000:03d}"
+        logger.info(f"now begin stream llm: {readable_start_time}")
+        # 按观测到的首 token 延迟和在途请求数选择上游，首个 token 之前的连接错误切换到下一个上游
+        if if_r1:
+            completion = llm_router.stream(
+                model_name, lambda upstream: _get_llm(upstream, model_name, if_r1=True).astream(messages))
+        else:
+            completion = llm_router.stream(
+                model_name, lambda upstream: _get_llm(upstream, model_name).astream(messages, stream_usage=True))
+        # 按块收集响应内容，结束时只拼接一次；文本片段按配置的时间/字节窗口合并为 SSE 帧
+        accumulator = StreamAccumulator()
+        encoder = SSEEncoder()
+        try:
+            async for text in coalesce(_stream_text(completion, accumulator, start_time, if_r1)):
+                yield encoder.event(text, event="update")
+        except (asyncio.CancelledError, GeneratorExit):
+            # 客户端断开等原因提前关闭流：上游请求随之关闭，剩余 token 不再生成
+            _log_cancelled_stream(model_name, accumulator, start_time)
+            raise
+
+    end_time = time.time()
+    record_span("llm_total", end_time - start_time)
+    readable_ft_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(end_time)) + f".{int(end_time * 1000) % 1000:03d}"
+    time_diff_ms = (end_time - start_time) * 1000  # 转换为毫秒
+    logger.info(f"when we get all token from llm: {readable_ft_time}")
+    logger.info(f"all out put Consume time: {time_diff_ms:.2f} ms")
     if if_r1:
-        completion = llm.astream(messages)
+        response_dict = {
+            "content": accumulator.content,
+            "response_metadata": accumulator.response_metadata,
+            "time_consuming": f"{time_diff_ms:.2f}"
+        }
     else:
-        completion = llm.astream(messages, stream_usage=True)
+        response_dict = {
+        "content": accumulator.content,
+        "response_metadata": accumulator.response_metadata,
+        "usage_metadata": accumulator.usage_metadata,
+        "time_consuming": f"{time_diff_ms:.2f}"
+        }
+    output_tokens = (accumulator.usage_metadata or {}).get("output_tokens") or accumulator.chunks
+    average = _completion_tokens_ewma.get(model_name)
+    _completion_tokens_ewma[model_name] = output_tokens if average is None else 0.2 * output_tokens + 0.8 * average
+    if result is not None:
+        result.content = accumulator.content
+        result.reasoning_content = accumulator.reasoning_content
+        result.response_metadata = accumulator.response_metadata
+        result.usage_metadata = accumulator.usage_metadata
+        result.time_consuming = f"{time_diff_ms:.2f}"
+        result.done = True
+    yield encoder.event(response_dict, event="Done")
+
+
+
+def _log_cancelled_stream(model_name: str, accumulator: StreamAccumulator, start_time: float):
+    """
+    记录被取消的流：已收到的 token 数按块数计（兼容 OpenAI 的服务每块一个 token），
+    节省的 token 数按该模型完整回复的平均长度估算
+    """
+    received = accumulator.chunks
+    saved = max(0, int(_completion_tokens_ewma.get(model_name, 0) - received))
+    LLM_STREAMS_CANCELLED.labels(model=model_name).inc()
+    LLM_TOKENS_SAVED.labels(model=model_name).inc(saved)
+    logger.info(f"LLM stream cancelled after {(time.time() - start_time) * 1000:.2f} ms: "
+                f"{received} tokens received, ~{saved} tokens saved")
+
+
+async def _stream_text(completion, accumulator: StreamAccumulator, start_time: float, if_r1: bool) -> AsyncIterator[str]:
+    """
+    将模型的流式输出转换为要推送给前端的文本片段，同时收集完整响应
+    r1 系列模型的思考过程 (reasoning_content) 包裹在 <think></think> 中输出
+    """
+    flag = 1
+    r1_think_flag = 0
     # 获取流式响应（异步生成器）
     async for chunk in completion:
         if flag == 1:
             ft_time = time.time()
             readable_ft_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ft_time)) + f".{int(ft_time * 1000) % 1000:03d}"
+            record_span("llm_ttft", ft_time - start_time)
             time_diff_ms = (ft_time - start_time) * 1000  # 转换为毫秒
             logger.info(f"first token Consume time: {time_diff_ms:.2f} ms")
             logger.info(f"when we get first token from llm: {readable_ft_time}")
-            full = chunk
             flag=0
-        full += chunk
+        accumulator.add(chunk)
 
         if if_r1:
             if r1_think_flag==0:
-                yield f"event:update\ndata:<think>\n\n"
+                yield "<think>"
                 r1_think_flag=1
-                print("开始思考")
+                logger.debug("开始思考")
 
             if chunk.content and r1_think_flag==2:
                 r1_think_flag=3
-                yield f"event:update\ndata:</think>\n\n"
-                print("结束思考")
+                yield "</think>"
+                logger.debug("结束思考")
 
-            if r1_think_flag==2 or chunk.additional_kwargs.get("reasoning_content"):
+            reasoning_content = chunk.additional_kwargs.get("reasoning_content")
+            if r1_think_flag==2 or reasoning_content:
                 r1_think_flag=2
-                yield f"event:update\ndata:{chunk.additional_kwargs.get('reasoning_content')}\n\n"
+                if reasoning_content:
+                    yield reasoning_content
                 
-            if r1_think_flag==3:
-                yield f"event:update\ndata:{chunk.content}\n\n"
-        else:
-            yield f"event:update\ndata:{chunk.content}\n\n" # 假设 AIMessageChunk 有 content 属性
-
-    end_time = time.time()
-    readable_ft_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(end_time)) + f".{int(end_time * 1000) % 1000:03d}"
-    time_diff_ms = (end_time - start_time) * 1000  # 转换为毫秒
-    logger.info(f"when we get all token from llm: {readable_ft_time}")
-    logger.info(f"all out put Consume time: {time_diff_ms:.2f} ms")
-    if if_r1:
-        response_dict = {
-            "content": full.content,
-            "response_metadata": full.response_metadata,
-            "time_consuming": f"{time_diff_ms:.2f}"
-        }
-    else:
-        response_dict = {
-        "content": full.content,
-        "response_metadata": full.response_metadata,
-        "usage_metadata": full.usage_metadata,
-        "time_consuming": f"{time_diff_ms:.2f}"
-        }
-    # 将字典转换为 JSON 字符串
-    json_string = json.dumps(response_dict, ensure_ascii=False)
-    yield f"event: Done\ndata:{json_string}\n\n"
-
+            if r1_think_flag==3 and chunk.content:
+                yield chunk.content
+        elif chunk.content:
+            yield chunk.content
@@ -0,0 +1,156 @@
+from typing import Dict, List, Optional
+import asyncio
+import os
+import time
+from database.async_connection import get_async_db_connection, close_async_pools
+from tools.embedding_service import embedding_service
+from tools.hybrid_retrieval import hybrid_retriever, law_bm25_index, RAG_HYBRID_ENABLED
+from tools.utils import read_json, write_json
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+# Where the precomputed question -> law slices table is stored
+QUESTION_LAW_TABLE_PATH = os.getenv("QUESTION_LAW_TABLE_PATH", "data/question_law_table.json")
+QUESTION_LAW_TABLE_TOP_K = int(os.getenv("QUESTION_LAW_TABLE_TOP_K", "5"))
+# Questions embedded and searched at the same time while building
+QUESTION_LAW_TABLE_CONCURRENCY = int(os.getenv("QUESTION_LAW_TABLE_CONCURRENCY", "16"))
+
+
+def retrieval_mode() -> str:
+    """"hybrid" when rag_search fuses BM25 with vector search, otherwise "vector"."""
+    return "hybrid" if RAG_HYBRID_ENABLED and law_bm25_index.ready else "vector"
+
+
+def build_question_query(q_stem: str, options: str) -> str:
+    """The RAG query text for a question; the live path and the precompute job must agree on it."""
+    return f"q:{q_stem};\noptions:{options}"
+
+
+class QuestionLawTable:
+    """
+    Precomputed top-k law slices per te_exam_question.que_id.
+
+    Retrieval for a question depends only on its stem and options, so the
+    embedding and vector search can be done offline once. The table is kept
+    in memory and persisted as JSON; a question missing from it falls back to
+    live embedding plus search. The table is built with the same retrieval
+    rag_search uses (hybrid or vector only) and is not served while the
+    live mode differs, so enabling hybrid retrieval needs a rebuild.
+    """
+
+    def __init__(self, path: str = QUESTION_LAW_TABLE_PATH):
+        self.path = path
+        self.table: Dict[int, List[dict]] = {}
+        self.meta: dict = {}
+
+    def get(self, question_id: int, top_k: int = QUESTION_LAW_TABLE_TOP_K) -> Optional[List[dict]]:
+        """Return the precomputed law slices for a question, or None on a miss."""
+        if self.meta.get("retrieval", "vector") != retrieval_mode():
+            return None
+        results = self.table.get(question_id)
+        if results is None or len(results) < top_k:
+            return None
+        return results[:top_k]
+
+    def load(self) -> dict:
+        """Load the table from disk; a missing file leaves the table empty."""
+        if not os.path.exists(self.path):
+            logger.info(f"Question law table {self.path} not found, retrieval runs live")
+            return self.stats()
+        data = read_json(self.path)
+        self.table = {int(question_id): results for question_id, results in data["questions"].items()}
+        self.meta = data.get("meta", {})
+        logger.info(f"Question law table loaded: {self.stats()}")
+        return self.stats()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        write_json(self.path, {
+            "meta": self.meta,
+            "questions": {str(question_id): results for question_id, results in self.table.items()},
+        })
+
+    async def build(self, top_k: int = QUESTION_LAW_TABLE_TOP_K,
+                    concurrency: int = QUESTION_LAW_TABLE_CONCURRENCY) -> dict:
+        """
+        Precompute the table for every question in te_exam_question, then swap
+        it in and persist it. Questions whose embedding or search fails are
+        left out and keep being served live.
+        """
+        start_time = time.time()
+        query = """
+            SELECT que_id, q_stem, options
+            FROM tobacco.te_exam_question;
+        """
+        async with get_async_db_connection() as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(query)
+                questions = await cursor.fetchall()
+
+        if RAG_HYBRID_ENABLED and not law_bm25_index.ready:
+            await law_bm25_index.load()
+        mode = retrieval_mode()
+
+        semaphore = asyncio.Semaphore(concurrency)
+        table: Dict[int, List[dict]] = {}
+
+        async def retrieve(question_id: int, q_stem: str, options: str):
+            async with semaphore:
+                try:
+                    query = build_question_query(q_stem, options)
+                    embedding = await embedding_service.get_embedding(query)
+                    if embedding is None:
+                        return
+                    if mode == "hybrid":
+                        results = await hybrid_retriever.search(query, embedding, top_k)
+                    else:
+                        results = await embedding_service.search_similar(embedding, top_k)
+                except Exception as e:
+                    logger.error(f"Question law table: retrieval for question {question_id} failed: {e}")
+                    return
+                if results:
+                    table[question_id] = results
+
+        await asyncio.gather(*(retrieve(*row) for row in questions))
+
+        self.table = table
+        self.meta = {
+            "top_k": top_k,
+            "retrieval": mode,
+            "embedding_model": embedding_service.model_name,
+            "built_at": time.time(),
+        }
+        self.save()
+        stats = self.stats()
+        stats["questions_total"] = len(questions)
+        logger.info(f"Question law table built in {(time.time() - start_time):.2f} s: {stats}")
+        return stats
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "questions": len(self.table),
+            **self.meta,
+        }
+
+
+# Singleton instance
+question_law_table = QuestionLawTable()
+
+
+if __name__ == "__main__":
+    # Offline precompute job: python -m tools.question_law_table
+    async def main():
+        try:
+            await question_law_table.build()
+        finally:
+            await embedding_service.close()
+            await close_async_pools()
+
+    asyncio.run(main())
@@ -0,0 +1,178 @@
+import asyncio
+import os
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Type
+from prometheus_client import Counter, Gauge
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+# Circuit breaker defaults
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RECOVERY_TIMEOUT = float(os.getenv("CIRCUIT_RECOVERY_TIMEOUT", "30"))
+
+CIRCUIT_STATE = Gauge(
+    "mcbot_circuit_state",
+    "Circuit breaker state: 0 closed, 1 half-open, 2 open",
+    ["circuit"],
+)
+CIRCUIT_REJECTIONS = Counter(
+    "mcbot_circuit_rejections_total",
+    "Calls rejected because the circuit was open",
+    ["circuit"],
+)
+RETRY_ATTEMPTS = Counter(
+    "mcbot_retry_attempts_total",
+    "Retries after a failed call",
+    ["circuit"],
+)
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the endpoint while its circuit is open."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit '{name}' is open, retry after {retry_after:.1f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class RetryableStatusError(Exception):
+    """An upstream answered with a status worth retrying (5xx / 429)."""
+
+    def __init__(self, status: int, detail: str = ""):
+        super().__init__(f"Upstream returned status {status}: {detail}")
+        self.status = status
+        self.detail = detail
+
+
+class CircuitBreaker:
+    """
+    Per-endpoint circuit breaker.
+
+    After failure_threshold consecutive failures the circuit opens and calls
+    fail fast. Once recovery_timeout has passed it goes half-open and lets
+    half_open_max_calls probe calls through: a success closes it, a failure
+    opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+                 recovery_timeout: float = CIRCUIT_RECOVERY_TIMEOUT, half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._half_open_calls = 0
+        CIRCUIT_STATE.labels(circuit=name).set(0)
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning(f"Circuit '{self.name}' {self.state} -> {state}")
+        self.state = state
+        CIRCUIT_STATE.labels(circuit=self.name).set(_STATE_VALUES[state])
+
+    def before_call(self):
+        """Check whether a call may go through; raises CircuitOpenError if not."""
+        if self.state == OPEN:
+            remaining = self.opened_at + self.recovery_timeout - time.time()
+            if remaining > 0:
+                CIRCUIT_REJECTIONS.labels(circuit=self.name).inc()
+                raise CircuitOpenError(self.name, remaining)
+            self._set_state(HALF_OPEN)
+            self._half_open_calls = 0
+        if self.state == HALF_OPEN:
+            if self._half_open_calls >= self.half_open_max_calls:
+                CIRCUIT_REJECTIONS.labels(circuit=self.name).inc()
+                raise CircuitOpenError(self.name, self.recovery_timeout)
+            self._half_open_calls += 1
+
+    def release_probe(self):
+        """Give back a half-open probe slot for a call that ended without a result."""
+        if self.state == HALF_OPEN and self._half_open_calls > 0:
+            self._half_open_calls -= 1
+
+    def record_success(self):
+        self.failures = 0
+        self._set_state(CLOSED)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.time()
+            self._set_state(OPEN)
+
+
+class RetryPolicy:
+    """
+    Retry with exponential backoff and full jitter: the wait before retry n
+    is a random value in [0, min(max_delay, base_delay * 2 ** n)].
+
+    Only exceptions in retry_on are retried and counted as circuit failures;
+    anything else is raised straight away.
+    """
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.2, max_delay: float = 2.0,
+                 retry_on: Tuple[Type[BaseException], ...] = (Exception,)):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def call(self, func: Callable[..., Awaitable], *args,
+                   breaker: Optional[CircuitBreaker] = None, **kwargs):
+        """Call func(*args, **kwargs) under this policy and the optional circuit breaker."""
+        name = breaker.name if breaker else getattr(func, "__name__", "call")
+        for attempt in range(self.max_attempts):
+            if breaker:
+                breaker.before_call()
+            try:
+                result = await func(*args, **kwargs)
+            except self.retry_on as e:
+                if breaker:
+                    breaker.record_failure()
+                logger.error(f"{name} attempt {attempt + 1}/{self.max_attempts} failed: {e}")
+                if attempt + 1 >= self.max_attempts:
+                    raise
+                RETRY_ATTEMPTS.labels(circuit=name).inc()
+                await asyncio.sleep(self.backoff(attempt))
+            except asyncio.CancelledError:
+                if breaker:
+                    breaker.release_probe()
+                raise
+            except Exception:
+                # The endpoint answered, the error is not an availability failure
+                if breaker:
+                    breaker.record_success()
+                raise
+            else:
+                if breaker:
+                    breaker.record_success()
+                return result
+
+
+# One breaker per endpoint
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+def get_circuit_breaker(name: str, **kwargs) -> CircuitBreaker:
+    """Return the circuit breaker for an endpoint, creating it on first use."""
+    if name not in _circuit_breakers:
+        _circuit_breakers[name] = CircuitBreaker(name, **kwargs)
+    return _circuit_breakers[name]
+
+def get_circuit_states() -> dict:
+    return {name: breaker.state for name, breaker in _circuit_breakers.items()}
@@ -0,0 +1,330 @@
+from typing import Dict, List, Optional
+import asyncio
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from psycopg import sql
+from database.async_connection import get_async_db_connection, close_async_pools
+from tools.embedding_service import embedding_service
+from tools.utils import read_json, write_json, examples_to_str
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+# Pick the tables for analysis prompts from the catalog; the built-in table info is used while it is empty
+SCHEMA_CATALOG_ENABLED = os.getenv("SCHEMA_CATALOG_ENABLED", "True") == "True"
+SCHEMA_CATALOG_PATH = os.getenv("SCHEMA_CATALOG_PATH", "data/schema_catalog.json")
+# Database and schemas that are introspected
+SCHEMA_CATALOG_DB = os.getenv("SCHEMA_CATALOG_DB", "prod")
+SCHEMA_CATALOG_SCHEMAS = [schema for schema in os.getenv("SCHEMA_CATALOG_SCHEMAS", "tobacco").split(",") if schema]
+# Tables put into a prompt, not counting the tables they reference
+SCHEMA_CATALOG_TOP_K = int(os.getenv("SCHEMA_CATALOG_TOP_K", "3"))
+# Rows read per table for column examples, examples kept per column and their maximum length
+SCHEMA_CATALOG_SAMPLE_ROWS = int(os.getenv("SCHEMA_CATALOG_SAMPLE_ROWS", "50"))
+SCHEMA_CATALOG_EXAMPLES = int(os.getenv("SCHEMA_CATALOG_EXAMPLES", "3"))
+SCHEMA_CATALOG_EXAMPLE_CHARS = int(os.getenv("SCHEMA_CATALOG_EXAMPLE_CHARS", "200"))
+# Descriptions embedded at the same time while building
+SCHEMA_CATALOG_CONCURRENCY = int(os.getenv("SCHEMA_CATALOG_CONCURRENCY", "16"))
+
+_COLUMNS_QUERY = """
+    SELECT c.table_schema, c.table_name, c.column_name, c.data_type, c.udt_name,
+           c.character_maximum_length, c.numeric_precision, c.numeric_scale, c.is_nullable,
+           col_description(format('%%I.%%I', c.table_schema, c.table_name)::regclass, c.ordinal_position),
+           obj_description(format('%%I.%%I', c.table_schema, c.table_name)::regclass, 'pg_class')
+    FROM information_schema.columns c
+    JOIN information_schema.tables t
+      ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+    WHERE c.table_schema = ANY(%s) AND t.table_type IN ('BASE TABLE', 'VIEW')
+    ORDER BY c.table_schema, c.table_name, c.ordinal_position;
+"""
+
+_KEYS_QUERY = """
+    SELECT tc.table_schema, tc.table_name, kcu.column_name, tc.constraint_type,
+           ccu.table_schema, ccu.table_name, ccu.column_name
+    FROM information_schema.table_constraints tc
+    JOIN information_schema.key_column_usage kcu
+      ON kcu.constraint_schema = tc.constraint_schema AND kcu.constraint_name = tc.constraint_name
+    LEFT JOIN information_schema.constraint_column_usage ccu
+      ON tc.constraint_type = 'FOREIGN KEY'
+     AND ccu.constraint_schema = tc.constraint_schema AND ccu.constraint_name = tc.constraint_name
+    WHERE tc.table_schema = ANY(%s) AND tc.constraint_type IN ('PRIMARY KEY', 'FOREIGN KEY');
+"""
+
+_NUMERIC_TYPES = {"smallint", "integer", "bigint", "numeric", "real", "double precision"}
+
+
+def _column_type(data_type: str, udt_name: str, max_length, precision, scale) -> str:
+    if data_type == "character varying" and max_length:
+        return f"VARCHAR({max_length})"
+    if data_type == "numeric" and precision:
+        return f"NUMERIC({precision},{scale or 0})"
+    if data_type in ("USER-DEFINED", "ARRAY"):
+        return udt_name.upper()
+    return data_type.upper()
+
+
+def _examples(values: list) -> List[str]:
+    """Distinct sample values as strings, the same way the rest of the NL2SQL tooling renders them."""
+    distinct = list(dict.fromkeys(value for value in values if value is not None))
+    examples = examples_to_str(distinct)[:SCHEMA_CATALOG_EXAMPLES]
+    return [example[:SCHEMA_CATALOG_EXAMPLE_CHARS] for example in examples]
+
+
+def render_table(table: dict) -> str:
+    """One table in the schema prompt format generate_sql expects."""
+    lines = []
+    for column in table["columns"]:
+        parts = [f"{column['name']}:{column['type']}"]
+        if column["primary_key"]:
+            parts.append("Primary Key")
+        elif not column["nullable"]:
+            parts.append("NOT NULL")
+        if column["comment"]:
+            parts.append(column["comment"])
+        if column["maps_to"]:
+            parts.append(f"Maps to {column['maps_to']}")
+        if column["examples"]:
+            if column["numeric"]:
+                examples = ", ".join(column["examples"])
+            else:
+                examples = ", ".join(json.dumps(example, ensure_ascii=False) for example in column["examples"])
+            parts.append(f"Examples:[{examples}]")
+        lines.append(f"  ({', '.join(parts)})")
+    comment = f"\n# Comment: {table['comment']}" if table["comment"] else ""
+    return f"[DB_ID] {table['schema']}\n[Schema]\n# Table: {table['name']}{comment}\n[\n" + ",\n".join(lines) + "\n]\n"
+
+
+def _descriptions(table: dict) -> List[str]:
+    """Texts embedded for a table: the table itself, then each of its columns."""
+    texts = [f"{table['name']} {table['comment'] or ''}".strip()]
+    for column in table["columns"]:
+        examples = " ".join(column["examples"][:2]) if not column["numeric"] else ""
+        texts.append(f"{table['name']}.{column['name']} {column['comment'] or ''} {examples}".strip())
+    return texts
+
+
+class SchemaCatalog:
+    """
+    Introspected tables of the analysis database, for picking the tables a
+    question needs instead of putting every table into the NL2SQL prompt.
+
+    build() reads information_schema and a few sample rows per table, embeds
+    a description of every table and column, and persists the catalog as
+    JSON. select_tables() ranks tables by the best similarity of the
+    question to any of their descriptions, adds the tables they reference,
+    and renders them in the schema prompt format. version is a hash of the
+    rendered schema, so caches keyed on it go stale when the schema changes.
+    """
+
+    def __init__(self, path: str = SCHEMA_CATALOG_PATH):
+        self.path = path
+        self.tables: List[dict] = []
+        self.meta: dict = {}
+        self.version: Optional[str] = None
+        self._rendered: List[str] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._owners: Optional[np.ndarray] = None
+        self._listeners = []
+
+    def ready(self) -> bool:
+        return bool(self.tables) and self.meta.get("embedding_model") == embedding_service.model_name
+
+    def on_change(self, listener):
+        """Call listener() whenever a catalog with a different version is swapped in."""
+        self._listeners.append(listener)
+
+    def _swap(self, tables: List[dict], meta: dict):
+        rendered = [render_table(table) for table in tables]
+        vectors, owners = [], []
+        for index, table in enumerate(tables):
+            vectors.extend(table["vectors"])
+            owners.extend([index] * len(table["vectors"]))
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if len(matrix):
+            matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        previous = self.version
+        self.tables, self.meta, self._rendered = tables, meta, rendered
+        self._matrix, self._owners = matrix, np.asarray(owners, dtype=np.int64)
+        self.version = hashlib.sha256("".join(rendered).encode("utf-8")).hexdigest()[:16] if tables else None
+        if self.version != previous:
+            for listener in self._listeners:
+                listener()
+
+    def load(self) -> dict:
+        """Load the catalog from disk; a missing file leaves it empty."""
+        if not os.path.exists(self.path):
+            logger.info(f"Schema catalog {self.path} not found, analysis uses the built-in table info")
+            return self.stats()
+        data = read_json(self.path)
+        self._swap(data["tables"], data.get("meta", {}))
+        if not self.ready():
+            logger.warning(f"Schema catalog was embedded with {self.meta.get('embedding_model')}, "
+                           f"not {embedding_service.model_name}; refresh it before use")
+        logger.info(f"Schema catalog loaded: {self.stats()}")
+        return self.stats()
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        write_json(self.path, {"meta": self.meta, "tables": self.tables})
+
+    async def _introspect(self, db_type: str, schemas: List[str]) -> List[dict]:
+        tables: Dict[tuple, dict] = {}
+        async with get_async_db_connection(db_type) as connection:
+            async with connection.cursor() as cursor:
+                await cursor.execute(_COLUMNS_QUERY, (schemas,))
+                for (schema, name, column, data_type, udt_name, max_length, precision, scale,
+                     nullable, column_comment, table_comment) in await cursor.fetchall():
+                    table = tables.setdefault((schema, name), {
+                        "schema": schema, "name": name, "comment": table_comment,
+                        "columns": [], "references": [], "vectors": [],
+                    })
+                    table["columns"].append({
+                        "name": column,
+                        "type": _column_type(data_type, udt_name, max_length, precision, scale),
+                        "numeric": data_type in _NUMERIC_TYPES,
+                        "nullable": nullable == "YES",
+                        "primary_key": False,
+                        "comment": column_comment,
+                        "maps_to": None,
+                        "examples": [],
+                    })
+                await cursor.execute(_KEYS_QUERY, (schemas,))
+                for schema, name, column, constraint_type, ref_schema, ref_table, ref_column in await cursor.fetchall():
+                    table = tables.get((schema, name))
+                    if table is None:
+                        continue
+                    for entry in table["columns"]:
+                        if entry["name"] != column:
+                            continue
+                        if constraint_type == "PRIMARY KEY":
+                            entry["primary_key"] = True
+                        elif ref_table:
+                            entry["maps_to"] = f"{ref_table}.{ref_column}"
+                            if ref_schema == schema and ref_table != name and ref_table not in table["references"]:
+                                table["references"].append(ref_table)
+
+            for table in tables.values():
+                query = sql.SQL("SELECT * FROM {}.{} LIMIT {}").format(
+                    sql.Identifier(table["schema"]), sql.Identifier(table["name"]),
+                    sql.Literal(SCHEMA_CATALOG_SAMPLE_ROWS))
+                try:
+                    async with connection.cursor() as cursor:
+                        await cursor.execute(query)
+                        names = [description.name for description in cursor.description]
+                        rows = await cursor.fetchall()
+                except Exception as e:
+                    # e.g. no SELECT permission; the table is still listed, just without examples
+                    logger.warning(f"Schema catalog: sampling {table['schema']}.{table['name']} failed: {e}")
+                    await connection.rollback()
+                    continue
+                for column in table["columns"]:
+                    if column["name"] in names and column["type"] not in ("BYTEA", "VECTOR"):
+                        index = names.index(column["name"])
+                        column["examples"] = _examples([row[index] for row in rows])
+        return list(tables.values())
+
+    async def build(self, db_type: str = SCHEMA_CATALOG_DB, schemas: List[str] = None,
+                    concurrency: int = SCHEMA_CATALOG_CONCURRENCY) -> dict:
+        """
+        Introspect the schemas, embed the table and column descriptions, then
+        swap the catalog in and persist it. Descriptions whose embedding fails
+        are left out; a table without any vector can only be picked as a
+        referenced table.
+        """
+        start_time = time.time()
+        schemas = schemas or SCHEMA_CATALOG_SCHEMAS
+        tables = await self._introspect(db_type, schemas)
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def embed(text: str) -> Optional[List[float]]:
+            async with semaphore:
+                try:
+                    return await embedding_service.get_embedding(text)
+                except Exception as e:
+                    logger.error(f"Schema catalog: embedding {text!r} failed: {e}")
+                    return None
+
+        for table in tables:
+            vectors = await asyncio.gather(*(embed(text) for text in _descriptions(table)))
+            table["vectors"] = [np.round(vector, 6).tolist() for vector in vectors if vector is not None]
+
+        self._swap(tables, {
+            "db_type": db_type,
+            "schemas": schemas,
+            "embedding_model": embedding_service.model_name,
+            "built_at": time.time(),
+        })
+        self.save()
+        stats = self.stats()
+        logger.info(f"Schema catalog built in {(time.time() - start_time):.2f} s: {stats}")
+        return stats
+
+    async def select_tables(self, question: str, top_k: int = SCHEMA_CATALOG_TOP_K) -> Optional[str]:
+        """
+        The schema prompt for the tables most similar to the question plus the
+        tables they reference, or None when the catalog cannot be used or the
+        question cannot be embedded.
+        """
+        if not self.ready():
+            return None
+        if len(self.tables) <= top_k:
+            return "\n".join(self._rendered)
+        if not len(self._matrix):
+            return None
+        try:
+            embedding = await embedding_service.get_embedding(question)
+        except Exception as e:
+            # Embedding service down or its breaker open: the caller falls back to the built-in table info
+            logger.error(f"Schema catalog: embedding the question failed, not selecting tables: {e}")
+            return None
+        if embedding is None:
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        scores = np.full(len(self.tables), -np.inf, dtype=np.float32)
+        np.maximum.at(scores, self._owners, self._matrix @ query)
+        selected = [int(index) for index in np.argsort(-scores)[:top_k] if np.isfinite(scores[index])]
+
+        by_name = {(table["schema"], table["name"]): index for index, table in enumerate(self.tables)}
+        for index in list(selected):
+            table = self.tables[index]
+            for reference in table["references"]:
+                referenced = by_name.get((table["schema"], reference))
+                if referenced is not None and referenced not in selected:
+                    selected.append(referenced)
+        logger.debug(f"Schema catalog picked {[self.tables[index]['name'] for index in selected]} for {question!r}")
+        return "\n".join(self._rendered[index] for index in selected)
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "tables": len(self.tables),
+            "columns": sum(len(table["columns"]) for table in self.tables),
+            "vectors": 0 if self._matrix is None else len(self._matrix),
+            "version": self.version,
+            **self.meta,
+        }
+
+
+# Singleton instance
+schema_catalog = SchemaCatalog()
+
+
+if __name__ == "__main__":
+    # Refresh job: python -m tools.schema_catalog
+    async def main():
+        try:
+            await schema_catalog.build()
+        finally:
+            await embedding_service.close()
+            await close_async_pools()
+
+    asyncio.run(main())
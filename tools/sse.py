@@ -0,0 +1,74 @@
+import json
+import os
+import re
+from dataclasses import dataclass, field, asdict
+from typing import Any, Optional
+
+# Add an incrementing id to every event of a stream, and a reconnect hint (ms) to its first event
+SSE_EVENT_IDS = os.getenv("SSE_EVENT_IDS") == "True"
+SSE_RETRY_MS = int(os.getenv("SSE_RETRY_MS")) if os.getenv("SSE_RETRY_MS") else None
+
+_LINE_BREAK_RE = re.compile(r"\r\n|\r|\n")
+
+
+def _field(name: str, value: str) -> str:
+    # Parsers drop one space after the colon, so a value starting with a space needs an extra one
+    return f"{name}: {value}" if value.startswith(" ") else f"{name}:{value}"
+
+
+def sse_event(data: Any, event: Optional[str] = None, id: Optional[Any] = None,
+              retry: Optional[int] = None) -> str:
+    """
+    Encode one Server-Sent Event.
+    :param data: strings are sent as is, anything else as JSON; multi-line data
+        becomes several data lines, which the client joins back with newlines
+    :param event: event type
+    :param id: event id, sent back by the client as Last-Event-ID on reconnect
+    :param retry: reconnect delay hint for the client, in milliseconds
+    :return: the event text, terminated by a blank line
+    """
+    if not isinstance(data, str):
+        data = json.dumps(data, ensure_ascii=False, default=str)
+    lines = []
+    if event:
+        lines.append(_field("event", event))
+    if id is not None:
+        lines.append(_field("id", str(id)))
+    if retry is not None:
+        lines.append(f"retry:{int(retry)}")
+    lines += [_field("data", line) for line in _LINE_BREAK_RE.split(data)]
+    return "\n".join(lines) + "\n\n"
+
+
+class SSEEncoder:
+    """
+    Encoder for one stream: numbers its events when ids are enabled and puts
+    the retry hint on the first event only.
+    """
+
+    def __init__(self, ids: bool = SSE_EVENT_IDS, retry: Optional[int] = SSE_RETRY_MS):
+        self.ids = ids
+        self.retry = retry
+        self.count = 0
+
+    def event(self, data: Any, event: Optional[str] = None) -> str:
+        self.count += 1
+        retry = self.retry if self.count == 1 else None
+        return sse_event(data, event=event, id=self.count if self.ids else None, retry=retry)
+
+
+@dataclass
+class StreamResult:
+    """
+    The final result of a streamed LLM response, filled in by the stream when
+    it finishes, so callers read it directly instead of parsing the Done event.
+    """
+    content: str = ""
+    reasoning_content: str = ""
+    response_metadata: dict = field(default_factory=dict)
+    usage_metadata: Optional[dict] = None
+    time_consuming: Optional[str] = None
+    done: bool = False
+
+    def to_dict(self) -> dict:
+        return asdict(self)
@@ -0,0 +1,66 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict
+from tools.timing import record_span
+
+
+class StageGraph:
+    """
+    Runs the async stages of a pipeline as soon as their dependencies are done.
+
+    Each stage is started when it is added and receives the results of its
+    dependencies as positional arguments, so independent stages run
+    concurrently while the caller awaits results in whatever order it reports
+    them. Stage durations are recorded as request spans under the stage name.
+
+        graph = StageGraph()
+        graph.add("optimize_query", optimize_query, user_query)
+        graph.add("select_table", select_table, user_query)
+        graph.add("generate_sql", generate_sql, deps=("optimize_query", "select_table"))
+        sql = await graph.result("generate_sql")
+    """
+
+    def __init__(self):
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.durations: Dict[str, float] = {}
+
+    def add(self, name: str, func: Callable[..., Awaitable[Any]], *args, deps: tuple = (), after: tuple = ()):
+        """
+        Start a stage. It runs func(*args, *dependency results) once every
+        stage named in deps has finished; stages named in after are waited
+        for as well, but their results are not passed. Both must already be added.
+        """
+        if name in self.tasks:
+            raise ValueError(f"Stage {name} already added")
+        dependencies = [self.tasks[dep] for dep in deps]
+        predecessors = [self.tasks[stage] for stage in after]
+
+        async def run():
+            for predecessor in predecessors:
+                await predecessor
+            results = [await dependency for dependency in dependencies]
+            start = time.perf_counter()
+            try:
+                return await func(*args, *results)
+            finally:
+                self.durations[name] = time.perf_counter() - start
+                record_span(name, self.durations[name])
+
+        self.tasks[name] = asyncio.ensure_future(run())
+
+    async def result(self, name: str) -> Any:
+        return await self.tasks[name]
+
+    def duration_ms(self, name: str) -> float:
+        return round(self.durations.get(name, 0.0) * 1000, 2)
+
+    async def cancel(self):
+        """Cancel the stages still running, e.g. after one failed or the client left."""
+        pending = [task for task in self.tasks.values() if not task.done()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        # Failures nobody awaited would otherwise be logged as "never retrieved"
+        for task in self.tasks.values():
+            if task.done() and not task.cancelled():
+                task.exception()
@@ -0,0 +1,204 @@
+import asyncio
+import os
+import time
+from typing import AsyncIterator, List, Optional
+from langchain_core.messages.ai import add_usage
+from prometheus_client import Counter
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+# Coalesce streamed tokens into one SSE frame per window; 0 disables the limit.
+# With both at 0 every token is sent as its own frame.
+SSE_COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", "0"))
+SSE_COALESCE_BYTES = int(os.getenv("SSE_COALESCE_BYTES", "0"))
+# How often a streaming response checks whether its client is still connected
+SSE_DISCONNECT_POLL_S = float(os.getenv("SSE_DISCONNECT_POLL_S", "0.5"))
+
+STREAM_DISCONNECTS = Counter(
+    "mcbot_stream_disconnects_total",
+    "Streaming responses stopped because the client disconnected",
+    ["route"],
+)
+
+
+class StreamAccumulator:
+    """
+    Collects a streamed LLM response in linear time.
+
+    Merging AIMessageChunks with `full += chunk` copies the whole content on
+    every token, which is quadratic in the response length. The accumulator
+    keeps the parts in lists and joins them once at the end.
+    """
+
+    def __init__(self):
+        self.content_parts: List[str] = []
+        self.reasoning_parts: List[str] = []
+        self.response_metadata: dict = {}
+        self.usage_metadata: Optional[dict] = None
+        self.chunks = 0
+
+    def add(self, chunk):
+        """Add one AIMessageChunk."""
+        self.chunks += 1
+        if chunk.content:
+            self.content_parts.append(chunk.content)
+        reasoning = chunk.additional_kwargs.get("reasoning_content")
+        if reasoning:
+            self.reasoning_parts.append(reasoning)
+        if chunk.response_metadata:
+            self.response_metadata.update(chunk.response_metadata)
+        if chunk.usage_metadata:
+            self.usage_metadata = add_usage(self.usage_metadata, chunk.usage_metadata)
+
+    @property
+    def content(self) -> str:
+        return "".join(self.content_parts)
+
+    @property
+    def reasoning_content(self) -> str:
+        return "".join(self.reasoning_parts)
+
+
+async def coalesce(pieces: AsyncIterator[str], max_delay_ms: Optional[float] = None,
+                   max_bytes: Optional[int] = None) -> AsyncIterator[str]:
+    """
+    Join text pieces into larger ones. A joined piece is emitted once it
+    reaches max_bytes or max_delay_ms after its first part arrived, whichever
+    comes first, so a stalled upstream never holds buffered text back for
+    longer than the window. With both limits at 0 pieces pass through as is.
+    Limits default to SSE_COALESCE_MS / SSE_COALESCE_BYTES.
+    """
+    max_delay_ms = SSE_COALESCE_MS if max_delay_ms is None else max_delay_ms
+    max_bytes = SSE_COALESCE_BYTES if max_bytes is None else max_bytes
+    if max_delay_ms <= 0 and max_bytes <= 0:
+        try:
+            async for piece in pieces:
+                yield piece
+        finally:
+            await _aclose(pieces)
+        return
+
+    loop = asyncio.get_running_loop()
+    iterator = pieces.__aiter__()
+    buffer: List[str] = []
+    size = 0
+    deadline = None
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            can_go_stale = bool(buffer) and deadline is not None
+            if pending is None and not can_go_stale:
+                # Nothing buffered that a time window applies to: wait for the next piece directly
+                try:
+                    piece = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+            else:
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                timeout = max(0.0, deadline - loop.time()) if can_go_stale else None
+                done, _ = await asyncio.wait((pending,), timeout=timeout)
+                if not done:
+                    yield "".join(buffer)
+                    buffer, size, deadline = [], 0, None
+                    continue
+                finished, pending = pending, None
+                try:
+                    piece = finished.result()
+                except StopAsyncIteration:
+                    break
+
+            if not piece:
+                continue
+            if not buffer and max_delay_ms > 0:
+                deadline = loop.time() + max_delay_ms / 1000
+            buffer.append(piece)
+            size += len(piece.encode("utf-8"))
+            if (max_bytes > 0 and size >= max_bytes) or (deadline is not None and loop.time() >= deadline):
+                yield "".join(buffer)
+                buffer, size, deadline = [], 0, None
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        # Stop the piece being fetched, then close the source so its upstream request ends now
+        await _cancel(pending)
+        await _aclose(iterator)
+
+
+async def stop_on_disconnect(request, stream: AsyncIterator[str], route: str,
+                             poll_interval: Optional[float] = None) -> AsyncIterator[str]:
+    """
+    Pass the events of a streaming response through until its client
+    disconnects. The disconnect is noticed while the stream is waiting too
+    (for the first token, a DB query), not only on the next write: the wait
+    is cancelled where it is and the stream is closed, which closes the
+    upstream LLM request and releases slots and DB connections.
+
+    The stream keeps running in the response's own task, so server-side
+    cancellation (Starlette's disconnect listener) reaches it the same way.
+    :param request: the Starlette request of the response
+    :param route: label for logs and metrics
+    :param poll_interval: seconds between disconnect checks, default SSE_DISCONNECT_POLL_S
+    """
+    poll_interval = SSE_DISCONNECT_POLL_S if poll_interval is None else poll_interval
+    host = asyncio.current_task()
+    waiting = False
+    disconnected = False
+
+    async def watch():
+        nonlocal disconnected
+        while not await request.is_disconnected():
+            await asyncio.sleep(poll_interval)
+        disconnected = True
+        # Only interrupt the stream itself; while an event is being written the loop checks the flag
+        if waiting:
+            host.cancel()
+
+    iterator = stream.__aiter__()
+    watcher = asyncio.ensure_future(watch())
+    start_time = time.perf_counter()
+    events = 0
+    try:
+        while not disconnected:
+            waiting = True
+            try:
+                event = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            except asyncio.CancelledError:
+                # Cancelled by the watcher alone: swallow it and end the response normally
+                if not disconnected or host.cancelling() > 1:
+                    raise
+                host.uncancel()
+                break
+            finally:
+                waiting = False
+            events += 1
+            yield event
+        STREAM_DISCONNECTS.labels(route=route).inc()
+        logger.info(f"Client disconnected from {route} after {events} events "
+                    f"({time.perf_counter() - start_time:.2f}s), stream cancelled")
+    finally:
+        watcher.cancel()
+        await _aclose(iterator)
+
+
+async def _cancel(future: Optional[asyncio.Future]):
+    """Cancel a pending step of a stream and wait until it has stopped."""
+    if future is None or future.done():
+        return
+    future.cancel()
+    try:
+        await future
+    except (asyncio.CancelledError, Exception):
+        pass
+
+
+async def _aclose(iterator):
+    aclose = getattr(iterator, "aclose", None)
+    if aclose is not None:
+        await aclose()
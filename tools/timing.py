@@ -0,0 +1,110 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, Optional
+from prometheus_client import Histogram
+from tools.sse import sse_event
+
+# Add a Server-Timing header to responses, and a final "timing" event to SSE streams
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "True") == "True"
+SSE_TIMING_EVENT = os.getenv("SSE_TIMING_EVENT", "True") == "True"
+
+REQUEST_SPAN_SECONDS = Histogram(
+    "mcbot_request_span_seconds",
+    "Time spent per request stage (embedding, vector_search, question_fetch, history_load, llm_ttft, llm_total, ...)",
+    ["span"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+
+
+class RequestTiming:
+    """Spans recorded while serving one request; a span recorded twice adds up."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def to_dict(self) -> Dict[str, float]:
+        """Span durations in milliseconds, plus the time since the request started."""
+        timings = {name: round(seconds * 1000, 2) for name, seconds in self.spans.items()}
+        timings["total"] = round(self.elapsed() * 1000, 2)
+        return timings
+
+    def header(self) -> str:
+        """Server-Timing header value, e.g. `embedding;dur=12.5, total;dur=80.1`."""
+        return ", ".join(f"{name};dur={duration}" for name, duration in self.to_dict().items())
+
+
+_current_timing: ContextVar[Optional[RequestTiming]] = ContextVar("request_timing", default=None)
+
+
+def current_timing() -> Optional[RequestTiming]:
+    return _current_timing.get()
+
+
+def record_span(name: str, seconds: float):
+    """Record a measured span into the histogram and, inside a request, into its timing."""
+    REQUEST_SPAN_SECONDS.labels(span=name).observe(seconds)
+    timing = _current_timing.get()
+    if timing is not None:
+        timing.add(name, seconds)
+
+
+@contextmanager
+def span(name: str):
+    """Time the block as a span of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+class ServerTimingMiddleware:
+    """
+    Starts a RequestTiming for every HTTP request and adds the spans recorded
+    before the response starts as a Server-Timing header. Streaming responses
+    start before their work is done, so they report through
+    with_timing_event instead.
+
+    A plain ASGI middleware rather than BaseHTTPMiddleware, which would pipe
+    every chunk of a streaming body through an extra memory stream.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timing = RequestTiming()
+        token = _current_timing.set(timing)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and SERVER_TIMING_ENABLED:
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", timing.header().encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_timing.reset(token)
+
+
+async def with_timing_event(stream: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Pass an SSE stream through and end it with a "timing" event holding the request's spans."""
+    async for event in stream:
+        yield event
+    timing = _current_timing.get()
+    if SSE_TIMING_EVENT and timing is not None:
+        yield sse_event(timing.to_dict(), event="timing")
@@ -0,0 +1,138 @@
+from typing import List, Optional
+import os
+import time
+import numpy as np
+from database.async_connection import get_async_db_connection
+
+# ----------配置日志-------------
+from tools.ray_logger import LoggerHandler
+log_file = "main.log"
+logger = LoggerHandler(logger_level='DEBUG',file="logs/"+log_file)
+# -----------日志配置完成----------
+
+# Serve law similarity search from memory instead of the stored procedure
+LAW_INDEX_ENABLED = os.getenv("LAW_INDEX_ENABLED") == "True"
+# "numpy" (exact cosine top-k) or "hnsw" (approximate, needs hnswlib)
+LAW_INDEX_BACKEND = os.getenv("LAW_INDEX_BACKEND", "numpy")
+# Table behind tobacco.get_top5_laws_by_quevec
+LAW_INDEX_TABLE = os.getenv("LAW_INDEX_TABLE", "tobacco.law_slices")
+
+
+class LawVectorIndex:
+    """
+    In-memory index over the law slices: the vectors are kept in one contiguous,
+    L2-normalized float32 matrix so a query is a single matrix-vector product.
+    """
+
+    def __init__(self, table: str = LAW_INDEX_TABLE, backend: str = LAW_INDEX_BACKEND):
+        self.table = table
+        self.backend = backend
+        self.rows: List[dict] = []
+        self.matrix: Optional[np.ndarray] = None
+        self._hnsw = None
+        self.loaded_at: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.matrix is not None and len(self.rows) > 0
+
+    async def load(self) -> dict:
+        """Load (or reload) all law slices and their vectors from the database."""
+        start_time = time.time()
+        query = f"""
+            SELECT law_id, law_name, chapter, article_content, embedding
+            FROM {self.table}
+            WHERE embedding IS NOT NULL;
+        """
+        # Binary results: vectors are read as pgvector Vector objects without text parsing
+        async with get_async_db_connection() as conn:
+            async with conn.cursor(binary=True) as cursor:
+                await cursor.execute(query)
+                results = await cursor.fetchall()
+
+        rows = [{
+            "law_id": row[0],
+            "law_name": row[1],
+            "chapter": row[2],
+            "article_content": row[3],
+        } for row in results]
+        vectors = [row[4].to_numpy() for row in results]
+        self.build(rows, vectors)
+        stats = self.stats()
+        logger.info(f"Law vector index loaded in {(time.time() - start_time) * 1000:.2f} ms: {stats}")
+        return stats
+
+    async def warm_up(self):
+        """Load the index on startup; failures are logged and the database search is used."""
+        try:
+            await self.load()
+        except Exception as e:
+            logger.error(f"Law vector index load failed, falling back to database search: {e}")
+
+    def build(self, rows: List[dict], vectors) -> None:
+        """Build the index from row metadata and one vector per row."""
+        if not rows:
+            raise ValueError("Cannot build law vector index from an empty table")
+        matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        matrix /= norms
+
+        hnsw = None
+        if self.backend == "hnsw":
+            hnsw = self._build_hnsw(matrix)
+
+        # Swap everything at once so concurrent searches never see a half-built index
+        self.rows, self.matrix, self._hnsw = rows, matrix, hnsw
+        self.loaded_at = time.time()
+
+    def _build_hnsw(self, matrix: np.ndarray):
+        try:
+            import hnswlib
+        except ImportError:
+            logger.warning("hnswlib is not installed, law vector index falls back to numpy")
+            return None
+        index = hnswlib.Index(space="cosine", dim=matrix.shape[1])
+        index.init_index(max_elements=matrix.shape[0], ef_construction=200, M=16)
+        index.add_items(matrix, np.arange(matrix.shape[0]))
+        index.set_ef(64)
+        return index
+
+    def search(self, embedding: List[float], top_k: int = 5) -> List[dict]:
+        """Return the top_k most similar law slices by cosine similarity."""
+        rows, matrix, hnsw = self.rows, self.matrix, self._hnsw
+        if matrix is None:
+            raise RuntimeError("Law vector index is not loaded")
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+        top_k = min(top_k, len(rows))
+
+        if hnsw is not None:
+            labels, distances = hnsw.knn_query(query, k=top_k)
+            indices, scores = labels[0], 1 - distances[0]
+        else:
+            similarities = matrix @ query
+            if top_k < len(rows):
+                indices = np.argpartition(-similarities, top_k - 1)[:top_k]
+            else:
+                indices = np.arange(len(rows))
+            indices = indices[np.argsort(-similarities[indices])]
+            scores = similarities[indices]
+
+        return [{**rows[i], "similarity": float(score)} for i, score in zip(indices, scores)]
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "backend": "hnsw" if self._hnsw is not None else "numpy",
+            "rows": len(self.rows),
+            "dim": int(self.matrix.shape[1]) if self.matrix is not None else None,
+            "bytes": int(self.matrix.nbytes) if self.matrix is not None else 0,
+            "loaded_at": self.loaded_at,
+        }
+
+
+# Singleton instance
+law_vector_index = LawVectorIndex()